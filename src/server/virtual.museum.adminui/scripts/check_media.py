@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+"""
+Media Store Check
+
+This script compares the media directory with the MediaFiles table after a migration and reports
+media files whose local file is missing, empty or differs from what was downloaded, and files in
+the media directory that no media file refers to.
+
+Usage:
+  python check_media.py [--hash] [--jobs=<number>] [--report=<file>] [--repair]
+
+Options:
+  --hash             Also compare the SHA-256 of every file with the one recorded when it was downloaded
+  --jobs=N           Processes hashing files in parallel (default: number of CPUs)
+  --report=FILE      Write every finding to this JSON file
+  --repair           Queue the broken files for download_media.py: restore their original URL and remove the file
+  --verbose          List every finding instead of the first few of each kind
+"""
+
+import os
+import sys
+import argparse
+import json
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from tqdm import tqdm
+
+# Shared code of the tools in src/tools
+sys.path.append(str(Path(__file__).resolve().parents[3] / 'tools'))
+from shared.media_derivatives import is_derivative  # noqa: E402
+from shared.media_queries import iter_media_files  # noqa: E402
+from shared.metrics import metrics  # noqa: E402
+from download_journal import DownloadJournal, STATUS_COMPLETE  # noqa: E402
+from download_media import API_BASE_URL, DB_PATH, DOWNLOAD_JOURNAL_PATH, MEDIA_UPLOAD_DIR  # noqa: E402
+from hash_cache import HashCache  # noqa: E402
+from media_store import hash_file_mapped  # noqa: E402
+from url_writer import MediaUrlWriter  # noqa: E402
+
+# Hashes of the checked files, kept next to the download journal
+HASH_CACHE_PATH = os.getenv(
+    'MEDIA_HASH_CACHE_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(MEDIA_UPLOAD_DIR)), 'media_hash_cache.db'))
+# Files of unfinished downloads and links, not orphans
+TEMPORARY_SUFFIXES = ('.part', '.link', '.tmp')
+# Findings listed per kind without --verbose
+LIST_LIMIT = 20
+
+MISSING = 'missing'
+EMPTY = 'zero-length'
+MISMATCHED = 'mismatched'
+ORPHANED = 'orphaned'
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description='Check the media directory against the MediaFiles table.')
+    parser.add_argument('--hash', action='store_true',
+                        help='Also compare the SHA-256 of every file with the one recorded when it was downloaded')
+    parser.add_argument('--jobs', type=int, default=None, help='Processes hashing files in parallel')
+    parser.add_argument('--report', help='Write every finding to this JSON file')
+    parser.add_argument('--repair', action='store_true',
+                        help='Queue the broken files for download_media.py: restore their original URL and remove the file')
+    parser.add_argument('--verbose', action='store_true', help='List every finding instead of the first few')
+    args = parser.parse_args()
+    if args.jobs is not None and args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    return args
+
+def scan_media_dir(media_dir):
+    """Get the size and modification time of every media file in the media directory, by name.
+
+    Derivatives belong to their image and temporary files to an unfinished download, so neither
+    is listed. The .blobs directory of the content store is not descended into.
+    """
+    files = {}
+    with os.scandir(media_dir) as entries:
+        for entry in entries:
+            if not entry.is_file() or entry.name.startswith('.'):
+                continue
+            if entry.name.endswith(TEMPORARY_SUFFIXES) or is_derivative(entry.name):
+                continue
+            stat = entry.stat()
+            files[entry.name] = (stat.st_size, stat.st_mtime_ns)
+    return files
+
+def check_media_file(media_file, files, journal):
+    """Check the local file of one media file.
+
+    Returns (kind, detail, None) for a problem, otherwise (None, None, sha256) with the SHA-256
+    recorded by the download, if there is one, to compare with the hash of the file.
+    """
+    file_name = media_file['Url'][len(API_BASE_URL):]
+    found = files.get(file_name)
+    if found is None:
+        return MISSING, 'no file in the media directory', None
+    size = found[0]
+    if size == 0:
+        return EMPTY, 'the file is empty', None
+
+    entry = journal.get(media_file['Id']) if journal else None
+    if not entry or entry['Status'] != STATUS_COMPLETE:
+        return None, None, None
+    # A truncated download that was taken for complete by an older run
+    if entry['ContentLength'] is not None and entry['ContentLength'] != size:
+        return MISMATCHED, f"{size} bytes instead of {entry['ContentLength']}", None
+    return None, None, entry['Sha256']
+
+def hash_files(file_names, files, cache, jobs):
+    """Get the SHA-256 of the files, from the cache where the file did not change since it was hashed."""
+    hashes = {}
+    to_hash = []
+    for file_name in file_names:
+        size, mtime_ns = files[file_name]
+        cached = cache.get(file_name, size, mtime_ns)
+        if cached:
+            hashes[file_name] = cached
+        else:
+            to_hash.append(file_name)
+    metrics.count('hashes_cached', len(hashes))
+    if not to_hash:
+        return hashes
+
+    # Hashing is CPU bound, every process reads its files through a memory map
+    paths = [os.path.join(MEDIA_UPLOAD_DIR, file_name) for file_name in to_hash]
+    total_bytes = sum(files[file_name][0] for file_name in to_hash)
+    new_entries = []
+    with metrics.timer('hash', files=len(to_hash)), \
+            tqdm(total=total_bytes, unit='B', unit_scale=True, unit_divisor=1024) as progress_bar, \
+            ProcessPoolExecutor(max_workers=jobs) as executor:
+        for file_name, sha256 in zip(to_hash, executor.map(hash_file_mapped, paths, chunksize=16)):
+            size, mtime_ns = files[file_name]
+            hashes[file_name] = sha256
+            new_entries.append((file_name, size, mtime_ns, sha256))
+            progress_bar.update(size)
+            # Keep what was hashed so far if the check is interrupted
+            if len(new_entries) >= 1000:
+                cache.put_many(new_entries)
+                new_entries = []
+    cache.put_many(new_entries)
+    metrics.count('files_hashed', len(to_hash))
+    metrics.count('bytes_hashed', total_bytes)
+    return hashes
+
+def repair(findings, journal):
+    """Queue the broken files for another download and return how many were queued.
+
+    The URL of the media file is set back to the one it was downloaded from, so the next run of
+    download_media.py picks it up again. The broken file and its journal entry are removed, so it
+    is downloaded from scratch.
+    """
+    writer = MediaUrlWriter(DB_PATH)
+    writer.start()
+    queued = 0
+    try:
+        for finding in findings:
+            if finding['kind'] == ORPHANED:
+                continue
+            entry = journal.get(finding['id']) if journal else None
+            if not entry:
+                tqdm.write(f"Cannot repair {finding['id']}: its original URL is not in the download journal")
+                continue
+            file_path = os.path.join(MEDIA_UPLOAD_DIR, finding['file'])
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            journal.forget(finding['id'])
+            writer.submit(finding['id'], entry['Url'])
+            queued += 1
+    finally:
+        writer.close()
+    return queued
+
+def print_findings(findings, verbose):
+    """Print the findings grouped by kind."""
+    for kind in (MISSING, EMPTY, MISMATCHED, ORPHANED):
+        of_kind = [finding for finding in findings if finding['kind'] == kind]
+        if not of_kind:
+            continue
+        print(f"\n{kind.capitalize()}: {len(of_kind)} files")
+        shown = of_kind if verbose else of_kind[:LIST_LIMIT]
+        for finding in shown:
+            media_file = f" (ID: {finding['id']})" if finding['id'] else ''
+            print(f"  {finding['file']}{media_file}: {finding['detail']}")
+        if len(shown) < len(of_kind):
+            print(f"  ... and {len(of_kind) - len(shown)} more")
+
+def main():
+    """Main function."""
+    args = parse_args()
+
+    print("Checking media files...")
+    print(f"Database: {DB_PATH}")
+    print(f"Media directory: {MEDIA_UPLOAD_DIR}")
+
+    with metrics.timer('scan'):
+        files = scan_media_dir(MEDIA_UPLOAD_DIR)
+    print(f"Found {len(files)} files in the media directory")
+
+    conn = sqlite3.connect(DB_PATH)
+    conn.row_factory = sqlite3.Row
+    # Without a journal there is nothing to compare sizes and hashes with
+    journal = DownloadJournal(DOWNLOAD_JOURNAL_PATH) if os.path.exists(DOWNLOAD_JOURNAL_PATH) else None
+    cache = HashCache(HASH_CACHE_PATH) if args.hash else None
+
+    try:
+        findings = []
+        referenced = set()
+        # file name -> (media file ID, SHA-256 recorded by the download)
+        expected_hashes = {}
+        checked = 0
+
+        # The rows are streamed, only the local ones have a file to check
+        with metrics.timer('db_read'):
+            for media_file in iter_media_files(conn, batch_size=1000):
+                if not media_file['Url'] or not media_file['Url'].startswith(API_BASE_URL):
+                    continue
+                checked += 1
+                file_name = media_file['Url'][len(API_BASE_URL):]
+                referenced.add(file_name)
+                kind, detail, sha256 = check_media_file(media_file, files, journal)
+                if kind:
+                    findings.append({'kind': kind, 'id': media_file['Id'], 'file': file_name, 'detail': detail})
+                elif sha256:
+                    expected_hashes[file_name] = (media_file['Id'], sha256)
+        print(f"Checked {checked} media files with local URLs")
+
+        if args.hash:
+            hashes = hash_files(list(expected_hashes), files, cache, args.jobs)
+            for file_name, (file_id, sha256) in expected_hashes.items():
+                if hashes[file_name] != sha256:
+                    findings.append({'kind': MISMATCHED, 'id': file_id, 'file': file_name,
+                                     'detail': f"SHA-256 {hashes[file_name]} instead of {sha256}"})
+
+        for file_name in sorted(set(files) - referenced):
+            findings.append({'kind': ORPHANED, 'id': None, 'file': file_name,
+                             'detail': f"{files[file_name][0]} bytes, no media file refers to it"})
+
+        for finding in findings:
+            metrics.count(finding['kind'].replace('-', '_'))
+        print_findings(findings, args.verbose)
+        if not findings:
+            print('\nNo problems found')
+
+        if args.report:
+            with open(args.report, 'w', encoding='utf-8') as f:
+                json.dump(findings, f, ensure_ascii=False, indent=2)
+
+        if args.repair and any(finding['kind'] != ORPHANED for finding in findings):
+            queued = repair(findings, journal)
+            print(f"\nQueued {queued} files for download_media.py")
+
+        print(metrics.summary())
+        return 1 if findings else 0
+    finally:
+        if cache:
+            cache.close()
+        if journal:
+            journal.close()
+        conn.close()
+
+if __name__ == "__main__":
+    try:
+        sys.exit(main())
+    except Exception as e:
+        print(f"Fatal error: {str(e)}")
+        sys.exit(2)
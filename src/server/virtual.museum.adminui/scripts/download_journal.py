@@ -0,0 +1,103 @@
+"""
+Download Journal
+
+Records the progress of every media file handled by download_media.py in a small SQLite
+database, so an interrupted migration can resume partial downloads and skip finished
+files without asking the server again.
+"""
+
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+STATUS_PARTIAL = 'partial'
+STATUS_COMPLETE = 'complete'
+
+
+class DownloadJournal:
+    """Thread-safe per-file download progress, keyed by MediaFiles.Id."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS Downloads (
+                Id TEXT NOT NULL PRIMARY KEY,
+                Url TEXT NOT NULL,
+                FileName TEXT NULL,
+                Status TEXT NOT NULL,
+                ETag TEXT NULL,
+                LastModified TEXT NULL,
+                ContentLength INTEGER NULL,
+                BytesDone INTEGER NOT NULL DEFAULT 0,
+                UpdatedAt TEXT NOT NULL,
+                Sha256 TEXT NULL
+            )
+        """)
+        # Journals written before content hashes were recorded
+        columns = [row['name'] for row in self._conn.execute('PRAGMA table_info(Downloads)')]
+        if 'Sha256' not in columns:
+            self._conn.execute('ALTER TABLE Downloads ADD COLUMN Sha256 TEXT NULL')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS IX_Downloads_Url ON Downloads (Url)')
+        self._conn.commit()
+
+    def get(self, file_id, url=None):
+        """Get the journal entry for a file, or None if there is none (for this URL, if one is given)."""
+        with self._lock:
+            row = self._conn.execute('SELECT * FROM Downloads WHERE Id = ?', (file_id,)).fetchone()
+        if row is None or (url is not None and row['Url'] != url):
+            return None
+        return dict(row)
+
+    def find_stored(self, url):
+        """Get a complete entry with a content hash for the URL, downloaded for any media file."""
+        with self._lock:
+            row = self._conn.execute("""
+                SELECT * FROM Downloads
+                WHERE Url = ? AND Status = ? AND Sha256 IS NOT NULL
+                LIMIT 1
+            """, (url, STATUS_COMPLETE)).fetchone()
+        return dict(row) if row else None
+
+    def record_partial(self, file_id, url, file_name, etag, last_modified, content_length, bytes_done):
+        """Record that a download was started or interrupted."""
+        self._upsert(file_id, url, file_name, STATUS_PARTIAL, etag, last_modified, content_length, bytes_done)
+
+    def record_complete(self, file_id, url, file_name, etag, last_modified, size, sha256=None):
+        """Record that a file has been fully downloaded."""
+        self._upsert(file_id, url, file_name, STATUS_COMPLETE, etag, last_modified, size, size, sha256)
+
+    def forget(self, file_id):
+        """Drop the entry of a file, e.g. after its partial download was discarded."""
+        with self._lock:
+            self._conn.execute('DELETE FROM Downloads WHERE Id = ?', (file_id,))
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _upsert(self, file_id, url, file_name, status, etag, last_modified, content_length, bytes_done,
+                sha256=None):
+        with self._lock:
+            self._conn.execute("""
+                INSERT INTO Downloads (Id, Url, FileName, Status, ETag, LastModified, ContentLength, BytesDone,
+                                       UpdatedAt, Sha256)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(Id) DO UPDATE SET
+                    Url = excluded.Url,
+                    FileName = excluded.FileName,
+                    Status = excluded.Status,
+                    ETag = excluded.ETag,
+                    LastModified = excluded.LastModified,
+                    ContentLength = excluded.ContentLength,
+                    BytesDone = excluded.BytesDone,
+                    UpdatedAt = excluded.UpdatedAt,
+                    Sha256 = excluded.Sha256
+            """, (file_id, url, file_name, status, etag, last_modified, content_length, bytes_done,
+                  datetime.now(timezone.utc).isoformat(), sha256))
+            self._conn.commit()
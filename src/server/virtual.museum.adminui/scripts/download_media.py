@@ -6,25 +6,66 @@ This script downloads media files from external URLs, saves them to the local me
 and updates the database records with the new local URLs.
 
 Usage:
-  python download_media.py [--dry-run] [--limit=<number>]
+  python download_media.py [--dry-run] [--limit=<number>] [--concurrency=<number>]
 
 Options:
-  --dry-run    Only log actions without making changes
-  --limit=N    Process only N files (for testing)
+  --dry-run          Only log actions without making changes (implies --verbose)
+  --limit=N          Process only N files (for testing)
+  --concurrency=N    Download N files in parallel (default: 1)
+  --per-host-limit=N Maximum parallel connections to a single host (default: 4)
+  --pool-size=N      Keep-alive connections kept open per host (default: concurrency)
+  --batch-size=N     URL updates committed in one transaction (default: 100)
+  --flush-interval=S Seconds after which pending URL updates are committed (default: 5)
+  --dedupe           Store identical files once and link the per-Id file names to them
+  --derivatives      Create thumbnails and 2K/4K/8K renditions of the downloaded images (needs Pillow)
+  --verbose          Log every file instead of showing a single progress bar
+  --metrics=FILE     Write the time per stage and the counters in the Prometheus text format
+  --trace=FILE       Append every timed stage of every file as a JSON line
+  --retries=N        Attempts after the first for 429/5xx responses, timeouts and dropped connections (default: 4)
+  --retry-rounds=N   Times the files that still failed are retried at the end of the run (default: 1)
+  --rate-limit=R     Maximum requests per second to a single host, lowered while it throttles (default: none)
+  --worker           Claim the files through leases, so several processes or machines can share the migration
+  --lease-ttl=S      Seconds a lease lasts without being renewed (default: 300)
+  --claim-size=N     Files claimed at once by a worker (default: 50)
+  --max-attempts=N   Times a worker tries a file before it is given up in this migration (default: 3)
+  --reset-leases     Remove all leases first, so the files given up earlier are tried again
+  --plan             Show the schedule of the downloads with the total size and duration, without downloading
+  --schedule         Get the sizes first and download the files in the order of the plan
+  --bandwidth=MB     Megabytes per second of all downloads together, for the estimate (default: from earlier runs)
 """
 
 import os
 import sys
 import argparse
+import hashlib
 import sqlite3
 import requests
+import threading
+import time
 import uuid
 import mimetypes
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import nullcontext
+from datetime import timedelta
 from pathlib import Path
 from urllib.parse import urlparse
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
 
+# Thumbnails, renditions and metrics come from the shared code of the tools in src/tools
+sys.path.append(str(Path(__file__).resolve().parents[3] / 'tools'))
+from shared.media_derivatives import generate_all_derivatives  # noqa: E402
+from shared.media_queries import (  # noqa: E402
+    count_external_media_files, ensure_external_url_index, iter_external_media_files)
+from shared.metrics import metrics  # noqa: E402
+from download_journal import DownloadJournal, STATUS_COMPLETE  # noqa: E402
+from media_store import ContentStore, hash_file  # noqa: E402
+from url_writer import MediaUrlWriter  # noqa: E402
+from fetch_policy import FetchPolicy, RetryableError, RETRYABLE_STATUS, THROTTLE_STATUS, parse_retry_after  # noqa: E402
+from lease_store import LeaseStore  # noqa: E402
+from media_planner import SizeCache, plan_downloads  # noqa: E402
+
 # Initialize mime types
 mimetypes.init()
 
@@ -38,13 +79,140 @@ load_dotenv(project_dir / '.env')
 MEDIA_UPLOAD_DIR = os.getenv('MEDIA_UPLOAD_DIR', r'E:\Media')
 DB_PATH = os.getenv('DB_PATH', r'E:\db\virtualmuseum.db')
 API_BASE_URL = '/api/media/file/'
+# MediaFiles.Type of the images that get derivatives
+MEDIA_TYPE_IMAGE_2D = 0
+MEDIA_TYPE_IMAGE_360 = 2
+# Rows read from the database per query; only a few batches are held in memory at a time
+QUERY_BATCH_SIZE = 500
+# Progress of the downloads, kept next to (not inside) the media directory
+DOWNLOAD_JOURNAL_PATH = os.getenv(
+    'DOWNLOAD_JOURNAL_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(MEDIA_UPLOAD_DIR)), 'media_download_journal.db'))
+# Sizes found by the planner and the throughput of earlier runs, next to the journal
+PLAN_CACHE_PATH = os.getenv(
+    'MEDIA_PLAN_CACHE_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(MEDIA_UPLOAD_DIR)), 'media_plan_cache.db'))
+# Files of the schedule listed by --plan without --verbose
+PLAN_LIST_LIMIT = 20
 
 def parse_args():
     """Parse command line arguments."""
     parser = argparse.ArgumentParser(description='Download media files and update database.')
-    parser.add_argument('--dry-run', action='store_true', help='Only log actions without making changes')
+    parser.add_argument('--dry-run', action='store_true', help='Only log actions without making changes (implies --verbose)')
     parser.add_argument('--limit', type=int, default=None, help='Process only N files (for testing)')
-    return parser.parse_args()
+    parser.add_argument('--concurrency', type=int, default=1, help='Download N files in parallel')
+    parser.add_argument('--per-host-limit', type=int, default=4, help='Maximum parallel connections to a single host')
+    parser.add_argument('--pool-size', type=int, default=None,
+                        help='Keep-alive connections kept open per host (default: concurrency)')
+    parser.add_argument('--batch-size', type=int, default=100,
+                        help='Number of URL updates committed in one transaction')
+    parser.add_argument('--flush-interval', type=float, default=5.0,
+                        help='Maximum number of seconds an URL update waits before it is committed')
+    parser.add_argument('--dedupe', action='store_true',
+                        help='Store identical files once and link the per-Id file names to them')
+    parser.add_argument('--derivatives', action='store_true',
+                        help='Create thumbnails and 2K/4K/8K renditions of the downloaded images (needs Pillow)')
+    parser.add_argument('--verbose', action='store_true',
+                        help='Log every file instead of showing a single progress bar')
+    parser.add_argument('--metrics', help='Write the time per stage and the counters to this Prometheus text file')
+    parser.add_argument('--trace', help='Append every timed stage of every file to this JSON lines file')
+    parser.add_argument('--retries', type=int, default=4,
+                        help='Attempts after the first for 429/5xx responses, timeouts and dropped connections')
+    parser.add_argument('--backoff-base', type=float, default=1.0,
+                        help='Seconds before the first retry, doubled for every further one (with jitter)')
+    parser.add_argument('--backoff-max', type=float, default=60.0, help='Longest wait between two attempts')
+    parser.add_argument('--retry-rounds', type=int, default=1,
+                        help='Times the files that still failed are retried at the end of the run')
+    parser.add_argument('--rate-limit', type=float, default=None,
+                        help='Maximum requests per second to a single host, lowered while it throttles '
+                             '(default: no limit until the host throttles)')
+    parser.add_argument('--connect-timeout', type=float, default=10.0, help='Seconds to wait for a connection')
+    parser.add_argument('--read-timeout', type=float, default=60.0,
+                        help='Seconds to wait for data from the server before the download is retried')
+    parser.add_argument('--worker', action='store_true',
+                        help='Claim the files through leases, so several processes or machines can share the migration')
+    parser.add_argument('--lease-ttl', type=float, default=300.0,
+                        help='Seconds a lease lasts without being renewed; a crashed worker\'s files wait this long')
+    parser.add_argument('--claim-size', type=int, default=50, help='Files claimed at once by a worker')
+    parser.add_argument('--max-attempts', type=int, default=3,
+                        help='Times the workers try a file before it is given up in this migration')
+    parser.add_argument('--retry-delay', type=float, default=30.0,
+                        help='Seconds before a file that failed with a transient error is claimed again')
+    parser.add_argument('--reset-leases', action='store_true',
+                        help='Remove all leases first, so the files given up earlier are tried again')
+    parser.add_argument('--plan', action='store_true',
+                        help='Show the schedule of the downloads with the total size and duration, without downloading')
+    parser.add_argument('--schedule', action='store_true',
+                        help='Get the sizes first and download the files in the order of the plan')
+    parser.add_argument('--bandwidth', type=float, default=None,
+                        help='Megabytes per second of all downloads together, for the estimate of the plan')
+    parser.add_argument('--head-concurrency', type=int, default=16,
+                        help='Parallel HEAD requests of the plan for the sizes that are not known yet')
+    parser.add_argument('--size-cache-age', type=float, default=7.0,
+                        help='Days for which the sizes found by a plan are reused')
+    args = parser.parse_args()
+    if args.pool_size is None:
+        args.pool_size = args.concurrency
+    if args.concurrency < 1:
+        parser.error('--concurrency must be at least 1')
+    if args.per_host_limit < 1:
+        parser.error('--per-host-limit must be at least 1')
+    if args.pool_size < 1:
+        parser.error('--pool-size must be at least 1')
+    if args.batch_size < 1:
+        parser.error('--batch-size must be at least 1')
+    if args.retries < 0 or args.retry_rounds < 0:
+        parser.error('--retries and --retry-rounds must not be negative')
+    if args.rate_limit is not None and args.rate_limit <= 0:
+        parser.error('--rate-limit must be positive')
+    if args.worker and (args.plan or args.schedule):
+        parser.error('--worker claims its files by Id and cannot follow a plan')
+    if args.worker and args.dry_run:
+        parser.error('--worker cannot be combined with --dry-run')
+    if args.bandwidth is not None and args.bandwidth <= 0:
+        parser.error('--bandwidth must be positive')
+    if args.head_concurrency < 1:
+        parser.error('--head-concurrency must be at least 1')
+    # A dry run reports what it would do with every file
+    if args.dry_run:
+        args.verbose = True
+    # A plan is a dry run that also gets the sizes
+    if args.plan:
+        args.dry_run = True
+    if args.lease_ttl <= 0 or args.claim_size < 1 or args.max_attempts < 1:
+        parser.error('--lease-ttl, --claim-size and --max-attempts must be positive')
+    return args
+
+# One semaphore per host so parallel workers do not overload a single CDN
+_host_semaphores = {}
+_host_semaphores_lock = threading.Lock()
+
+def get_host_semaphore(url, limit):
+    """Get the semaphore limiting parallel connections to the host of the URL."""
+    host = urlparse(url).netloc.lower()
+    with _host_semaphores_lock:
+        if host not in _host_semaphores:
+            _host_semaphores[host] = threading.BoundedSemaphore(limit)
+        return _host_semaphores[host]
+
+# One lock per URL so that a URL is only downloaded once when rows share it
+_url_locks = {}
+_url_locks_lock = threading.Lock()
+
+def get_url_lock(url):
+    """Get the lock serializing the downloads of a URL."""
+    with _url_locks_lock:
+        if url not in _url_locks:
+            _url_locks[url] = threading.Lock()
+        return _url_locks[url]
+
+# Per-file messages are only shown with --verbose, otherwise the progress bar shows the totals
+_verbose = True
+
+def log(message):
+    """Log a per-file message without breaking the progress bar."""
+    if _verbose:
+        tqdm.write(message)
 
 def ensure_directory_exists(directory):
     """Ensure the specified directory exists."""
@@ -81,59 +249,383 @@ def get_file_extension(url, content_type=None):
     
     return mime_to_ext.get(content_type, '')
 
-def download_file(url, file_path):
-    """Download a file from URL to the specified path."""
-    # Skip if file already exists
-    if os.path.exists(file_path):
-        print(f"File already exists: {file_path}")
-        return file_path
+def create_session(pool_size):
+    """Create an HTTP session that keeps connections alive and reuses them across downloads."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update({'Connection': 'keep-alive'})
+    return session
+
+def get_content_type(headers):
+    """Get the media type from response headers, without parameters like charset."""
+    content_type = headers.get('content-type')
+    if not content_type:
+        return None
+    return content_type.split(';')[0].strip().lower()
+
+def head_request(session, policy, url, **kwargs):
+    """Make a HEAD request within the rate limit of the host.
+    
+    HEAD requests are not retried, their callers fall back to the GET request.
+    """
+    limiter = policy.limiter(url) if policy else None
+    if limiter:
+        limiter.acquire()
+    with metrics.timer('head', url=url):
+        response = session.head(url, timeout=10, **kwargs)
+    if limiter and response.status_code in THROTTLE_STATUS:
+        limiter.on_throttle(parse_retry_after(response.headers.get('retry-after')))
+    return response
+
+def resolve_file_extension(session, url, policy=None):
+    """Get the file extension for a URL, asking the server only if the URL has none."""
+    file_extension = get_file_extension(url)
+    if file_extension:
+        return file_extension
+    
+    # Make a HEAD request to get content type
+    try:
+        head_response = head_request(session, policy, url)
+        content_type = get_content_type(head_response.headers)
+    except requests.exceptions.RequestException:
+        content_type = None
+    return get_file_extension(url, content_type)
+
+def parse_content_range(value):
+    """Parse a Content-Range header like 'bytes 100-199/1000' into (start, total)."""
+    if not value or not value.startswith('bytes '):
+        return None, None
+    byte_range, _, total = value[len('bytes '):].partition('/')
+    start = byte_range.split('-')[0]
+    if not start.isdigit():
+        return None, None
+    return int(start), int(total) if total.isdigit() else None
+
+def check_existing_file(session, journal, url, file_id, file_path, policy=None, response=None):
+    """Check whether an already downloaded file is complete.
+
+    The size on the server is taken from response, a GET that is already under way, or else
+    from a HEAD request.
+    """
+    size = os.path.getsize(file_path)
+    entry = journal.get(file_id, url)
+    if entry and entry['Status'] == STATUS_COMPLETE:
+        return entry['ContentLength'] is None or entry['ContentLength'] == size
+    
+    # The file is not in the journal (e.g. downloaded by an older run): compare with the size on the server
+    try:
+        head_response = response or head_request(session, policy, url, allow_redirects=True)
+        head_response.raise_for_status()
+    except requests.exceptions.RequestException:
+        # Without the size on the server the file cannot be trusted, the GET replaces it
+        return False
+    expected_size = int(head_response.headers.get('content-length', 0)) or None
+    etag = head_response.headers.get('etag')
+    last_modified = head_response.headers.get('last-modified')
+    if expected_size is None or expected_size == size:
+        journal.record_complete(file_id, url, os.path.basename(file_path), etag, last_modified, size)
+        return True
+    
+    # Remember the validators so the truncated file can be resumed
+    journal.record_partial(file_id, url, os.path.basename(file_path), etag, last_modified, expected_size, size)
+    return False
+
+def finish_download(journal, store, file_id, url, part_path, file_path, etag, last_modified, size, digest):
+    """Move a complete .part file into place and record it in the journal."""
+    sha256 = digest.hexdigest()
+    with metrics.timer('store', file_id=file_id):
+        if store:
+            store.add(part_path, sha256, file_path)
+        else:
+            os.replace(part_path, file_path)
+    journal.record_complete(file_id, url, os.path.basename(file_path), etag, last_modified, size, sha256)
+
+def download_file(session, journal, url, file_id, store=None, policy=None, timeout=(10, 60)):
+    """Download a file from URL into the media directory and return its new file name.
     
-    # Create parent directories if they don't exist
-    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    The data is written to a .part file that is renamed once it is complete. An existing .part file
+    is resumed with a Range request if the journal holds a validator (ETag or Last-Modified) for it.
+    With a content store, files are kept once per content and URLs that are already stored are not
+    downloaded again. Failures that may be transient raise RetryableError; the partial file is kept,
+    so a retry continues where this attempt stopped.
+    """
+    entry = journal.get(file_id, url)
     
-    # Download with progress
-    print(f"Downloading {url} to {file_path}...")
+    # The target is known before touching the network if the journal or the URL has the extension
+    file_name = entry['FileName'] if entry else None
+    if not file_name:
+        file_extension = get_file_extension(url)
+        if file_extension:
+            file_name = f"{file_id}{file_extension}"
+    
+    if file_name:
+        file_path = os.path.join(MEDIA_UPLOAD_DIR, file_name)
+        # Skip if file already exists and is complete
+        if os.path.exists(file_path):
+            if check_existing_file(session, journal, url, file_id, file_path, policy):
+                log(f"File already exists: {file_path}")
+                metrics.count('files_skipped')
+                return file_name
+            log(f"File is incomplete, resuming: {file_path}")
+            os.replace(file_path, file_path + '.part')
+            entry = journal.get(file_id, url)
     
+    # Reuse the blob if the same URL was already downloaded for another media file
+    if store:
+        stored = journal.find_stored(url)
+        if stored and store.has_blob(stored['Sha256']):
+            file_name = f"{file_id}{os.path.splitext(stored['FileName'])[1]}"
+            file_path = os.path.join(MEDIA_UPLOAD_DIR, file_name)
+            store.link_existing(stored['Sha256'], file_path)
+            journal.record_complete(file_id, url, file_name, stored['ETag'], stored['LastModified'],
+                                    stored['ContentLength'], stored['Sha256'])
+            log(f"Already stored, linked {file_path}")
+            metrics.count('files_linked')
+            return file_name
+    
+    # Ask only for the missing bytes, and for the whole file again if it changed on the server
+    headers = {'Accept-Encoding': 'identity'}
+    offset = 0
+    part_path = os.path.join(MEDIA_UPLOAD_DIR, file_name + '.part') if file_name else None
+    if part_path and entry and os.path.exists(part_path):
+        validator = entry['ETag'] or entry['LastModified']
+        if validator:
+            offset = os.path.getsize(part_path)
+        if offset:
+            headers['Range'] = f"bytes={offset}-"
+            headers['If-Range'] = validator
+    
+    # Validators of the partial file, replaced by those of the response once it arrives
+    etag = entry['ETag'] if entry else None
+    last_modified = entry['LastModified'] if entry else None
+    total_size = entry['ContentLength'] if entry else None
     try:
         # Stream the download
-        with requests.get(url, stream=True, timeout=30) as response:
+        started = time.perf_counter()
+        with session.get(url, stream=True, timeout=timeout, headers=headers) as response:
+            # Time to the response headers, the body is timed while it is read
+            metrics.record('get', time.perf_counter() - started, file_id=file_id, status=response.status_code)
+            if response.status_code in RETRYABLE_STATUS:
+                raise RetryableError(f"Server answered {response.status_code} for {url}", response.status_code,
+                                     parse_retry_after(response.headers.get('retry-after')))
+            if response.status_code == 416 and offset:
+                # Nothing left to fetch: the partial file is either complete or unusable
+                if total_size == offset:
+                    finish_download(journal, store, file_id, url, part_path,
+                                    os.path.join(MEDIA_UPLOAD_DIR, file_name), etag, last_modified, offset,
+                                    hash_file(part_path))
+                    return file_name
+                os.unlink(part_path)
+                journal.forget(file_id)
+                raise Exception(f"Discarded unusable partial download of {url}")
             response.raise_for_status()
             
-            # Get content length if available
-            total_size = int(response.headers.get('content-length', 0))
+            # Otherwise take the extension from the content type of the response
+            if not file_name:
+                file_extension = get_file_extension(url, get_content_type(response.headers))
+                if not file_extension:
+                    raise Exception(f"Could not determine file extension for {url}")
+                file_name = f"{file_id}{file_extension}"
+                file_path = os.path.join(MEDIA_UPLOAD_DIR, file_name)
+                if os.path.exists(file_path):
+                    if check_existing_file(session, journal, url, file_id, file_path, policy, response):
+                        log(f"File already exists: {file_path}")
+                        metrics.count('files_skipped')
+                        return file_name
+                    # The response has the whole file, it replaces the truncated one
+                    log(f"File is incomplete, downloading it again: {file_path}")
+            
+            file_path = os.path.join(MEDIA_UPLOAD_DIR, file_name)
+            part_path = file_path + '.part'
             
-            # Get content type for extension detection if needed
-            content_type = response.headers.get('content-type')
+            # Create parent directories if they don't exist
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
             
-            # Create progress bar
-            progress_bar = tqdm(total=total_size, unit='B', unit_scale=True, desc=os.path.basename(file_path))
+            if response.status_code == 206:
+                start, total_size = parse_content_range(response.headers.get('content-range'))
+                if start != offset:
+                    raise Exception(f"Server returned an unexpected range for {url}")
+                etag = response.headers.get('etag') or etag
+                last_modified = response.headers.get('last-modified') or last_modified
+                mode = 'ab'
+                # The hash covers the whole file, so feed it the bytes we already have
+                digest = hash_file(part_path)
+                log(f"Resuming {url} at {offset} bytes to {file_path}...")
+            else:
+                # The server ignored the range or the file has changed, start over
+                offset = 0
+                etag = response.headers.get('etag')
+                last_modified = response.headers.get('last-modified')
+                total_size = int(response.headers.get('content-length', 0)) or None
+                mode = 'wb'
+                digest = hashlib.sha256()
+                log(f"Downloading {url} to {file_path}...")
             
-            # Write to file
-            with open(file_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
-                        progress_bar.update(len(chunk))
+            journal.record_partial(file_id, url, file_name, etag, last_modified, total_size, offset)
             
-            progress_bar.close()
+            # Write to file, hashing while streaming. Reading, writing and hashing are timed
+            # separately to tell a slow network from a slow disk.
+            bytes_done = offset
+            transfer_time = write_time = hash_time = 0.0
+            chunks = response.iter_content(chunk_size=65536)
+            try:
+                with open(part_path, mode) as f:
+                    while True:
+                        read_started = time.perf_counter()
+                        chunk = next(chunks, None)
+                        write_started = time.perf_counter()
+                        transfer_time += write_started - read_started
+                        if chunk is None:
+                            break
+                        if chunk:
+                            f.write(chunk)
+                            hash_started = time.perf_counter()
+                            write_time += hash_started - write_started
+                            digest.update(chunk)
+                            hash_time += time.perf_counter() - hash_started
+                            bytes_done += len(chunk)
+            finally:
+                metrics.record('transfer', transfer_time, file_id=file_id, bytes=bytes_done - offset)
+                metrics.record('disk_write', write_time, file_id=file_id)
+                metrics.record('hash', hash_time, file_id=file_id)
+                metrics.count('bytes_downloaded', bytes_done - offset)
+
+            if total_size is not None and bytes_done != total_size:
+                journal.record_partial(file_id, url, file_name, etag, last_modified, total_size, bytes_done)
+                raise RetryableError(f"Incomplete download of {url}: got {bytes_done} of {total_size} bytes")
             
-            return file_path
+            finish_download(journal, store, file_id, url, part_path, file_path, etag, last_modified,
+                            bytes_done, digest)
+            metrics.count('files_downloaded')
+            return file_name
     except requests.exceptions.RequestException as e:
-        # Clean up partial file if download failed
-        if os.path.exists(file_path):
-            os.unlink(file_path)
+        # Keep the partial file so that the next run can resume it
+        if part_path and os.path.exists(part_path):
+            journal.record_partial(file_id, url, file_name, etag, last_modified, total_size,
+                                   os.path.getsize(part_path))
+        if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                          requests.exceptions.ChunkedEncodingError)):
+            raise RetryableError(f"Failed to download {url}: {str(e)}") from e
         raise Exception(f"Failed to download {url}: {str(e)}")
 
+def fetch_media_file(session, journal, store, policy, media_file, args, position, total):
+    """Download a single media file and return its new local URL, or None if it was skipped."""
+    log(f"\nProcessing file {position}/{total}: {media_file['Name']} (ID: {media_file['Id']})")
+
+    # Skip empty URLs
+    if not media_file['Url']:
+        log('URL is empty, skipping')
+        return None
+
+    # Skip if URL is already local
+    if media_file['Url'].startswith(API_BASE_URL):
+        log('URL is already local, skipping')
+        return None
+
+    # Log the current URL
+    log(f"Current URL: {media_file['Url']}")
+
+    # With a content store, rows sharing a URL wait for each other and then reuse the stored file
+    url_lock = get_url_lock(media_file['Url']) if store else nullcontext()
+    host_semaphore = get_host_semaphore(media_file['Url'], args.per_host_limit)
+    with url_lock:
+        if not args.dry_run:
+            # The extension is taken from the GET response, so no separate HEAD request is needed
+            timeout = (args.connect_timeout, args.read_timeout)
+
+            def attempt():
+                # The host slot is only held while a request runs, not during the backoff before a
+                # retry, so a throttled host does not keep the other downloads of that host waiting
+                with host_semaphore:
+                    return download_file(session, journal, media_file['Url'], media_file['Id'], store, policy,
+                                         timeout)
+
+            new_filename = policy.call(media_file['Url'], attempt)
+        else:
+            with host_semaphore:
+                file_extension = resolve_file_extension(session, media_file['Url'], policy)
+            if not file_extension:
+                raise Exception(f"Could not determine file extension for {media_file['Url']}")
+            new_filename = f"{media_file['Id']}{file_extension}"
+            file_path = os.path.join(MEDIA_UPLOAD_DIR, new_filename)
+            log(f"[DRY RUN] Would download {media_file['Url']} to {file_path}")
+
+    # Generate new URL
+    new_url = f"{API_BASE_URL}{new_filename}"
+    log(f"New URL: {new_url}")
+    return new_url
+
+def create_plan(media_files, session, policy, journal, cache, args):
+    """Get the sizes of the media files and schedule them for the parallel downloads."""
+    # A dry run has no journal of its own, but the sizes of an earlier run are still in it
+    size_journal = journal
+    if size_journal is None and os.path.exists(DOWNLOAD_JOURNAL_PATH):
+        size_journal = DownloadJournal(DOWNLOAD_JOURNAL_PATH)
+    try:
+        with metrics.timer('plan'):
+            return plan_downloads(
+                list(media_files), args.concurrency,
+                lambda url: head_request(session, policy, url, allow_redirects=True),
+                size_journal, cache, args.head_concurrency)
+    finally:
+        if size_journal is not journal:
+            size_journal.close()
+
+def print_plan(plan, cache, args, schedule=True):
+    """Print the totals and the estimated duration of a plan, and with schedule its first files."""
+    print(f"Plan: {len(plan.files)} files, {tqdm.format_sizeof(plan.total_bytes, 'B', 1024)} "
+          f"on {plan.concurrency} parallel downloads")
+    if plan.estimated_count:
+        print(f"  {plan.estimated_count} sizes are unknown and estimated by type "
+              f"({tqdm.format_sizeof(plan.estimated_bytes, 'B', 1024)})")
+    if plan.unavailable_count:
+        print(f"  {plan.unavailable_count} files are not found on the server and will fail")
+    if args.bandwidth:
+        rate, source = args.bandwidth * 1024 * 1024 / args.concurrency, '--bandwidth'
+    else:
+        rate, source = (cache.bytes_per_second_per_download() if cache else None), 'earlier runs'
+    if rate:
+        seconds = plan.estimate_seconds(rate, args.rate_limit)
+        print(f"  Estimated duration: {timedelta(seconds=round(seconds))} at "
+              f"{tqdm.format_sizeof(rate, 'B/s', 1024)} per download ({source})")
+    else:
+        print("  Estimated duration: unknown until a run has finished, or pass --bandwidth")
+    if not schedule:
+        return
+
+    shown = plan.files if args.verbose else plan.files[:PLAN_LIST_LIMIT]
+    print(f"\n{'#':>6} {'Download':>8} {'Starts after':>12} {'Size':>10}  Type  ID / URL")
+    for position, planned in enumerate(shown, 1):
+        size = 'missing' if planned.unavailable else (
+            tqdm.format_sizeof(planned.size, 'B', 1024) + ('?' if planned.estimated else ''))
+        print(f"{position:>6} {planned.lane + 1:>8} {tqdm.format_sizeof(planned.start, 'B', 1024):>12} {size:>10}  "
+              f"{planned.media_file['Type']:>4}  {planned.media_file['Id']} {planned.media_file['Url']}")
+    if len(shown) < len(plan.files):
+        print(f"  ... and {len(plan.files) - len(shown)} more (--verbose lists all)")
+
 def main():
     """Main function."""
+    global _verbose
     args = parse_args()
-    
+    _verbose = args.verbose
+    if args.trace:
+        metrics.start_trace(args.trace)
+
     print("Starting media file migration...")
     print(f"Database: {DB_PATH}")
     print(f"Media directory: {MEDIA_UPLOAD_DIR}")
+    if not args.dry_run:
+        print(f"Download journal: {DOWNLOAD_JOURNAL_PATH}")
     print(f"Dry run: {args.dry_run}")
     if args.limit:
         print(f"Limit: {args.limit} files")
+    print(f"Concurrency: {args.concurrency} (max {args.per_host_limit} per host)")
+    if args.worker:
+        print(f"Worker mode: leases of {args.lease_ttl:g}s, {args.claim_size} files per claim")
+    if args.dedupe:
+        print("Deduplication: enabled")
     
     # Ensure media directory exists
     ensure_directory_exists(MEDIA_UPLOAD_DIR)
@@ -141,94 +633,219 @@ def main():
     # Connect to the database
     conn = sqlite3.connect(DB_PATH)
     conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
+    
+    # All workers share one connection pool
+    session = create_session(args.pool_size)
+    
+    # Retries with backoff and an adaptive rate limit per host
+    policy = FetchPolicy(args.retries, args.backoff_base, args.backoff_max, args.rate_limit)
+    
+    # Progress of earlier runs, used to resume and skip downloads
+    journal = DownloadJournal(DOWNLOAD_JOURNAL_PATH) if not args.dry_run else None
+    
+    # Sizes for the plan and the throughput of the runs, for the next estimate
+    cache = SizeCache(PLAN_CACHE_PATH, args.size_cache_age) if args.plan or not args.dry_run else None
+    
+    # Optional content-addressed layout that stores identical files once
+    store = ContentStore(MEDIA_UPLOAD_DIR) if args.dedupe and not args.dry_run else None
+    
+    # In worker mode the files are claimed through leases shared with the other workers
+    leases = None
+    if args.worker:
+        leases = LeaseStore(DB_PATH, args.lease_ttl, args.max_attempts, args.retry_delay)
+        if args.reset_leases:
+            leases.reset()
+        leases.start()
+        print(f"Worker: {leases.worker}")
+    
+    # URL updates are committed in batches by a single writer thread
+    writer = None
+    if not args.dry_run:
+        writer = MediaUrlWriter(DB_PATH, batch_size=args.batch_size, flush_interval=args.flush_interval,
+                                leases=leases)
+        writer.start()
     
     try:
-        # Get all media files with external URLs
-        limit_clause = f"LIMIT {args.limit}" if args.limit else ""
-        cursor.execute(f"""
-            SELECT Id, FileName, Name, Description, DurationInSeconds, Type, Url
-            FROM MediaFiles
-            WHERE Url NOT LIKE '{API_BASE_URL}%'
-            {limit_clause}
-        """)
+        # The media files with external URLs are selected through a partial index, so finding
+        # the remaining work does not scan the whole table. A dry run leaves the schema alone.
+        if not args.dry_run and ensure_external_url_index(conn):
+            print("Created the index of the media files with external URLs")
+        total = count_external_media_files(conn)
+        if args.limit:
+            total = min(total, args.limit)
+        print(f"Found {total} media files with external URLs")
         
-        media_files = cursor.fetchall()
-        print(f"Found {len(media_files)} media files with external URLs")
+        # The rows are streamed in batches instead of being read all at once. A worker only gets
+        # the rows it claimed, the total is shared with the other workers.
+        if leases:
+            media_files = leases.iter_claimed(args.claim_size, args.limit)
+        else:
+            media_files = iter_external_media_files(conn, QUERY_BATCH_SIZE, args.limit)
+        
+        # With a plan the sizes are known before the first download. The files are downloaded in
+        # the order of the schedule and the progress is counted in bytes, so its ETA holds.
+        planned_sizes = None
+        if args.plan or args.schedule:
+            plan = create_plan(media_files, session, policy, journal, cache, args)
+            print_plan(plan, cache, args, schedule=args.plan)
+            if args.plan:
+                return
+            media_files = [planned.media_file for planned in plan.files]
+            planned_sizes = {planned.media_file['Id']: planned.size for planned in plan.files}
         
         # Process each media file
         success_count = 0
         error_count = 0
+        # (path, is 360 degree) of the downloaded images, for the derivatives
+        images = []
         
-        for i, media_file in enumerate(media_files):
-            print(f"\nProcessing file {i + 1}/{len(media_files)}: {media_file['Name']} (ID: {media_file['Id']})")
-            
-            try:
-                # Skip if URL is already local
-                if media_file['Url'].startswith(API_BASE_URL):
-                    print('URL is already local, skipping')
-                    continue
-                
-                # Skip empty URLs
-                if not media_file['Url']:
-                    print('URL is empty, skipping')
-                    continue
-                
-                # Log the current URL
-                print(f"Current URL: {media_file['Url']}")
-                
-                # Make a HEAD request to get content type
-                try:
-                    head_response = requests.head(media_file['Url'], timeout=10)
-                    content_type = head_response.headers.get('content-type')
-                except:
-                    content_type = None
+        # One bar for the whole run; with --verbose every file is logged instead
+        if planned_sizes:
+            progress_bar = tqdm(total=sum(planned_sizes.values()), unit='B', unit_scale=True, unit_divisor=1024,
+                                disable=args.verbose)
+        else:
+            progress_bar = tqdm(total=total, unit='file', disable=args.verbose)
+        
+        def advance(media_file):
+            progress_bar.update(planned_sizes[media_file['Id']] if planned_sizes else 1)
+        
+        # Downloads run on the worker threads, the database is only written by the writer thread.
+        # Only a few files per worker are submitted ahead, so the rows are read from the database
+        # as the downloads progress. Files that still fail with a transient error are queued and
+        # retried once the others are done, when the CDN has had time to recover.
+        max_in_flight = args.concurrency * 4
+        pending = media_files
+        retry_round = 0
+        claimed_count = 0
+        started = time.perf_counter()
+        with progress_bar, ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            while True:
+                retry_queue = []
+                in_flight = {}
+                rows = iter(pending)
+                position = 0
+                exhausted = False
+                while in_flight or not exhausted:
+                    while not exhausted and len(in_flight) < max_in_flight:
+                        media_file = next(rows, None)
+                        if media_file is None:
+                            exhausted = True
+                            break
+                        position += 1
+                        future = executor.submit(fetch_media_file, session, journal, store, policy, media_file,
+                                                 args, position, total)
+                        in_flight[future] = media_file
+                    if not in_flight:
+                        break
+                    
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        media_file = in_flight.pop(future)
+                        try:
+                            new_url = future.result()
+                            advance(media_file)
+                            if new_url is None:
+                                # Nothing to migrate, no other worker needs to try it either
+                                if leases:
+                                    leases.skip(media_file['Id'])
+                                continue
+                            
+                            # Queue the database update
+                            if not args.dry_run:
+                                writer.submit(media_file['Id'], new_url)
+                                if media_file['Type'] in (MEDIA_TYPE_IMAGE_2D, MEDIA_TYPE_IMAGE_360):
+                                    file_path = os.path.join(MEDIA_UPLOAD_DIR, new_url[len(API_BASE_URL):])
+                                    images.append((file_path, media_file['Type'] == MEDIA_TYPE_IMAGE_360))
+                            else:
+                                log(f"[DRY RUN] Would update database for ID {media_file['Id']}")
+                            
+                            success_count += 1
+                        except RetryableError as e:
+                            if leases:
+                                # Claimed again after --retry-delay, by this or another worker
+                                log(f"Released file {media_file['Id']} for a retry: {str(e)}")
+                                leases.release(media_file['Id'], str(e))
+                                advance(media_file)
+                                metrics.count('released')
+                                continue
+                            if retry_round < args.retry_rounds:
+                                log(f"Queued file {media_file['Id']} for a retry: {str(e)}")
+                                retry_queue.append(media_file)
+                                continue
+                            advance(media_file)
+                            tqdm.write(f"Error processing file {media_file['Id']}: {str(e)}")
+                            metrics.count('errors')
+                            error_count += 1
+                        except Exception as e:
+                            if leases:
+                                leases.release(media_file['Id'], str(e), permanent=True)
+                            advance(media_file)
+                            tqdm.write(f"Error processing file {media_file['Id']}: {str(e)}")
+                            metrics.count('errors')
+                            error_count += 1
+                        finally:
+                            progress_bar.set_postfix(
+                                downloaded=tqdm.format_sizeof(metrics.get('bytes_downloaded'), 'B', 1024),
+                                errors=error_count, retrying=len(retry_queue), refresh=False)
                 
-                # Determine file extension
-                file_extension = get_file_extension(media_file['Url'], content_type)
-                if not file_extension:
-                    print(f"Could not determine file extension for {media_file['Url']}, skipping")
-                    error_count += 1
+                if leases:
+                    # The files left are leased by other workers or cool down after a failure.
+                    # Waiting for them only here, with nothing in flight, lets the workers finish
+                    # (and end the leases of) the files they hold while the others wait.
+                    claimed_count += position
+                    remaining = args.limit - claimed_count if args.limit else None
+                    if remaining == 0 or not leases.wait_for_claimable():
+                        break
+                    pending = leases.iter_claimed(args.claim_size, remaining)
                     continue
-                
-                # Generate new filename using the ID
-                new_filename = f"{media_file['Id']}{file_extension}"
-                file_path = os.path.join(MEDIA_UPLOAD_DIR, new_filename)
-                
-                # Download the file
-                if not args.dry_run:
-                    download_file(media_file['Url'], file_path)
-                else:
-                    print(f"[DRY RUN] Would download {media_file['Url']} to {file_path}")
-                
-                # Generate new URL
-                new_url = f"{API_BASE_URL}{new_filename}"
-                print(f"New URL: {new_url}")
-                
-                # Update the database
-                if not args.dry_run:
-                    cursor.execute("""
-                        UPDATE MediaFiles
-                        SET Url = ?
-                        WHERE Id = ?
-                    """, (new_url, media_file['Id']))
-                    conn.commit()
-                    print('Database updated')
-                else:
-                    print(f"[DRY RUN] Would update database for ID {media_file['Id']}")
-                
-                success_count += 1
-            except Exception as e:
-                print(f"Error processing file {media_file['Id']}: {str(e)}")
-                error_count += 1
+                if not retry_queue:
+                    break
+                retry_round += 1
+                tqdm.write(f"Retrying {len(retry_queue)} files (round {retry_round} of {args.retry_rounds})")
+                pending = retry_queue
+                total = len(retry_queue)
         
+        # Write the remaining updates
+        if writer:
+            writer.close()
+            writer = None
+        if cache and not args.dry_run:
+            cache.record_run(int(metrics.get('bytes_downloaded')), int(metrics.get('files_downloaded')),
+                             time.perf_counter() - started, args.concurrency)
+        
+        # Scaling is CPU bound and runs in its own process pool once all downloads are done
+        if args.derivatives and images:
+            with metrics.timer('derivatives'):
+                generate_all_derivatives(images)
+
         print('\nMigration completed!')
         print(f"Successfully processed: {success_count} files")
         print(f"Errors: {error_count} files")
-        
+        if leases:
+            print(f"Released for a retry: {int(metrics.get('released'))} files")
+            print(f"Given up by all workers: {leases.failed_count()} files (retry them with --reset-leases)")
+        if store:
+            print(f"Deduplicated: {store.files_deduplicated} files, "
+                  f"{tqdm.format_sizeof(store.bytes_saved, 'B', 1024)} saved")
+        # Where the time went: network (get, transfer), disk (disk_write, store) or SQLite (db_update)
+        print(metrics.summary())
+        if args.metrics:
+            metrics.write_prometheus(args.metrics)
+
     finally:
-        # Close the database connection
+        # Close the database connections and the HTTP connections
+        if writer:
+            writer.close()
+        # Only after the writer, whose updates end the leases of the migrated files
+        if leases:
+            leases.close()
+        session.close()
+        if journal:
+            journal.close()
+        if cache:
+            cache.close()
         conn.close()
+        metrics.close()
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,165 @@
+"""
+Fetch Policy
+
+Retries, backoff and per-host rate limits for the requests to the CDN. Transient failures (429, 5xx,
+timeouts, dropped connections) are retried with exponential backoff and jitter, honouring Retry-After.
+Every host gets a token bucket whose rate is lowered when the host throttles us and raised again while
+requests succeed, so the migration settles at the highest rate the CDN sustains. Without a maximum rate a
+host is not limited at all until it throttles for the first time.
+"""
+
+import collections
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+from shared.metrics import metrics
+
+# Responses that are worth another attempt
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+# Responses that mean we are too fast for the host
+THROTTLE_STATUS = {429, 503}
+
+
+class RetryableError(Exception):
+    """A failure that may go away if the request is repeated later."""
+
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value):
+    """Parse a Retry-After header (seconds or an HTTP date) into seconds from now."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, base, cap, retry_after=None):
+    """Exponential backoff with full jitter, but never shorter than the server asked for."""
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, cap))
+    return delay
+
+
+class HostRateLimiter:
+    """Token bucket for one host with an additive-increase, multiplicative-decrease rate.
+
+    With max_rate None the host is not limited until it throttles. The rate then starts at the
+    decreased rate of the requests of the last second and grows without a ceiling.
+    """
+
+    def __init__(self, max_rate=None, min_rate=0.5, increase=0.5, decrease=0.5):
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate) if max_rate else min_rate
+        self.increase = increase
+        self.decrease = decrease
+        # None while the host is not limited
+        self.rate = max_rate
+        self._tokens = 1.0
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        # Times of the requests of the last second while the host is not limited
+        self._recent = collections.deque()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until the host may be sent another request."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if self.rate is None:
+                    if now >= self._paused_until:
+                        self._recent.append(now)
+                        while self._recent[0] < now - 1.0:
+                            self._recent.popleft()
+                        return
+                    wait = self._paused_until - now
+                else:
+                    # The bucket holds at most one second worth of requests
+                    self._tokens = min(max(1.0, self.rate), self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if now >= self._paused_until and self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = max(self._paused_until - now, (1 - self._tokens) / self.rate)
+            time.sleep(wait)
+
+    def on_success(self):
+        with self._lock:
+            if self.rate is not None:
+                self.rate = self.rate + self.increase
+                if self.max_rate:
+                    self.rate = min(self.max_rate, self.rate)
+
+    def on_throttle(self, retry_after=None):
+        """Slow down, and pause the host completely if it told us how long to wait."""
+        with self._lock:
+            if self.rate is None:
+                # Start from the rate the host was sent requests at until now
+                self.rate = float(max(1, len(self._recent)))
+                self._recent.clear()
+                self._updated = time.monotonic()
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self._tokens = min(self._tokens, 0.0)
+            if retry_after:
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+
+
+class FetchPolicy:
+    """Runs requests through the rate limiter of their host and retries transient failures."""
+
+    def __init__(self, retries=4, backoff_base=1.0, backoff_max=60.0, max_rate=None, min_rate=0.5):
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self._limiters = {}
+        self._limiters_lock = threading.Lock()
+
+    def limiter(self, url):
+        """Get the rate limiter of the host of the URL."""
+        host = urlparse(url).netloc.lower()
+        with self._limiters_lock:
+            if host not in self._limiters:
+                self._limiters[host] = HostRateLimiter(self.max_rate, self.min_rate)
+            return self._limiters[host]
+
+    def call(self, url, request):
+        """Call request() until it succeeds, fails permanently or the retries are used up.
+
+        request raises RetryableError for transient failures; any other exception is not retried.
+        """
+        limiter = self.limiter(url)
+        attempt = 0
+        while True:
+            limiter.acquire()
+            try:
+                result = request()
+            except RetryableError as e:
+                if e.status is None or e.status in THROTTLE_STATUS:
+                    # Timeouts and dropped connections count as throttling as well
+                    limiter.on_throttle(e.retry_after)
+                    metrics.count('throttled')
+                if attempt >= self.retries:
+                    raise
+                delay = backoff_delay(attempt, self.backoff_base, self.backoff_max, e.retry_after)
+                metrics.count('retries')
+                with metrics.timer('backoff', url=url, attempt=attempt + 1, status=e.status):
+                    time.sleep(delay)
+                attempt += 1
+                continue
+            limiter.on_success()
+            return result
@@ -0,0 +1,48 @@
+"""
+Hash Cache
+
+Remembers the SHA-256 of the files in the media directory together with their size and
+modification time, so check_media.py only hashes files that changed since the last check.
+"""
+
+import sqlite3
+
+
+class HashCache:
+    """SHA-256 per file name, valid as long as the size and modification time of the file are the same."""
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS Hashes (
+                FileName TEXT NOT NULL PRIMARY KEY,
+                Size INTEGER NOT NULL,
+                MTime INTEGER NOT NULL,
+                Sha256 TEXT NOT NULL
+            )
+        """)
+        self._conn.commit()
+
+    def get(self, file_name, size, mtime_ns):
+        """Get the cached hash of a file, or None if there is none or the file changed since."""
+        row = self._conn.execute(
+            'SELECT Sha256 FROM Hashes WHERE FileName = ? AND Size = ? AND MTime = ?',
+            (file_name, size, mtime_ns)).fetchone()
+        return row[0] if row else None
+
+    def put_many(self, entries):
+        """Store (file name, size, mtime, sha256) tuples in one transaction."""
+        with self._conn:
+            self._conn.executemany("""
+                INSERT INTO Hashes (FileName, Size, MTime, Sha256) VALUES (?, ?, ?, ?)
+                ON CONFLICT(FileName) DO UPDATE SET
+                    Size = excluded.Size,
+                    MTime = excluded.MTime,
+                    Sha256 = excluded.Sha256
+            """, entries)
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,247 @@
+"""
+Media File Leases
+
+Lets several download_media.py processes, on one machine or on several machines sharing the
+database, split a migration between them. A worker claims a batch of media files by writing a
+lease with an expiry for each of them into the MediaFileLeases table of virtualmuseum.db, and
+renews its leases while it works on them. The lease of a migrated file is removed in the same
+transaction that writes its local URL. Leases of a worker that crashed expire and their files are
+claimed by another worker.
+"""
+
+import os
+import random
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+from shared.media_queries import EXTERNAL_URL_CONDITION, MEDIA_FILE_COLUMNS
+from shared.metrics import metrics
+
+LEASES_TABLE = 'MediaFileLeases'
+STATUS_LEASED = 'leased'
+STATUS_FAILED = 'failed'
+STATUS_SKIPPED = 'skipped'
+
+
+def worker_name():
+    """A name that is unique across the machines sharing the database."""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class LeaseStore:
+    """Claims, renews and releases the leases of one worker.
+
+    Usage:
+        leases = LeaseStore(db_path, ttl=300)
+        leases.start()
+        while True:
+            for media_file in leases.iter_claimed(batch_size=50):
+                ...
+                leases.release(media_file['Id'], str(error))
+            if not leases.wait_for_claimable():
+                break
+        leases.close()
+
+    A media file can be claimed if it still has an external URL and has no lease, an expired
+    one, or a failed one whose cool-down has passed and that has not failed max_attempts times.
+    Every worker starts reading the table at a random Id, so the workers claim different parts
+    of it instead of competing for the same rows.
+    """
+
+    def __init__(self, db_path, ttl=300.0, max_attempts=3, retry_delay=30.0, worker=None):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.worker = worker or worker_name()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat = None
+        self._conn = self._connect()
+        self._conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS "{LEASES_TABLE}" (
+                "MediaFileId" TEXT NOT NULL PRIMARY KEY,
+                "Worker" TEXT NULL,
+                "Status" TEXT NOT NULL,
+                "ExpiresAt" REAL NOT NULL,
+                "Attempts" INTEGER NOT NULL DEFAULT 0,
+                "Error" TEXT NULL
+            )
+        """)
+        self._conn.execute(
+            f'CREATE INDEX IF NOT EXISTS "IX_{LEASES_TABLE}_Worker" ON "{LEASES_TABLE}" ("Worker")')
+
+    def _connect(self):
+        # Autocommit, every claim takes the write lock with BEGIN IMMEDIATE
+        conn = sqlite3.connect(self.db_path, timeout=60, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def start(self):
+        """Renew the leases of this worker in the background until close() is called."""
+        self._heartbeat = threading.Thread(target=self._renew_loop, name='LeaseHeartbeat', daemon=True)
+        self._heartbeat.start()
+
+    def _renew_loop(self):
+        conn = self._connect()
+        try:
+            while not self._stop.wait(self.ttl / 3):
+                try:
+                    with metrics.timer('lease_renew'):
+                        conn.execute(f"""
+                            UPDATE "{LEASES_TABLE}" SET "ExpiresAt" = ?
+                            WHERE "Worker" = ? AND "Status" = ?
+                        """, (time.time() + self.ttl, self.worker, STATUS_LEASED))
+                except sqlite3.Error as e:
+                    # The next heartbeat tries again, the leases last for three of them
+                    print(f"Could not renew the leases: {str(e)}")
+        finally:
+            conn.close()
+
+    def claim(self, after_id, batch_size):
+        """Lease up to batch_size claimable media files with an Id greater than after_id."""
+        now = time.time()
+        with self._lock, metrics.timer('lease_claim'):
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self._conn.execute(f"""
+                    SELECT {MEDIA_FILE_COLUMNS} FROM "MediaFiles"
+                    WHERE {EXTERNAL_URL_CONDITION} AND "Id" > ? AND NOT EXISTS (
+                        SELECT 1 FROM "{LEASES_TABLE}" l
+                        WHERE l."MediaFileId" = "MediaFiles"."Id"
+                          AND (l."ExpiresAt" > ? OR l."Status" = ? OR (l."Status" = ? AND l."Attempts" >= ?))
+                    )
+                    ORDER BY "Id" LIMIT ?
+                """, (after_id, now, STATUS_SKIPPED, STATUS_FAILED, self.max_attempts, batch_size)).fetchall()
+                self._conn.executemany(f"""
+                    INSERT INTO "{LEASES_TABLE}" ("MediaFileId", "Worker", "Status", "ExpiresAt")
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT("MediaFileId") DO UPDATE SET
+                        "Worker" = excluded."Worker",
+                        "Status" = excluded."Status",
+                        "ExpiresAt" = excluded."ExpiresAt"
+                """, [(row['Id'], self.worker, STATUS_LEASED, now + self.ttl) for row in rows])
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+        metrics.count('leases_claimed', len(rows))
+        return rows
+
+    def next_expiry(self):
+        """Seconds until a lease of another worker or a failed file may become claimable, None if none will."""
+        with self._lock:
+            row = self._conn.execute(f"""
+                SELECT min(l."ExpiresAt") FROM "{LEASES_TABLE}" l
+                JOIN "MediaFiles" ON "MediaFiles"."Id" = l."MediaFileId"
+                WHERE {EXTERNAL_URL_CONDITION}
+                  AND ((l."Worker" IS NOT ? AND l."Status" = ?) OR (l."Status" = ? AND l."Attempts" < ?))
+            """, (self.worker, STATUS_LEASED, STATUS_FAILED, self.max_attempts)).fetchone()
+        return None if row[0] is None else max(0.0, row[0] - time.time())
+
+    def random_start(self):
+        """A random Id of the media files left to migrate, for the first claim to start after.
+
+        A random uuid would not do: the Ids created by EF are upper case and all sort before the
+        lower case ones, so every worker would start at the same place.
+        """
+        with self._lock:
+            count = self._conn.execute(
+                f'SELECT count(*) FROM "MediaFiles" WHERE {EXTERNAL_URL_CONDITION}').fetchone()[0]
+            if not count:
+                return ''
+            row = self._conn.execute(f"""
+                SELECT "Id" FROM "MediaFiles" WHERE {EXTERNAL_URL_CONDITION} ORDER BY "Id" LIMIT 1 OFFSET ?
+            """, (random.randrange(count),)).fetchone()
+        return row['Id'] if row else ''
+
+    def iter_claimed(self, batch_size=50, limit=None):
+        """Claim media files batch by batch until there is nothing left to claim right now."""
+        after_id = self.random_start()
+        wrapped = False
+        claimed = 0
+        while limit is None or claimed < limit:
+            size = batch_size if limit is None else min(batch_size, limit - claimed)
+            rows = self.claim(after_id, size)
+            if rows:
+                claimed += len(rows)
+                after_id = rows[-1]['Id']
+                yield from rows
+                continue
+            if wrapped:
+                return
+            # Continue from the start of the table
+            after_id = ''
+            wrapped = True
+
+    def wait_for_claimable(self, poll_interval=10.0):
+        """Wait while the remaining files are leased by other workers or cool down after a failure.
+
+        Returns False if no file will become claimable. The leases of a crashed worker expire, so
+        its files are migrated by the workers that are still running.
+        """
+        wait = self.next_expiry()
+        if wait is None:
+            return False
+        time.sleep(min(max(wait, 0.5), poll_interval))
+        return True
+
+    def release(self, media_file_id, error=None, permanent=False):
+        """Give up the lease of a file that could not be migrated, so it can be claimed again.
+
+        A failed file is not claimed again before retry_delay has passed, and after a permanent
+        failure not at all until the leases are reset.
+        """
+        with self._lock:
+            self._conn.execute(f"""
+                UPDATE "{LEASES_TABLE}" SET
+                    "Worker" = NULL,
+                    "Status" = ?,
+                    "ExpiresAt" = ?,
+                    "Attempts" = CASE WHEN ? THEN max("Attempts" + 1, ?) ELSE "Attempts" + 1 END,
+                    "Error" = ?
+                WHERE "MediaFileId" = ? AND "Worker" = ?
+            """, (STATUS_FAILED, time.time() + self.retry_delay, permanent, self.max_attempts, error,
+                  media_file_id, self.worker))
+        metrics.count('leases_released')
+
+    def skip(self, media_file_id):
+        """Keep a file without anything to migrate (e.g. an empty URL) from being claimed again."""
+        with self._lock:
+            self._conn.execute(f"""
+                UPDATE "{LEASES_TABLE}" SET "Worker" = NULL, "Status" = ?
+                WHERE "MediaFileId" = ? AND "Worker" = ?
+            """, (STATUS_SKIPPED, media_file_id, self.worker))
+
+    def remove_in(self, conn, media_file_ids):
+        """Remove the leases of migrated files, inside the transaction of conn that writes their URLs."""
+        conn.executemany(f'DELETE FROM "{LEASES_TABLE}" WHERE "MediaFileId" = ?',
+                         [(media_file_id,) for media_file_id in media_file_ids])
+
+    def failed_count(self):
+        """Files that failed too often to be claimed again."""
+        with self._lock:
+            return self._conn.execute(f"""
+                SELECT count(*) FROM "{LEASES_TABLE}" WHERE "Status" = ? AND "Attempts" >= ?
+            """, (STATUS_FAILED, self.max_attempts)).fetchone()[0]
+
+    def reset(self):
+        """Remove all leases, e.g. to retry the files that failed in an earlier migration."""
+        with self._lock:
+            self._conn.execute(f'DELETE FROM "{LEASES_TABLE}"')
+
+    def close(self):
+        """Stop renewing and give up the leases this worker still holds."""
+        self._stop.set()
+        if self._heartbeat:
+            self._heartbeat.join()
+        with self._lock:
+            self._conn.execute(f"""
+                UPDATE "{LEASES_TABLE}" SET "Worker" = NULL, "ExpiresAt" = 0
+                WHERE "Worker" = ? AND "Status" = ?
+            """, (self.worker, STATUS_LEASED))
+            self._conn.close()
@@ -0,0 +1,259 @@
+"""
+Download Planner
+
+Gets the size of every file before the migration starts and orders the downloads so that the
+large transfers are spread over the parallel downloads, with the small files filling the gaps,
+instead of a few huge videos at the end holding up the whole run. The sizes come from the
+download journal, from a cache of earlier plans or from HEAD requests. The throughput of earlier
+runs, kept in the same cache, gives the estimate of how long the migration takes.
+"""
+
+import heapq
+import sqlite3
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from shared.metrics import metrics
+
+# Sizes assumed for files whose size the server does not tell, by MediaFiles.Type, until other
+# files of the same type are known
+DEFAULT_SIZES = {
+    0: 2 * 1024 * 1024,      # Image2D
+    1: 8 * 1024 * 1024,      # Image3D
+    2: 8 * 1024 * 1024,      # Image360Degree
+    3: 100 * 1024 * 1024,    # Video2D
+    4: 300 * 1024 * 1024,    # Video3D
+    5: 300 * 1024 * 1024,    # Video360Degree
+    6: 5 * 1024 * 1024,      # Audio
+}
+DEFAULT_SIZE = 8 * 1024 * 1024
+# Every request costs about as much time as transferring this many bytes (connection, latency)
+REQUEST_COST_BYTES = 256 * 1024
+# Runs whose throughput is averaged for the estimate
+THROUGHPUT_RUNS = 5
+# Responses to a HEAD request that mean there is nothing to download
+UNAVAILABLE_STATUS = {404, 410}
+
+
+class SizeCache:
+    """Sizes of the URLs found by earlier plans, and the throughput of earlier runs."""
+
+    def __init__(self, path, max_age_days=7.0):
+        self.path = path
+        self.max_age = max_age_days * 86400
+        self._conn = sqlite3.connect(path)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS Sizes (
+                Url TEXT NOT NULL PRIMARY KEY,
+                Size INTEGER NULL,
+                ContentType TEXT NULL,
+                CheckedAt REAL NOT NULL
+            )
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS Runs (
+                FinishedAt REAL NOT NULL,
+                Bytes INTEGER NOT NULL,
+                Files INTEGER NOT NULL,
+                Seconds REAL NOT NULL,
+                Concurrency INTEGER NOT NULL
+            )
+        """)
+        self._conn.commit()
+
+    def get(self, url):
+        """Get (size, content type) of a URL checked within max_age_days, or None."""
+        row = self._conn.execute('SELECT Size, ContentType FROM Sizes WHERE Url = ? AND CheckedAt > ?',
+                                 (url, time.time() - self.max_age)).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def put_many(self, entries):
+        """Store (url, size, content type) tuples in one transaction."""
+        now = time.time()
+        with self._conn:
+            self._conn.executemany("""
+                INSERT INTO Sizes (Url, Size, ContentType, CheckedAt) VALUES (?, ?, ?, ?)
+                ON CONFLICT(Url) DO UPDATE SET
+                    Size = excluded.Size,
+                    ContentType = excluded.ContentType,
+                    CheckedAt = excluded.CheckedAt
+            """, [(url, size, content_type, now) for url, size, content_type in entries])
+
+    def record_run(self, total_bytes, files, seconds, concurrency):
+        """Remember the throughput of a finished run for the next estimate.
+
+        Only the files that were downloaded count: skipped and linked files cost almost nothing
+        and would make the throughput look higher than it is.
+        """
+        if files <= 0 or seconds <= 0:
+            return
+        with self._conn:
+            self._conn.execute("""
+                INSERT INTO Runs (FinishedAt, Bytes, Files, Seconds, Concurrency) VALUES (?, ?, ?, ?, ?)
+            """, (time.time(), total_bytes, files, seconds, concurrency))
+
+    def bytes_per_second_per_download(self):
+        """The average throughput of one of the parallel downloads in the last runs, or None.
+
+        Every file counts with its request cost, like in the schedule, so a run of many small
+        images and one of a few videos give the same rate.
+        """
+        rows = self._conn.execute("""
+            SELECT Bytes, Files, Seconds, Concurrency FROM Runs ORDER BY FinishedAt DESC LIMIT ?
+        """, (THROUGHPUT_RUNS,)).fetchall()
+        if not rows:
+            return None
+        return sum(total_bytes + files * REQUEST_COST_BYTES for total_bytes, files, _, _ in rows) / sum(
+            seconds * concurrency for _, _, seconds, concurrency in rows)
+
+    def close(self):
+        self._conn.close()
+
+
+class PlannedFile:
+    """A media file with its (possibly estimated) size and its place in the schedule."""
+
+    __slots__ = ('media_file', 'size', 'estimated', 'unavailable', 'lane', 'start')
+
+    def __init__(self, media_file, size, estimated, unavailable=False):
+        self.media_file = media_file
+        self.size = size
+        self.estimated = estimated
+        # The server said the file does not exist, it only costs a request
+        self.unavailable = unavailable
+        # The parallel download it is expected to run on, and after how many bytes of it
+        self.lane = 0
+        self.start = 0
+
+
+class DownloadPlan:
+    """The files in the order they are downloaded, with the totals the estimate is based on."""
+
+    def __init__(self, files, concurrency):
+        self.files = files
+        self.concurrency = concurrency
+        self.total_bytes = sum(planned.size for planned in files)
+        self.estimated_bytes = sum(planned.size for planned in files if planned.estimated)
+        self.estimated_count = sum(1 for planned in files if planned.estimated)
+        self.unavailable_count = sum(1 for planned in files if planned.unavailable)
+        # Bytes (and the request cost) of the busiest download, it decides when the run ends
+        self.makespan = 0
+        self.requests_per_host = {}
+        for planned in files:
+            self.makespan = max(self.makespan, planned.start + weight(planned))
+            host = urlparse(planned.media_file['Url']).netloc
+            self.requests_per_host[host] = self.requests_per_host.get(host, 0) + 1
+
+    def estimate_seconds(self, bytes_per_second_per_download, rate_limit=None):
+        """How long the run takes at the given throughput, and at no more than rate_limit requests per host."""
+        if not self.files:
+            return 0.0
+        seconds = self.makespan / bytes_per_second_per_download
+        if rate_limit:
+            seconds = max(seconds, max(self.requests_per_host.values()) / rate_limit)
+        return seconds
+
+
+def weight(planned):
+    return planned.size + REQUEST_COST_BYTES
+
+
+def content_length(response):
+    value = response.headers.get('content-length')
+    return int(value) if value and value.isdigit() else None
+
+
+def fetch_sizes(head, urls, jobs):
+    """Ask the servers for the sizes of the URLs with parallel HEAD requests.
+
+    head(url) makes the request (within the rate limit of its host). Returns
+    {url: (size or None, content type or None, status or None)}.
+    """
+    def fetch(url):
+        try:
+            response = head(url)
+        except Exception:
+            return None, None, None
+        if response.status_code >= 400:
+            return None, None, response.status_code
+        content_type = response.headers.get('content-type')
+        content_type = content_type.split(';')[0].strip().lower() if content_type else None
+        return content_length(response), content_type, response.status_code
+
+    urls = list(urls)
+    with metrics.timer('plan_head', urls=len(urls)), ThreadPoolExecutor(max_workers=jobs) as executor:
+        return dict(zip(urls, executor.map(fetch, urls)))
+
+
+def schedule(files, concurrency):
+    """Order the files for concurrency parallel downloads, largest first onto the least busy one.
+
+    Every download (lane) takes the next file when it is done with the one before. Assigning the
+    largest files first, each to the lane with the fewest bytes so far, spreads the large
+    transfers over all lanes and lets the small ones even them out at the end. Ordering by the
+    byte offset at which a lane starts a file gives the order to hand them to the workers.
+    """
+    lanes = [(0, lane) for lane in range(concurrency)]
+    for planned in sorted(files, key=weight, reverse=True):
+        start, lane = heapq.heappop(lanes)
+        planned.lane = lane
+        planned.start = start
+        heapq.heappush(lanes, (start + weight(planned), lane))
+    return sorted(files, key=lambda planned: (planned.start, planned.lane))
+
+
+def plan_downloads(media_files, concurrency, head=None, journal=None, cache=None, head_jobs=16):
+    """Get the size of every media file and schedule them for concurrency parallel downloads."""
+    # Files without a URL are skipped by the migration, there is nothing to plan for them
+    media_files = [media_file for media_file in media_files if media_file['Url']]
+    sizes = {}
+    # Sizes that are already known: downloads in the journal, then earlier plans
+    unknown = set()
+    for media_file in media_files:
+        url = media_file['Url']
+        entry = journal.get(media_file['Id'], url) if journal else None
+        if entry and entry['ContentLength']:
+            sizes[url] = entry['ContentLength']
+            continue
+        cached = cache.get(url) if cache else None
+        if cached and cached[0] is not None:
+            sizes[url] = cached[0]
+            continue
+        unknown.add(url)
+    metrics.count('plan_sizes_known', len(sizes))
+
+    unavailable = set()
+    if head and unknown:
+        fetched = fetch_sizes(head, unknown, head_jobs)
+        if cache:
+            cache.put_many((url, size, content_type) for url, (size, content_type, _) in fetched.items()
+                           if size is not None)
+        for url, (size, _, status) in fetched.items():
+            if size is not None:
+                sizes[url] = size
+            elif status in UNAVAILABLE_STATUS:
+                unavailable.add(url)
+        metrics.count('plan_sizes_fetched', sum(1 for size, _, _ in fetched.values() if size is not None))
+
+    # Files whose size is still unknown are assumed to be as large as the typical file of their type
+    known_by_type = {}
+    for media_file in media_files:
+        if media_file['Url'] in sizes:
+            known_by_type.setdefault(media_file['Type'], []).append(sizes[media_file['Url']])
+    typical = {media_type: statistics.median(known) for media_type, known in known_by_type.items()}
+
+    files = []
+    for media_file in media_files:
+        size = sizes.get(media_file['Url'])
+        if media_file['Url'] in unavailable:
+            files.append(PlannedFile(media_file, 0, False, True))
+        elif size is None:
+            size = int(typical.get(media_file['Type'], DEFAULT_SIZES.get(media_file['Type'], DEFAULT_SIZE)))
+            files.append(PlannedFile(media_file, size, True))
+        else:
+            files.append(PlannedFile(media_file, size, False))
+    return DownloadPlan(schedule(files, concurrency), concurrency)
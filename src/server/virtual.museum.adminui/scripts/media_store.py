@@ -0,0 +1,85 @@
+"""
+Content-Addressed Media Store
+
+Keeps every distinct media file once, named by the SHA-256 of its content, in a .blobs
+directory inside the media directory. The per-Id file names served by /api/media/file/
+are hard links to these blobs (or copies where the file system has no hard links).
+"""
+
+import hashlib
+import mmap
+import os
+import shutil
+import threading
+
+BLOB_DIR_NAME = '.blobs'
+
+
+def hash_file(file_path, chunk_size=1024 * 1024):
+    """Get a SHA-256 hash object fed with the content of a file."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest
+
+
+def hash_file_mapped(file_path):
+    """Get the SHA-256 hex digest of a file, read through a memory map instead of a copy per chunk."""
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # Empty files cannot be mapped
+            return hashlib.sha256().hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return hashlib.sha256(mapped).hexdigest()
+
+
+class ContentStore:
+    """Stores downloaded files by content hash and counts the bytes saved by deduplication."""
+
+    def __init__(self, media_dir):
+        self.blob_dir = os.path.join(media_dir, BLOB_DIR_NAME)
+        self.bytes_saved = 0
+        self.files_deduplicated = 0
+        self._lock = threading.Lock()
+
+    def blob_path(self, sha256):
+        return os.path.join(self.blob_dir, sha256[:2], sha256)
+
+    def has_blob(self, sha256):
+        return os.path.exists(self.blob_path(sha256))
+
+    def add(self, source_path, sha256, file_path):
+        """Move a finished download into the store and make file_path point to it."""
+        blob_path = self.blob_path(sha256)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        with self._lock:
+            if os.path.exists(blob_path):
+                # Same bytes are already stored under another URL
+                self._count_saved(os.path.getsize(source_path))
+                os.unlink(source_path)
+            else:
+                os.replace(source_path, blob_path)
+        self._link(blob_path, file_path)
+
+    def link_existing(self, sha256, file_path):
+        """Make file_path point to a blob that is already stored, instead of downloading it again."""
+        blob_path = self.blob_path(sha256)
+        self._link(blob_path, file_path)
+        with self._lock:
+            self._count_saved(os.path.getsize(blob_path))
+
+    def _count_saved(self, size):
+        self.bytes_saved += size
+        self.files_deduplicated += 1
+
+    def _link(self, blob_path, file_path):
+        # Link under a temporary name first, so that file_path only ever appears complete
+        temp_path = file_path + '.link'
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        try:
+            os.link(blob_path, temp_path)
+        except OSError:
+            shutil.copyfile(blob_path, temp_path)
+        os.replace(temp_path, file_path)
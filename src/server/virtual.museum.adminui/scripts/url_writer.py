@@ -0,0 +1,89 @@
+"""
+Batched Media URL Writer
+
+Collects the new local URLs of migrated media files on a queue and writes them to the
+MediaFiles table from a single thread, grouping many updates into one transaction.
+"""
+
+import queue
+import sqlite3
+import threading
+import time
+
+from shared.metrics import metrics
+from tqdm import tqdm
+
+_STOP = object()
+
+
+class MediaUrlWriter(threading.Thread):
+    """Writes MediaFiles.Url updates in batches of batch_size rows or every flush_interval seconds."""
+
+    def __init__(self, db_path, batch_size=100, flush_interval=5.0, leases=None):
+        super().__init__(name='MediaUrlWriter', daemon=True)
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # With a LeaseStore, the leases of the migrated files end with the update of their URLs
+        self.leases = leases
+        self.updated_count = 0
+        self.error = None
+        self._queue = queue.Queue()
+
+    def submit(self, media_file_id, new_url):
+        """Queue the URL update of one media file."""
+        if self.error:
+            raise Exception(f"Database writer failed: {str(self.error)}")
+        self._queue.put((new_url, media_file_id))
+
+    def close(self):
+        """Write all queued updates and stop the writer thread."""
+        self._queue.put(_STOP)
+        self.join()
+        if self.error:
+            raise Exception(f"Database writer failed: {str(self.error)}")
+
+    def run(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            # WAL lets the admin UI keep reading the database while the migration writes to it
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+
+            batch = []
+            deadline = None
+            stopping = False
+            while not stopping:
+                timeout = None if deadline is None else max(0, deadline - time.monotonic())
+                try:
+                    item = self._queue.get(timeout=timeout)
+                    if item is _STOP:
+                        stopping = True
+                    else:
+                        batch.append(item)
+                        if deadline is None:
+                            deadline = time.monotonic() + self.flush_interval
+                except queue.Empty:
+                    pass
+
+                if batch and (stopping or len(batch) >= self.batch_size or time.monotonic() >= deadline):
+                    self._flush(conn, batch)
+                    batch = []
+                    deadline = None
+        except Exception as e:
+            self.error = e
+        finally:
+            conn.close()
+
+    def _flush(self, conn, batch):
+        with metrics.timer('db_update', rows=len(batch)), conn:
+            conn.executemany("""
+                UPDATE MediaFiles
+                SET Url = ?
+                WHERE Id = ?
+            """, batch)
+            if self.leases:
+                self.leases.remove_in(conn, [media_file_id for _, media_file_id in batch])
+        self.updated_count += len(batch)
+        metrics.count('db_rows_updated', len(batch))
+        tqdm.write(f"Database updated: {len(batch)} rows ({self.updated_count} total)")
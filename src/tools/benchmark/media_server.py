@@ -0,0 +1,109 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import mimetypes
+import re
+import threading
+import time
+
+# /media/<name>-<size in bytes>.<ext>, e.g. /media/00042-262144.jpg
+MEDIA_PATH = re.compile(r"^/media/[^/]*-(\d+)(\.\w+)$")
+CHUNK_SIZE = 16 * 1024
+CHUNK = b"\x00" * CHUNK_SIZE
+
+
+class FakeMediaHandler(BaseHTTPRequestHandler):
+    # keep-alive, like the CDN
+    protocol_version = "HTTP/1.1"
+
+    def do_HEAD(self):
+        self.respond(send_body=False)
+
+    def do_GET(self):
+        self.respond(send_body=True)
+
+    def respond(self, send_body: bool):
+        match = MEDIA_PATH.match(self.path)
+        if not match:
+            self.send_error(404)
+            return
+        size = int(match.group(1))
+        # the time until the first byte
+        time.sleep(self.server.latency)
+        self.send_response(200)
+        self.send_header("Content-Type", mimetypes.guess_type(self.path)[0] or "application/octet-stream")
+        self.send_header("Content-Length", str(size))
+        self.send_header("ETag", f'"{size}"')
+        self.end_headers()
+        if not send_body:
+            return
+
+        remaining = size
+        while remaining > 0:
+            chunk = CHUNK[: min(CHUNK_SIZE, remaining)]
+            self.wfile.write(chunk)
+            remaining -= len(chunk)
+            if self.server.bandwidth:
+                # bytes per second and connection
+                time.sleep(len(chunk) / self.server.bandwidth)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeMediaServer:
+    """A local stand-in for the media CDN that serves zero-filled files of the requested size.
+
+    Usage:
+        with FakeMediaServer(latency=0.02, bandwidth=10_000_000) as server:
+            url = f"{server.url}/media/00001-262144.jpg"
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.0,
+        bandwidth: float | None = None,
+    ):
+        self._server = ThreadingHTTPServer((host, port), FakeMediaHandler)
+        self._server.daemon_threads = True
+        self._server.latency = latency
+        self._server.bandwidth = bandwidth
+        self._thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeMediaServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve fake media files like the CDN.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=20, help="Delay before every response")
+    parser.add_argument("--bandwidth-mbit", type=float, default=None, help="Bandwidth per connection")
+    args = parser.parse_args()
+    bandwidth = args.bandwidth_mbit * 1_000_000 / 8 if args.bandwidth_mbit else None
+    server = FakeMediaServer(port=args.port, latency=args.latency_ms / 1000, bandwidth=bandwidth)
+    print(f"Serving {server.url}/media/<name>-<size>.<ext>")
+    server.serve_forever()
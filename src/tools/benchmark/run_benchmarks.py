@@ -0,0 +1,284 @@
+from pathlib import Path
+import argparse
+import importlib.util
+import json
+import math
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from media_server import FakeMediaServer
+from synthetic_tree import generate_tree
+
+TOOLS_DIR = Path(__file__).resolve().parent.parent
+DATA_IMPORT_DIR = TOOLS_DIR / "data_import"
+MEDIA_PARSER_DIR = TOOLS_DIR / "media_parser"
+DOWNLOAD_MEDIA_PATH = TOOLS_DIR.parent / "server" / "virtual.museum.adminui" / "scripts" / "download_media.py"
+
+STAGES = ["find_multimedia_dirs", "create_media_files", "read_all_media_files", "download_media"]
+MEDIA_FILES_TABLE = """
+    CREATE TABLE "MediaFiles" (
+        "Id" TEXT NOT NULL PRIMARY KEY,
+        "Description" TEXT NULL,
+        "DurationInSeconds" REAL NOT NULL,
+        "FileName" TEXT NULL,
+        "Name" TEXT NULL,
+        "Type" INTEGER NOT NULL,
+        "Url" TEXT NULL
+    )
+"""
+
+
+def percentile(samples: list[float], p: float) -> float | None:
+    # nearest rank
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    rank = max(1, math.ceil(p / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def peak_rss_bytes() -> int | None:
+    # the largest resident set size of this process so far
+    if sys.platform == "win32":
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [
+                ("cb", wintypes.DWORD),
+                ("PageFaultCount", wintypes.DWORD),
+                ("PeakWorkingSetSize", ctypes.c_size_t),
+                ("WorkingSetSize", ctypes.c_size_t),
+                ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                ("PagefileUsage", ctypes.c_size_t),
+                ("PeakPagefileUsage", ctypes.c_size_t),
+            ]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return None
+        return counters.PeakWorkingSetSize
+
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def stage_result(items: int, seconds: float, latencies: list[float]) -> dict:
+    peak_rss = peak_rss_bytes()
+    return {
+        "items": items,
+        "seconds": round(seconds, 4),
+        "items_per_second": round(items / seconds, 1) if seconds else None,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3) if latencies else None,
+        "peak_rss_mb": round(peak_rss / (1024 * 1024), 1) if peak_rss else None,
+    }
+
+
+# Stages: each runs in its own process, so the peak RSS is that of the stage alone
+def bench_find_multimedia_dirs(args) -> dict:
+    sys.path.insert(0, str(DATA_IMPORT_DIR))
+    from create_multimedia_presentation import find_multimedia_dirs
+
+    latencies = []
+    directory_count = 0
+    started = time.perf_counter()
+    for _ in range(args.repeat):
+        run_started = time.perf_counter()
+        directory_count = len(find_multimedia_dirs(args.tree))
+        latencies.append(time.perf_counter() - run_started)
+    # one sample per scan of the whole tree
+    return stage_result(directory_count * args.repeat, time.perf_counter() - started, latencies)
+
+
+def bench_create_media_files(args) -> dict:
+    sys.path.insert(0, str(DATA_IMPORT_DIR))
+    from create_multimedia_presentation import create_media_files, find_multimedia_dirs, find_multimedia_files
+
+    directories = find_multimedia_dirs(args.tree)
+    latencies = []
+    file_count = 0
+    started = time.perf_counter()
+    for directory in directories:
+        # called per directory like the import does; every file gets the mean of its directory
+        files = find_multimedia_files(directory)
+        if not files:
+            continue
+        dir_started = time.perf_counter()
+        create_media_files(files)
+        elapsed = time.perf_counter() - dir_started
+        latencies.extend([elapsed / len(files)] * len(files))
+        file_count += len(files)
+    return stage_result(file_count, time.perf_counter() - started, latencies)
+
+
+def bench_read_all_media_files(args) -> dict:
+    sys.path.insert(0, str(MEDIA_PARSER_DIR))
+    spec = importlib.util.spec_from_file_location("media_parser_main", MEDIA_PARSER_DIR / "main.py")
+    media_parser = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(media_parser)
+
+    latencies = []
+    started = previous = time.perf_counter()
+    for _ in media_parser.iter_media_files(args.tree):
+        now = time.perf_counter()
+        latencies.append(now - previous)
+        previous = now
+    return stage_result(len(latencies), time.perf_counter() - started, latencies)
+
+
+def bench_download_media(args) -> dict:
+    work_dir = Path(args.work_dir)
+    media_dir = work_dir / "media"
+    db_path = work_dir / "virtualmuseum.db"
+    with sqlite3.connect(db_path) as conn:
+        conn.execute(MEDIA_FILES_TABLE)
+        conn.executemany(
+            'INSERT INTO "MediaFiles" VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (
+                (f"00000000-0000-0000-0000-{i:012d}", "", 0, "", f"file {i}", 0,
+                 f"{args.base_url}/media/{i:05d}-{args.download_size}.jpg")
+                for i in range(args.downloads)
+            ),
+        )
+    conn.close()
+    # download_media.py reads its configuration from the environment when it is imported
+    os.environ["MEDIA_UPLOAD_DIR"] = str(media_dir)
+    os.environ["DB_PATH"] = str(db_path)
+    os.environ["DOWNLOAD_JOURNAL_PATH"] = str(work_dir / "media_download_journal.db")
+    sys.path.insert(0, str(DOWNLOAD_MEDIA_PATH.parent))
+    spec = importlib.util.spec_from_file_location("download_media", DOWNLOAD_MEDIA_PATH)
+    download_media = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(download_media)
+
+    # time every file as the worker threads see it
+    latencies = []
+    fetch_media_file = download_media.fetch_media_file
+
+    def timed_fetch_media_file(*fetch_args):
+        fetch_started = time.perf_counter()
+        try:
+            return fetch_media_file(*fetch_args)
+        finally:
+            latencies.append(time.perf_counter() - fetch_started)
+
+    download_media.fetch_media_file = timed_fetch_media_file
+    sys.argv = ["download_media.py", "--concurrency", str(args.concurrency)]
+    started = time.perf_counter()
+    download_media.main()
+    return stage_result(len(latencies), time.perf_counter() - started, latencies)
+
+
+def run_stage(stage: str, args, tree: str, base_url: str) -> dict:
+    # a fresh interpreter per stage
+    work_dir = tempfile.mkdtemp(prefix=f"bench_{stage}_")
+    result_file = os.path.join(work_dir, "result.json")
+    command = [
+        sys.executable, __file__,
+        "--stage", stage,
+        "--tree", tree,
+        "--work-dir", work_dir,
+        "--result-file", result_file,
+        "--base-url", base_url,
+        "--repeat", str(args.repeat),
+        "--downloads", str(args.downloads),
+        "--download-size", str(args.download_size),
+        "--concurrency", str(args.concurrency),
+    ]
+    try:
+        subprocess.run(command, check=True, stdout=None if args.verbose else subprocess.DEVNULL)
+        with open(result_file, "r", encoding="utf-8") as f:
+            return json.load(f)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def print_report(results: dict, baseline: dict | None = None):
+    print(f"{'stage':<22}{'items':>8}{'seconds':>10}{'items/s':>11}{'p50 ms':>10}{'p99 ms':>10}{'RSS MB':>9}")
+    for stage, result in results.items():
+        print(
+            f"{stage:<22}{result['items']:>8}{result['seconds']:>10.3f}{result['items_per_second'] or 0:>11.1f}"
+            f"{result['p50_ms'] or 0:>10.3f}{result['p99_ms'] or 0:>10.3f}{result['peak_rss_mb'] or 0:>9.1f}"
+        )
+        previous = (baseline or {}).get(stage)
+        if previous and previous.get("items_per_second") and result["items_per_second"]:
+            change = result["items_per_second"] / previous["items_per_second"] - 1
+            print(f"{'':<22}throughput {change:+.1%} against the baseline")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the ingestion tools on a synthetic exhibit tree.")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--fanout", type=int, default=2, help="Directories per level of the tree")
+    parser.add_argument("--files", type=int, default=8, help="Media files per presentation directory")
+    parser.add_argument("--sidecar-ratio", type=float, default=0.5, help="Share of files with a .txt sidecar")
+    parser.add_argument("--file-size", type=int, default=64 * 1024, help="Size of the media files in the tree")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3, help="Scans of the whole tree")
+    parser.add_argument("--downloads", type=int, default=200, help="Files downloaded by download_media")
+    parser.add_argument("--download-size", type=int, default=256 * 1024, help="Size of the downloaded files")
+    parser.add_argument("--concurrency", type=int, default=8, help="--concurrency of download_media")
+    parser.add_argument("--latency-ms", type=float, default=20, help="Server delay before every response")
+    parser.add_argument("--bandwidth-mbit", type=float, default=100, help="Server bandwidth per connection")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="Compare with the results of an earlier run")
+    parser.add_argument("--verbose", action="store_true", help="Show the output of the tools")
+    # used by the stage processes
+    parser.add_argument("--stage", choices=STAGES, help=argparse.SUPPRESS)
+    parser.add_argument("--tree", help=argparse.SUPPRESS)
+    parser.add_argument("--work-dir", help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    parser.add_argument("--base-url", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.stage:
+        result = globals()[f"bench_{args.stage}"](args)
+        with open(args.result_file, "w", encoding="utf-8") as f:
+            json.dump(result, f)
+        return
+
+    tree = tempfile.mkdtemp(prefix="bench_tree_")
+    try:
+        directory_count, file_count = generate_tree(
+            os.path.join(tree, "museum"), args.fanout, args.files, args.sidecar_ratio, args.file_size, args.seed
+        )
+        print(f"Synthetic tree: {directory_count} presentation directories, {file_count} media files")
+        bandwidth = args.bandwidth_mbit * 1_000_000 / 8 if args.bandwidth_mbit else None
+        results = {}
+        with FakeMediaServer(latency=args.latency_ms / 1000, bandwidth=bandwidth) as server:
+            for stage in args.stages:
+                print(f"Running {stage}...")
+                results[stage] = run_stage(stage, args, os.path.join(tree, "museum"), server.url)
+    finally:
+        shutil.rmtree(tree, ignore_errors=True)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+    print_report(results, baseline)
+    if args.output:
+        config = {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("stage", "tree", "work_dir", "result_file", "base_url", "output", "baseline", "verbose")
+        }
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"config": config, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
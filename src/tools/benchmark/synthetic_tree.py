@@ -0,0 +1,129 @@
+import argparse
+import os
+import random
+import struct
+import uuid
+import zlib
+
+# the levels beneath the base path, as in data_import/input:
+# room / table / region / topic / group / presentation
+LEVELS = ["room", "table", "region", "topic", "group", "presentation"]
+# extensions of the generated media files and how often they occur
+MEDIA_KINDS = [(".jpg", 6), (".png", 2), (".mp4", 1), (".mp3", 1)]
+
+
+def jpeg_header(width: int, height: int) -> bytes:
+    # SOI, a JFIF segment and the SOF0 segment with the size, as read by the media probe
+    jfif = b"JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00"
+    sof = struct.pack(">BHHB", 8, height, width, 3) + b"\x01\x11\x00\x02\x11\x01\x03\x11\x01"
+    return (
+        b"\xff\xd8"
+        + b"\xff\xe0" + struct.pack(">H", len(jfif) + 2) + jfif
+        + b"\xff\xc0" + struct.pack(">H", len(sof) + 2) + sof
+        + b"\xff\xda\x00\x02"
+    )
+
+
+def png_header(width: int, height: int) -> bytes:
+    ihdr = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    crc = struct.pack(">I", zlib.crc32(b"IHDR" + ihdr))
+    return b"\x89PNG\r\n\x1a\n" + struct.pack(">I", len(ihdr)) + b"IHDR" + ihdr + crc
+
+
+def mp4_box(box_type: bytes, payload: bytes) -> bytes:
+    return struct.pack(">I", len(payload) + 8) + box_type + payload
+
+
+def mp4_file(width: int, height: int, seconds: float, size: int) -> bytes:
+    # ftyp, mdat with padding, and moov at the end like most camera files
+    mvhd = mp4_box(b"mvhd", b"\x00" * 4 + struct.pack(">IIII", 0, 0, 1000, int(seconds * 1000)) + b"\x00" * 80)
+    tkhd = mp4_box(
+        b"tkhd",
+        b"\x00\x00\x00\x07"
+        + struct.pack(">IIIII", 0, 0, 1, 0, int(seconds * 1000))
+        + b"\x00" * 52
+        + struct.pack(">II", width << 16, height << 16),
+    )
+    moov = mp4_box(b"moov", mvhd + mp4_box(b"trak", tkhd))
+    ftyp = mp4_box(b"ftyp", b"isom\x00\x00\x02\x00")
+    mdat = mp4_box(b"mdat", b"\x00" * max(0, size - len(ftyp) - len(moov) - 8))
+    return ftyp + mdat + moov
+
+
+def mp3_file(size: int) -> bytes:
+    # constant bitrate MPEG-1 layer III frames, 128 kbit/s at 44.1 kHz
+    frame = b"\xff\xfb\x90\x00" + b"\x00" * 413
+    return frame * max(1, size // len(frame))
+
+
+def media_file_content(extension: str, size: int, rng: random.Random) -> bytes:
+    # every third image or video is an equirectangular 360 degree one
+    width = rng.choice([1920, 4096, 8192])
+    height = width // 2 if rng.random() < 1 / 3 else width * 9 // 16
+    if extension == ".mp4":
+        return mp4_file(width, height, rng.uniform(5, 120), size)
+    if extension == ".mp3":
+        return mp3_file(size)
+    header = jpeg_header(width, height) if extension == ".jpg" else png_header(width, height)
+    return header + b"\x00" * max(0, size - len(header))
+
+
+def write_sidecar(path: str, name: str, description: str, id: str):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(name + "\n" + description + "\n" + id + "\n")
+
+
+def generate_tree(
+    base_path: str,
+    fanout: int = 2,
+    files_per_dir: int = 8,
+    sidecar_ratio: float = 0.5,
+    file_size: int = 64 * 1024,
+    seed: int = 1,
+) -> tuple[int, int]:
+    # a museum with fanout directories on each of the 6 levels and files_per_dir media files in
+    # every presentation. Returns the number of presentation directories and media files.
+    rng = random.Random(seed)
+    extensions = [extension for extension, weight in MEDIA_KINDS for _ in range(weight)]
+    directories = [base_path]
+    for level in LEVELS:
+        directories = [
+            os.path.join(directory, f"{level}_{i}") for directory in directories for i in range(fanout)
+        ]
+
+    file_count = 0
+    for directory in directories:
+        os.makedirs(directory, exist_ok=True)
+        name = os.path.basename(directory)
+        if rng.random() < sidecar_ratio:
+            write_sidecar(
+                os.path.join(directory, name + ".txt"), name, "", str(uuid.UUID(int=rng.getrandbits(128)))
+            )
+        for i in range(files_per_dir):
+            extension = rng.choice(extensions)
+            # media_parser groups files by the text before the first space
+            file_name = f"{name} {i:03d}{extension}"
+            path = os.path.join(directory, file_name)
+            with open(path, "wb") as f:
+                f.write(media_file_content(extension, file_size, rng))
+            if rng.random() < sidecar_ratio:
+                write_sidecar(
+                    path + ".txt", file_name, f"Description of {file_name}", str(uuid.UUID(int=rng.getrandbits(128)))
+                )
+            file_count += 1
+    return len(directories), file_count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic exhibit tree for the benchmarks.")
+    parser.add_argument("base_path")
+    parser.add_argument("--fanout", type=int, default=2, help="Directories per level")
+    parser.add_argument("--files", type=int, default=8, help="Media files per presentation directory")
+    parser.add_argument("--sidecar-ratio", type=float, default=0.5, help="Share of files with a .txt sidecar")
+    parser.add_argument("--file-size", type=int, default=64 * 1024, help="Size of every media file in bytes")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    directory_count, file_count = generate_tree(
+        args.base_path, args.fanout, args.files, args.sidecar_ratio, args.file_size, args.seed
+    )
+    print(f"Generated {directory_count} presentation directories with {file_count} media files")
@@ -0,0 +1,338 @@
+from datetime import datetime, timezone
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import time
+
+# the tools share their database code in src/tools/shared
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from shared.media_queries import LOCAL_URL_PREFIX  # noqa: E402
+
+# Bump when the structure of the bundles changes, so clients can reject bundles they cannot read
+BUNDLE_FORMAT_VERSION = 1
+INDEX_FILE_NAME = "bundles.json"
+TABLES = [
+    "Rooms",
+    "InventoryItems",
+    "TopographicalTables",
+    "TopographicalTableTopics",
+    "TopographicalTableTopicTimeSeries",
+    "TimeSeries",
+    "GeoEventGroups",
+    "GeoEvents",
+    "MultimediaPresentations",
+    "PresentationItems",
+    "MediaFiles",
+]
+
+
+def camel_case(name: str) -> str:
+    # the property names of the admin API (System.Text.Json, camelCase)
+    return name[:1].lower() + name[1:]
+
+
+def key(value) -> str:
+    # ids are compared like the API does, independent of the case they were stored in
+    return str(value).lower() if value is not None else ""
+
+
+def to_json_object(row: sqlite3.Row) -> dict:
+    result = {camel_case(column): row[column] for column in row.keys()}
+    if "dateTime" in result and isinstance(result["dateTime"], str):
+        # stored as "2024-09-11 01:07:13.488149", serialized by the API as ISO 8601
+        result["dateTime"] = result["dateTime"].replace(" ", "T", 1)
+    return result
+
+
+class Catalog:
+    """All rows a bundle is made of, each table read with one query and indexed by its joins."""
+
+    def __init__(self, conn: sqlite3.Connection, media_dir: str | None = None):
+        self.media_dir = media_dir
+        self.rows = {table: conn.execute(f'SELECT * FROM "{table}" ORDER BY "Id"').fetchall() for table in TABLES}
+        self.rooms = self.by_id("Rooms")
+        self.inventory_items = self.by_id("InventoryItems")
+        self.media_files = self.by_id("MediaFiles")
+        self.presentations = self.by_id("MultimediaPresentations")
+        self.time_series = self.by_id("TimeSeries")
+        self.topics_by_table = self.group("TopographicalTableTopics", "TopographicalTableId")
+        self.time_series_by_topic = self.group("TopographicalTableTopicTimeSeries", "TopographicalTableTopicId")
+        self.groups_by_time_series = self.group("GeoEventGroups", "TimeSeriesId")
+        self.events_by_group = self.group("GeoEvents", "GeoEventGroupId")
+        self.items_by_presentation = self.group("PresentationItems", "MultimediaPresentationId")
+        self._media_sizes: dict[str, int | None] = {}
+
+    def by_id(self, table: str) -> dict[str, sqlite3.Row]:
+        return {key(row["Id"]): row for row in self.rows[table]}
+
+    def group(self, table: str, column: str) -> dict[str, list[sqlite3.Row]]:
+        grouped: dict[str, list[sqlite3.Row]] = {}
+        for row in self.rows[table]:
+            grouped.setdefault(key(row[column]), []).append(row)
+        return grouped
+
+    def media_size(self, url: str | None) -> int | None:
+        # size of a media file served by the admin UI, None if unknown
+        if not url or not self.media_dir or not url.startswith(LOCAL_URL_PREFIX):
+            return None
+        if url not in self._media_sizes:
+            try:
+                self._media_sizes[url] = os.path.getsize(os.path.join(self.media_dir, url[len(LOCAL_URL_PREFIX):]))
+            except OSError:
+                self._media_sizes[url] = None
+        return self._media_sizes[url]
+
+
+class BundleBuilder:
+    # resolves all joins below one topographical table, like GET /api/topographical-table/{id}
+    def __init__(self, catalog: Catalog):
+        self.catalog = catalog
+        # media files of the bundle by id, for preloading
+        self.media: dict[str, dict] = {}
+
+    def media_file(self, media_file_id) -> dict | None:
+        row = self.catalog.media_files.get(key(media_file_id))
+        if row is None:
+            return None
+        media_file = to_json_object(row)
+        media_file["size"] = self.catalog.media_size(row["Url"])
+        self.media[key(row["Id"])] = {
+            "id": media_file["id"],
+            "type": media_file["type"],
+            "url": media_file["url"],
+            "size": media_file["size"],
+        }
+        return media_file
+
+    def presentation(self, presentation_id) -> dict | None:
+        row = self.catalog.presentations.get(key(presentation_id))
+        if row is None:
+            return None
+        presentation = to_json_object(row)
+        items = sorted(
+            self.catalog.items_by_presentation.get(key(row["Id"]), []),
+            key=lambda item: (item["SlotNumber"], item["SequenceNumber"]),
+        )
+        presentation["presentationItems"] = []
+        for item_row in items:
+            item = to_json_object(item_row)
+            item["mediaFile"] = self.media_file(item_row["MediaFileId"])
+            presentation["presentationItems"].append(item)
+        return presentation
+
+    def geo_event_group(self, row: sqlite3.Row) -> dict:
+        group = to_json_object(row)
+        group["geoEvents"] = []
+        for event_row in self.catalog.events_by_group.get(key(row["Id"]), []):
+            event = to_json_object(event_row)
+            event["multiMediaPresentation"] = self.presentation(event_row["MultiMediaPresentationId"])
+            group["geoEvents"].append(event)
+        return group
+
+    def time_series(self, time_series_id) -> dict | None:
+        row = self.catalog.time_series.get(key(time_series_id))
+        if row is None:
+            return None
+        time_series = to_json_object(row)
+        time_series["geoEventGroups"] = [
+            self.geo_event_group(group_row)
+            for group_row in self.catalog.groups_by_time_series.get(key(row["Id"]), [])
+        ]
+        return time_series
+
+    def topic(self, row: sqlite3.Row) -> dict:
+        topic = to_json_object(row)
+        topic["mediaFileImage2D"] = self.media_file(row["MediaFileImage2DId"]) if row["MediaFileImage2DId"] else None
+        topic["timeSeries"] = []
+        for link in self.catalog.time_series_by_topic.get(key(row["Id"]), []):
+            time_series = self.time_series(link["TimeSeriesId"])
+            if time_series is not None:
+                topic["timeSeries"].append(time_series)
+        return topic
+
+    def build(self, table_row: sqlite3.Row) -> dict:
+        table_id = key(table_row["Id"])
+        # the inventory item that places the table in a room has the id of the table
+        inventory_item = self.catalog.inventory_items.get(table_id)
+        room = self.catalog.rooms.get(key(inventory_item["RoomId"])) if inventory_item else None
+        table = to_json_object(table_row)
+        table["topics"] = [self.topic(row) for row in self.catalog.topics_by_table.get(table_id, [])]
+        return {
+            "room": to_json_object(room) if room else None,
+            "inventoryItem": to_json_object(inventory_item) if inventory_item else None,
+            "topographicalTable": table,
+            "media": list(self.media.values()),
+            "mediaBytes": sum(media["size"] or 0 for media in self.media.values()),
+        }
+
+
+class BundleRows:
+    """Hashes the rows a bundle is built from, following the joins of the BundleBuilder.
+
+    Usage:
+        rows_sha256 = BundleRows(catalog).sha256(table_row)
+
+    Hashing the rows is much cheaper than building and serializing the bundle, so the bundles
+    whose rows did not change since the last export are not built at all.
+    """
+
+    def __init__(self, catalog: Catalog):
+        self.catalog = catalog
+        self.digest = hashlib.sha256()
+
+    def add(self, table: str, row: sqlite3.Row | None):
+        self.digest.update(repr((table, tuple(row) if row is not None else None)).encode("utf-8"))
+
+    def media_file(self, media_file_id):
+        row = self.catalog.media_files.get(key(media_file_id))
+        self.add("MediaFiles", row)
+        if row is not None:
+            self.digest.update(repr(self.catalog.media_size(row["Url"])).encode("utf-8"))
+
+    def presentation(self, presentation_id):
+        row = self.catalog.presentations.get(key(presentation_id))
+        self.add("MultimediaPresentations", row)
+        if row is None:
+            return
+        for item_row in self.catalog.items_by_presentation.get(key(row["Id"]), []):
+            self.add("PresentationItems", item_row)
+            self.media_file(item_row["MediaFileId"])
+
+    def time_series(self, time_series_id):
+        row = self.catalog.time_series.get(key(time_series_id))
+        self.add("TimeSeries", row)
+        if row is None:
+            return
+        for group_row in self.catalog.groups_by_time_series.get(key(row["Id"]), []):
+            self.add("GeoEventGroups", group_row)
+            for event_row in self.catalog.events_by_group.get(key(group_row["Id"]), []):
+                self.add("GeoEvents", event_row)
+                self.presentation(event_row["MultiMediaPresentationId"])
+
+    def sha256(self, table_row: sqlite3.Row) -> str:
+        table_id = key(table_row["Id"])
+        inventory_item = self.catalog.inventory_items.get(table_id)
+        self.add("InventoryItems", inventory_item)
+        self.add("Rooms", self.catalog.rooms.get(key(inventory_item["RoomId"])) if inventory_item else None)
+        self.add("TopographicalTables", table_row)
+        for topic_row in self.catalog.topics_by_table.get(table_id, []):
+            self.add("TopographicalTableTopics", topic_row)
+            if topic_row["MediaFileImage2DId"]:
+                self.media_file(topic_row["MediaFileImage2DId"])
+            for link in self.catalog.time_series_by_topic.get(key(topic_row["Id"]), []):
+                self.add("TopographicalTableTopicTimeSeries", link)
+                self.time_series(link["TimeSeriesId"])
+        return self.digest.hexdigest()
+
+
+def content_hash(content: dict) -> str:
+    # the same rows always give the same hash, whatever order the dicts were filled in
+    canonical = json.dumps(content, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def write_atomic(path: str, data: bytes):
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+
+def load_index(out_dir: str) -> dict:
+    path = os.path.join(out_dir, INDEX_FILE_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        index = json.load(f)
+    if index.get("formatVersion") != BUNDLE_FORMAT_VERSION:
+        # bundles of another format are all written again
+        return {}
+    return index.get("bundles", {})
+
+
+def export_bundles(db_path: str, out_dir: str, media_dir: str | None = None, force: bool = False) -> dict:
+    # One gzip compressed JSON bundle per topographical table with everything the client shows on
+    # it. Bundles whose rows did not change are not built again, bundles whose content did not
+    # change keep their file and version.
+    started = time.perf_counter()
+    os.makedirs(out_dir, exist_ok=True)
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    conn.row_factory = sqlite3.Row
+    try:
+        catalog = Catalog(conn, media_dir)
+    finally:
+        conn.close()
+
+    old_index = load_index(out_dir)
+    index = {}
+    written = 0
+    index_changed = False
+    for table_row in catalog.rows["TopographicalTables"]:
+        table_id = key(table_row["Id"])
+        file_name = f"topographical-table-{table_id}.json.gz"
+        rows_sha256 = BundleRows(catalog).sha256(table_row)
+        old_entry = old_index.get(table_id)
+        unchanged = (
+            not force and old_entry is not None and os.path.exists(os.path.join(out_dir, old_entry["file"]))
+        )
+        if unchanged and old_entry.get("rowsSha256") == rows_sha256:
+            index[table_id] = old_entry
+            continue
+
+        content = BundleBuilder(catalog).build(table_row)
+        sha256 = content_hash(content)
+        if unchanged and old_entry["sha256"] == sha256:
+            # other rows, but the same bundle
+            index[table_id] = dict(old_entry, rowsSha256=rows_sha256)
+            index_changed = True
+            continue
+
+        version = old_entry["version"] + 1 if old_entry else 1
+        updated_at = datetime.now(timezone.utc).isoformat()
+        bundle = {"formatVersion": BUNDLE_FORMAT_VERSION, "version": version, "updatedAt": updated_at}
+        bundle.update(content)
+        # mtime=0 so the same bundle always compresses to the same bytes
+        data = gzip.compress(json.dumps(bundle, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), mtime=0)
+        write_atomic(os.path.join(out_dir, file_name), data)
+        index[table_id] = {
+            "file": file_name,
+            "version": version,
+            "sha256": sha256,
+            "rowsSha256": rows_sha256,
+            "bytes": len(data),
+            "mediaBytes": content["mediaBytes"],
+            "updatedAt": updated_at,
+        }
+        written += 1
+        print(f"Wrote {file_name} (version {version}, {len(data)} bytes)")
+
+    # bundles of tables that no longer exist
+    for table_id, old_entry in old_index.items():
+        if table_id not in index:
+            path = os.path.join(out_dir, old_entry["file"])
+            if os.path.exists(path):
+                os.remove(path)
+            print(f"Removed {old_entry['file']}")
+
+    if written or index_changed or index.keys() != old_index.keys():
+        index_data = json.dumps({"formatVersion": BUNDLE_FORMAT_VERSION, "bundles": index}, ensure_ascii=False, indent=2)
+        write_atomic(os.path.join(out_dir, INDEX_FILE_NAME), index_data.encode("utf-8"))
+    elapsed = time.perf_counter() - started
+    print(f"{written} of {len(index)} bundles written, {len(index) - written} unchanged, in {elapsed:.2f}s")
+    return index
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export one content bundle per topographical table for the VR client.")
+    parser.add_argument("db", help="Path to virtualmuseum.db")
+    parser.add_argument("--out", default="bundles", help="Directory of the bundles and their index")
+    parser.add_argument(
+        "--media-dir", help="The media directory of the admin UI, to include the size of every media file"
+    )
+    parser.add_argument("--force", action="store_true", help="Write all bundles, also the unchanged ones")
+    args = parser.parse_args()
+    export_bundles(args.db, args.out, args.media_dir, args.force)
@@ -1,27 +1,163 @@
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
 import os
+import sys
 import uuid
 
+from directory_scanner import ScannedDirectory, scan_multimedia_dirs
+from import_manifest import ImportDelta, ImportManifest
+from ingest_media import ingest_media_files
+from load_presentations import load_presentations
+from metadata_index import MetadataIndex, read_metadata_file, write_metadata_file
 from model.MediaFileDefinition import MediaFile, MediaType
 from model.MultiMediaPresentationDefinition import MultiMediaPresentation
 
+# the tools share their media code in src/tools/shared
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from shared.media_derivatives import generate_all_derivatives  # noqa: E402
+from shared.media_probe import PROBE_CACHE_FILE_NAME, MediaInfo, ProbeCache, probe_media_files  # noqa: E402
+from shared.metrics import metrics  # noqa: E402
+
+
+def default_probe_cache_path(base_path: str) -> str:
+    # next to the base path instead of in it, so the source media tree is left as it is
+    return os.path.join(os.path.dirname(os.path.abspath(base_path)), PROBE_CACHE_FILE_NAME)
+
 
 # Multimedia Presentations
-def create_multimedia_presentations(base_path: str):
-    multimedia_dirs = find_multimedia_dirs(base_path)
-    for multimedia_dir in multimedia_dirs:
-        create_multimedia_presentation(multimedia_dir)
+def create_multimedia_presentations(
+    base_path: str,
+    incremental: bool = False,
+    use_hash: bool = False,
+    jobs: int = 1,
+    derivatives: bool = False,
+    use_metadata_index: bool = False,
+    media_dir: str | None = None,
+    link: bool = False,
+    probe_cache_path: str | None = None,
+    manifest_path: str | None = None,
+    metadata_index_path: str | None = None,
+) -> tuple[list[MultiMediaPresentation], ImportDelta | None, list[tuple[str, str]]]:
+    # with incremental, directories and files that did not change since the last run are skipped
+    manifest = ImportManifest(base_path, use_hash, manifest_path) if incremental else None
+    delta = ImportDelta() if incremental else None
+    # probe results of unchanged media files are reused, whether incremental or not
+    probe_cache = ProbeCache(probe_cache_path or default_probe_cache_path(base_path))
+    # the sidecars of the whole tree in one file, only sidecars changed since are read
+    metadata_index = MetadataIndex(base_path, metadata_index_path) if use_metadata_index else None
+
+    presentations = []
+    # (path, is 360 degree) of the images that get thumbnails and renditions
+    images: list[tuple[str, bool]] = []
+    # (media file, path) of every media file, to be ingested into the media directory
+    media_file_paths: list[tuple[MediaFile, str]] = []
+    # directories that were processed, the manifest records them once their files are ingested
+    processed_dirs: list[tuple[str, MultiMediaPresentation]] = []
+    # unchanged directories, the ingest may still give their media files a new Url
+    unchanged_dirs: list[tuple[str, MultiMediaPresentation]] = []
+    # directories and files that could not be processed, with the error
+    failures: list[tuple[str, str]] = []
+    with metrics.timer("scan"):
+        scanned_dirs = scan_multimedia_dirs(base_path)
+    multimedia_dirs = [scanned_dir.path for scanned_dir in scanned_dirs]
+
+    # presentations are independent of each other, so they are processed in parallel and
+    # collected in the order of the directories
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(process_multimedia_dir, scanned_dir, manifest, probe_cache, metadata_index)
+            for scanned_dir in scanned_dirs
+        ]
+        for scanned_dir, future in zip(scanned_dirs, futures):
+            try:
+                presentation, processed = future.result()
+            except Exception as e:
+                print(f"Failed to process {scanned_dir.path}: {e}")
+                metrics.count("errors")
+                failures.append((scanned_dir.path, str(e)))
+                continue
+            if manifest:
+                (processed_dirs if processed else unchanged_dirs).append((scanned_dir.path, presentation))
+            presentations.append(presentation)
+            metrics.count("presentations")
+            metrics.count("media_files", len(presentation.MediaFiles))
+            images.extend(
+                (
+                    os.path.join(scanned_dir.path, media_file.FileName),
+                    media_file.Type == MediaType.Image360Degree,
+                )
+                for media_file in presentation.MediaFiles
+                if media_file.Type in (MediaType.Image2D, MediaType.Image360Degree)
+            )
+            media_file_paths.extend(
+                (media_file, os.path.join(scanned_dir.path, media_file.FileName))
+                for media_file in presentation.MediaFiles
+            )
+
+    if media_dir:
+        # the files are copied with several threads, they wait on the disks and not on Python
+        with metrics.timer("ingest_all"):
+            failures.extend(ingest_media_files(media_file_paths, media_dir, link, max(jobs, 4)))
+    if manifest:
+        for directory, presentation in processed_dirs:
+            manifest.update(directory, presentation, delta)
+        for directory, presentation in unchanged_dirs:
+            manifest.update_records(directory, presentation, delta)
+    probe_cache.close()
+    probe_cache.save()
+    if metadata_index:
+        metadata_index.save()
+    if derivatives:
+        # skipped for images whose derivatives are newer than the image
+        with metrics.timer("derivatives"):
+            generate_all_derivatives(images)
+    if manifest:
+        manifest.remove_missing(delta)
+        manifest.save()
+        print(delta.summary())
+    if failures:
+        print(f"{len(failures)} directories or files failed")
     print(multimedia_dirs)
+    return presentations, delta, failures
+
+
+def process_multimedia_dir(
+    scanned_dir: ScannedDirectory,
+    manifest: ImportManifest | None,
+    probe_cache: ProbeCache | None = None,
+    metadata_index: MetadataIndex | None = None,
+) -> tuple[MultiMediaPresentation, bool]:
+    # the presentation of a directory, and whether it had to be processed
+    if manifest:
+        presentation = manifest.unchanged_presentation(scanned_dir.path, scanned_dir.signature)
+        if presentation is not None:
+            return presentation, False
+    return (
+        create_multimedia_presentation(
+            scanned_dir.path, manifest, scanned_dir.media_files, probe_cache, metadata_index
+        ),
+        True,
+    )
 
 
-def create_multimedia_presentation(presentation_directory: str):
-    files = find_multimedia_files(presentation_directory)
+def create_multimedia_presentation(
+    presentation_directory: str,
+    manifest: ImportManifest | None = None,
+    files: list[str] | None = None,
+    probe_cache: ProbeCache | None = None,
+    metadata_index: MetadataIndex | None = None,
+) -> MultiMediaPresentation:
+    if files is None:
+        files = find_multimedia_files(presentation_directory)
 
     presentation = create_default_multimedia_presentation(presentation_directory)
     presentation = try_read_metadata_file_for_presenation(
-        presentation, presentation_directory
+        presentation, presentation_directory, metadata_index
     )
-    save_metadata_file_for_presenation(presentation, presentation_directory)
-    presentation.MediaFiles = create_media_files(files)
+    save_metadata_file_for_presenation(presentation, presentation_directory, metadata_index)
+    presentation.MediaFiles = create_media_files(files, manifest, probe_cache, metadata_index)
+    return presentation
 
 
 def create_default_multimedia_presentation(
@@ -35,7 +171,9 @@ def create_default_multimedia_presentation(
 
 
 def try_read_metadata_file_for_presenation(
-    presentation: MultiMediaPresentation, presentation_directory: str
+    presentation: MultiMediaPresentation,
+    presentation_directory: str,
+    metadata_index: MetadataIndex | None = None,
 ) -> MultiMediaPresentation:
     meta_data_file_path = (
         presentation_directory
@@ -43,25 +181,17 @@ def try_read_metadata_file_for_presenation(
         + os.path.basename(presentation_directory)
         + ".txt"
     )
-    if os.path.exists(meta_data_file_path):
-        meta_data_file = open(meta_data_file_path, "r")
-
-        lines = meta_data_file.readlines()
-        # check if we have at least 3 lines
-        if len(lines) < 3:
-            print(
-                f"Invalid metadata file for {presentation_directory}: Needs at least 3 lines but has {len(lines)}"
-            )
-        presentation.Name = lines[0].strip()
-        presentation.Description = "".join(lines[1:-1]).strip()
-        presentation.Id = lines[-1].strip()
-        meta_data_file.close()
+    metadata = read_sidecar(meta_data_file_path, metadata_index)
+    if metadata is not None:
+        presentation.Name, presentation.Description, presentation.Id = metadata
 
     return presentation
 
 
 def save_metadata_file_for_presenation(
-    presentation: MultiMediaPresentation, presentation_directory: str
+    presentation: MultiMediaPresentation,
+    presentation_directory: str,
+    metadata_index: MetadataIndex | None = None,
 ):
     meta_data_file_path = (
         presentation_directory
@@ -69,103 +199,227 @@ def save_metadata_file_for_presenation(
         + os.path.basename(presentation_directory)
         + ".txt"
     )
-    meta_data_file = open(meta_data_file_path, "w")
-    meta_data_file.write(presentation.Name + "\n")
-    meta_data_file.write(presentation.Description + "\n")
-    meta_data_file.write(presentation.Id + "\n")
-    meta_data_file.close()
-
+    write_sidecar(
+        meta_data_file_path,
+        presentation.Name,
+        presentation.Description,
+        presentation.Id,
+        metadata_index,
+    )
 
-def find_multimedia_dirs(base_path: str):
-    all_dirs = []
-    # walk through the base_path and find all directories 6 levels beneath it
-    for root, _, _ in os.walk(base_path):
-        # check if the depth of the current directory is 6
-        if root.count(os.sep) - base_path.count(os.sep) == 6:
-            all_dirs.append(root)
 
-    return all_dirs
+def find_multimedia_dirs(base_path: str) -> list[str]:
+    # all directories 6 levels beneath the base_path
+    return [scanned_dir.path for scanned_dir in scan_multimedia_dirs(base_path)]
 
 
 # Media Files
 def find_multimedia_files(multimedia_dir: str) -> list[str]:
     # all .jpg, .png, .mp4, .mp3 files in the multimedia_dir. Do not include subdirectories
-    multimedia_files = []
-    for file in os.listdir(multimedia_dir):
-        if (
-            file.endswith(".jpg")
-            or file.endswith(".png")
-            or file.endswith(".mp4")
-            or file.endswith(".mp3")
-        ):
-            multimedia_files.append(multimedia_dir + os.sep + file)
+    return scan_multimedia_dirs(multimedia_dir, depth=0)[0].media_files
 
-    return multimedia_files
 
-
-def create_media_files(media_file_paths: list[str]) -> list[MediaFile]:
+def create_media_files(
+    media_file_paths: list[str],
+    manifest: ImportManifest | None = None,
+    probe_cache: ProbeCache | None = None,
+    metadata_index: MetadataIndex | None = None,
+) -> list[MediaFile]:
     media_files: list[MediaFile] = []
+    unchanged_media_files = {}
+    if manifest:
+        for media_file_path in media_file_paths:
+            media_file = manifest.unchanged_media_file(media_file_path)
+            if media_file is not None:
+                unchanged_media_files[media_file_path] = media_file
+    # read the headers of the new and changed files in parallel
+    with metrics.timer("probe"):
+        media_infos = probe_media_files(
+            [path for path in media_file_paths if path not in unchanged_media_files], probe_cache
+        )
     # check if a text file with the same name exists in the same directory
 
     for media_file_path in media_file_paths:
-        media_file = create_default_media_data(media_file_path)
-        media_file = try_read_metadata_file(media_file, media_file_path)
-        save_metadata_file(media_file, media_file_path)
+        media_file = unchanged_media_files.get(media_file_path)
+        if media_file is not None:
+            media_files.append(media_file)
+            continue
+        media_file = create_default_media_data(media_file_path, media_infos[media_file_path])
+        media_file = try_read_metadata_file(media_file, media_file_path, metadata_index)
+        save_metadata_file(media_file, media_file_path, metadata_index)
         media_files.append(media_file)
     return media_files
 
 
-def create_default_media_data(media_file_path: str) -> MediaFile:
+def create_default_media_data(
+    media_file_path: str, media_info: MediaInfo | None = None
+) -> MediaFile:
     media_file = MediaFile()
     media_file.FileName = os.path.basename(media_file_path)
     media_file.Id = str(uuid.uuid4())
     media_file.Name = media_file.FileName
     media_file.Description = ""
     media_file.Url = ""
-    # TODO: distinguish 360 degree, 2D and 3D images and videos
-    if media_file_path.endswith(".jpg") or media_file_path.endswith(".png"):
-        media_file.Type = MediaType.Image2D
-    elif media_file_path.endswith(".mp4"):
-        media_file.Type = MediaType.Video360Degree
-    elif media_file_path.endswith(".mp3"):
-        media_file.Type = MediaType.Audio
+    media_file.Type = media_type(media_file_path, media_info)
+    media_file.DurationInSeconds = 0
+    if media_info is not None and media_info.duration:
+        media_file.DurationInSeconds = round(media_info.duration, 3)
 
     return media_file
 
 
-def try_read_metadata_file(media_file: MediaFile, media_file_path: str) -> MediaFile:
-    meta_data_file_path = media_file_path + ".txt"
-    if os.path.exists(meta_data_file_path):
-        meta_data_file = open(meta_data_file_path, "r")
-        # the first line is the name of the media file
-        # the last line is the id (uuid) of the media file
-        # all lines in between are the description of the media file
-        # the description can be multiple lines it must be at least one line (can be empty)
-
-        lines = meta_data_file.readlines()
-        # check if we have at least 3 lines
-        if len(lines) < 3:
-            print(
-                f"Invalid metadata file for {media_file_path}: Needs at least 3 lines but has {len(lines)}"
-            )
-        media_file.Name = lines[0].strip()
-        media_file.Description = "".join(lines[1:-1]).strip()
-        media_file.Id = lines[-1].strip()
-        meta_data_file.close()
+def media_type(media_file_path: str, media_info: MediaInfo | None) -> int:
+    # 360 degree images and videos are equirectangular, either flagged in the metadata or
+    # recognised by their 2:1 aspect ratio. 3D media cannot be told apart by the headers.
+    if media_file_path.endswith(".mp3") or (media_info is not None and media_info.kind == "audio"):
+        return MediaType.Audio
+    if media_file_path.endswith(".jpg") or media_file_path.endswith(".png"):
+        if media_info is not None and media_info.is_equirectangular:
+            return MediaType.Image360Degree
+        return MediaType.Image2D
+    if media_info is None or media_info.is_equirectangular:
+        # videos that could not be probed keep the old default
+        return MediaType.Video360Degree
+    return MediaType.Video2D
+
+
+def try_read_metadata_file(
+    media_file: MediaFile, media_file_path: str, metadata_index: MetadataIndex | None = None
+) -> MediaFile:
+    metadata = read_sidecar(media_file_path + ".txt", metadata_index)
+    if metadata is not None:
+        media_file.Name, media_file.Description, media_file.Id = metadata
 
     return media_file
 
 
-def save_metadata_file(media_file: MediaFile, media_file_path: str):
-    meta_data_file_path = media_file_path + ".txt"
-    meta_data_file = open(meta_data_file_path, "w")
-    meta_data_file.write(media_file.Name + "\n")
-    meta_data_file.write(media_file.Description + "\n")
-    meta_data_file.write(media_file.Id + "\n")
-    meta_data_file.close()
+def save_metadata_file(
+    media_file: MediaFile, media_file_path: str, metadata_index: MetadataIndex | None = None
+):
+    write_sidecar(
+        media_file_path + ".txt",
+        media_file.Name,
+        media_file.Description,
+        media_file.Id,
+        metadata_index,
+    )
+
+
+def read_sidecar(
+    meta_data_file_path: str, metadata_index: MetadataIndex | None = None
+) -> tuple[str, str, str] | None:
+    # (name, description, id) from the sidecar, or from the metadata index if it did not change
+    with metrics.timer("sidecar_read", path=meta_data_file_path):
+        if metadata_index:
+            return metadata_index.read(meta_data_file_path)
+        if not os.path.exists(meta_data_file_path):
+            return None
+        return read_metadata_file(meta_data_file_path)
+
+
+def write_sidecar(
+    meta_data_file_path: str,
+    name: str,
+    description: str,
+    id: str,
+    metadata_index: MetadataIndex | None = None,
+) -> bool:
+    # only written if the content changed, so unchanged sidecars keep their modification time
+    with metrics.timer("sidecar_write", path=meta_data_file_path):
+        if metadata_index:
+            written = metadata_index.write(meta_data_file_path, name, description, id)
+        else:
+            written = write_metadata_file(meta_data_file_path, name, description, id)
+    if written:
+        metrics.count("sidecars_written")
+    return written
 
 
 if __name__ == "__main__":
-    create_multimedia_presentations(
-        "C:\\src\\ntlt\\virtualmuseum\\src\\tools\\data_import\\input\\schloss_wilhelmsburg"
+    parser = argparse.ArgumentParser(description="Create multimedia presentations from a directory tree.")
+    parser.add_argument(
+        "base_path",
+        nargs="?",
+        default="C:\\src\\ntlt\\virtualmuseum\\src\\tools\\data_import\\input\\schloss_wilhelmsburg",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only process directories and files that changed since the last run",
+    )
+    parser.add_argument(
+        "--manifest",
+        help="File of the manifest of --incremental (default: .<base path name>.import_manifest.json next to the base path)",
+    )
+    parser.add_argument(
+        "--hash",
+        action="store_true",
+        help="With --incremental, compare file contents of touched media files",
+    )
+    parser.add_argument("--delta", help="Write the added, changed and removed records to this JSON file")
+    parser.add_argument(
+        "--jobs", type=int, default=1, help="Number of presentations processed in parallel"
+    )
+    parser.add_argument("--db", help="Load the presentations into this virtualmuseum.db")
+    parser.add_argument(
+        "--derivatives",
+        action="store_true",
+        help="Create thumbnails and 2K/4K/8K renditions of the images next to them (needs Pillow)",
+    )
+    parser.add_argument(
+        "--metadata-index",
+        action="store_true",
+        help="Keep the contents of all sidecars in one index file and only read the sidecars changed since",
+    )
+    parser.add_argument(
+        "--metadata-index-path",
+        help="File of the --metadata-index (default: .<base path name>.metadata_index.json next to the base path)",
+    )
+    parser.add_argument(
+        "--ingest",
+        metavar="MEDIA_DIR",
+        help="Copy the media files into this media directory of the admin UI and set their Url to it",
+    )
+    parser.add_argument(
+        "--link",
+        action="store_true",
+        help="With --ingest, hard link the media files instead of copying them where the file system allows it",
+    )
+    parser.add_argument(
+        "--probe-cache",
+        help=f"File of the probe results of the media files (default: {PROBE_CACHE_FILE_NAME} next to the base path)",
+    )
+    parser.add_argument("--metrics", help="Write the time per stage and the counters to this Prometheus text file")
+    parser.add_argument("--trace", help="Append every timed stage to this JSON lines file")
+    args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.trace:
+        metrics.start_trace(args.trace)
+
+    presentations, delta, failures = create_multimedia_presentations(
+        args.base_path,
+        args.incremental,
+        args.hash,
+        args.jobs,
+        args.derivatives,
+        args.metadata_index,
+        args.ingest,
+        args.link,
+        args.probe_cache,
+        args.manifest,
+        args.metadata_index_path,
     )
+    if args.db:
+        with metrics.timer("db_load"):
+            load_presentations(args.db, presentations)
+    if args.delta and delta is not None:
+        with open(args.delta, "w", encoding="utf-8") as f:
+            json.dump(delta.to_dict(), f, ensure_ascii=False, indent=2)
+    # where the time went: the file system (scan, probe, sidecars, ingest) or SQLite (db_load)
+    print(metrics.summary())
+    if args.metrics:
+        metrics.write_prometheus(args.metrics)
+    metrics.close()
+    if failures:
+        sys.exit(1)
@@ -0,0 +1,74 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import sys
+
+# the tools share their media code in src/tools/shared
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from shared.media_derivatives import is_derivative  # noqa: E402
+
+MEDIA_EXTENSIONS = (".jpg", ".png", ".mp4", ".mp3")
+SIDECAR_EXTENSION = ".txt"
+# presentations live 6 levels beneath the base path:
+# museum / room / table / region / topic / group / presentation
+PRESENTATION_DEPTH = 6
+
+
+class ScannedDirectory:
+    def __init__(self, path: str):
+        self.path = path
+        # full paths of the media files, sorted by name
+        self.media_files: list[str] = []
+        # names of the .txt files in the directory
+        self.sidecar_files: set[str] = set()
+        # size and mtime of every file in the directory, taken from the scan
+        self.signature: dict[str, list[int]] = {}
+
+
+def scan_multimedia_dirs(
+    base_path: str, depth: int = PRESENTATION_DEPTH, max_workers: int | None = None
+) -> list[ScannedDirectory]:
+    # walk the tree once, stop descending at the presentation depth and collect the files
+    # of each presentation directory on the way. The subtrees of the base path are scanned
+    # in parallel, which pays off on network shares where every directory read waits on I/O.
+    if depth == 0:
+        return [_scan_presentation_dir(base_path)]
+
+    subdirs = _list_subdirs(base_path)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(lambda subdir: _scan_tree(subdir, depth - 1), subdirs)
+        scanned = [directory for result in results for directory in result]
+
+    scanned.sort(key=lambda directory: directory.path)
+    return scanned
+
+
+def _scan_tree(path: str, depth: int) -> list[ScannedDirectory]:
+    if depth == 0:
+        return [_scan_presentation_dir(path)]
+    scanned = []
+    for subdir in _list_subdirs(path):
+        scanned.extend(_scan_tree(subdir, depth - 1))
+    return scanned
+
+
+def _list_subdirs(path: str) -> list[str]:
+    with os.scandir(path) as entries:
+        return [entry.path for entry in entries if entry.is_dir(follow_symlinks=False)]
+
+
+def _scan_presentation_dir(path: str) -> ScannedDirectory:
+    directory = ScannedDirectory(path)
+    with os.scandir(path) as entries:
+        for entry in entries:
+            # thumbnails and renditions are created from the media files, they are not part of them
+            if not entry.is_file() or is_derivative(entry.name):
+                continue
+            # DirEntry caches the stat result (on Windows it comes with the directory listing)
+            stat = entry.stat()
+            directory.signature[entry.name] = [stat.st_size, stat.st_mtime_ns]
+            if entry.name.endswith(MEDIA_EXTENSIONS):
+                directory.media_files.append(entry.path)
+            elif entry.name.endswith(SIDECAR_EXTENSION):
+                directory.sidecar_files.add(entry.name)
+    directory.media_files.sort()
+    return directory
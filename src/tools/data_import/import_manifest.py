@@ -0,0 +1,267 @@
+import hashlib
+import json
+import os
+import sys
+
+from model.MediaFileDefinition import MediaFile
+from model.MultiMediaPresentationDefinition import MultiMediaPresentation
+
+# the tools share their media code in src/tools/shared
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from shared.media_derivatives import is_derivative  # noqa: E402
+
+MANIFEST_FILE_NAME = ".import_manifest.json"
+MANIFEST_VERSION = 1
+
+
+def state_file_path(base_path: str, file_name: str) -> str:
+    # The files an import keeps about a tree are written next to it instead of into it, so the
+    # source media tree is left as it is. They are named after the tree, because their keys are
+    # relative to it and several trees may share a parent directory.
+    base_path = os.path.abspath(base_path)
+    return os.path.join(os.path.dirname(base_path), f".{os.path.basename(base_path)}{file_name}")
+
+
+def file_signature(path: str) -> list[int] | None:
+    # size and modification time of a file, None if it does not exist
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def directory_signature(directory: str) -> dict[str, list[int]]:
+    # signatures of all files directly in the directory, sidecars included, derivatives not
+    signature = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_file() and not is_derivative(entry.name):
+                stat = entry.stat()
+                signature[entry.name] = [stat.st_size, stat.st_mtime_ns]
+    return signature
+
+
+def media_file_record(media_file: MediaFile) -> dict:
+    return {
+        "Id": media_file.Id,
+        "Name": media_file.Name,
+        "Description": media_file.Description,
+        "FileName": media_file.FileName,
+        "Type": int(media_file.Type),
+        "Url": media_file.Url,
+        "DurationInSeconds": media_file.DurationInSeconds,
+    }
+
+
+def presentation_record(presentation: MultiMediaPresentation) -> dict:
+    return {
+        "Id": presentation.Id,
+        "Name": presentation.Name,
+        "Description": presentation.Description,
+    }
+
+
+def media_file_from_record(record: dict) -> MediaFile:
+    return MediaFile(**record)
+
+
+class ImportDelta:
+    def __init__(self):
+        self.added_presentations: list[dict] = []
+        self.changed_presentations: list[dict] = []
+        self.removed_presentations: list[dict] = []
+        self.added_media_files: list[dict] = []
+        self.changed_media_files: list[dict] = []
+        self.removed_media_files: list[dict] = []
+
+    def is_empty(self) -> bool:
+        return not any(self.to_dict().values())
+
+    def to_dict(self) -> dict:
+        return {
+            "MultiMediaPresentations": {
+                "added": self.added_presentations,
+                "changed": self.changed_presentations,
+                "removed": self.removed_presentations,
+            },
+            "MediaFiles": {
+                "added": self.added_media_files,
+                "changed": self.changed_media_files,
+                "removed": self.removed_media_files,
+            },
+        }
+
+    def summary(self) -> str:
+        return (
+            f"Presentations: {len(self.added_presentations)} added, "
+            f"{len(self.changed_presentations)} changed, {len(self.removed_presentations)} removed; "
+            f"media files: {len(self.added_media_files)} added, "
+            f"{len(self.changed_media_files)} changed, {len(self.removed_media_files)} removed"
+        )
+
+
+class ImportManifest:
+    """Remembers what the last import saw, so unchanged directories and files can be skipped.
+
+    Directories are keyed by their path relative to the base path. For every directory the
+    manifest keeps the signature (size, mtime) of all its files and the records that were
+    created from them.
+    """
+
+    def __init__(self, base_path: str, use_hash: bool = False, path: str | None = None):
+        self.base_path = base_path
+        self.path = path or state_file_path(base_path, MANIFEST_FILE_NAME)
+        # where earlier versions kept the manifest, it is moved to path by the next save
+        self.legacy_path = os.path.join(base_path, MANIFEST_FILE_NAME)
+        self.use_hash = use_hash
+        self.directories: dict[str, dict] = {}
+        self._seen: set[str] = set()
+        load_path = self.path
+        if not os.path.exists(load_path) and os.path.exists(self.legacy_path):
+            load_path = self.legacy_path
+        if os.path.exists(load_path):
+            with open(load_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == MANIFEST_VERSION:
+                self.directories = data["directories"]
+
+    def key(self, directory: str) -> str:
+        return os.path.relpath(directory, self.base_path)
+
+    def unchanged_presentation(
+        self, directory: str, signature: dict[str, list[int]] | None = None
+    ) -> MultiMediaPresentation | None:
+        # the presentation of the last import, if no file in the directory changed since
+        key = self.key(directory)
+        self._seen.add(key)
+        entry = self.directories.get(key)
+        if signature is None:
+            signature = directory_signature(directory)
+        if entry is None or entry["signature"] != signature:
+            return None
+
+        presentation = MultiMediaPresentation()
+        for field, value in entry["presentation"].items():
+            setattr(presentation, field, value)
+        presentation.MediaFiles = [
+            media_file_from_record(media_entry["record"])
+            for media_entry in entry["media_files"].values()
+        ]
+        return presentation
+
+    def unchanged_media_file(self, media_file_path: str) -> MediaFile | None:
+        # the media file of the last import, if neither the file nor its sidecar changed since
+        entry = self.directories.get(self.key(os.path.dirname(media_file_path)))
+        if entry is None:
+            return None
+        media_entry = entry["media_files"].get(os.path.basename(media_file_path))
+        if media_entry is None:
+            return None
+        if media_entry["sidecar"] != file_signature(media_file_path + ".txt"):
+            return None
+        if media_entry["signature"] != file_signature(media_file_path):
+            if not self.use_hash or media_entry.get("hash") is None:
+                return None
+            # touched, but maybe not changed
+            if media_entry["hash"] != file_hash(media_file_path):
+                return None
+        return media_file_from_record(media_entry["record"])
+
+    def update(self, directory: str, presentation: MultiMediaPresentation, delta: ImportDelta):
+        key = self.key(directory)
+        self._seen.add(key)
+        old_entry = self.directories.get(key)
+
+        record = presentation_record(presentation)
+        if old_entry is None:
+            delta.added_presentations.append(record)
+        elif old_entry["presentation"] != record:
+            delta.changed_presentations.append(record)
+
+        old_media_files = old_entry["media_files"] if old_entry else {}
+        media_files = {}
+        for media_file in presentation.MediaFiles:
+            media_file_path = os.path.join(directory, media_file.FileName)
+            media_entry = {
+                "signature": file_signature(media_file_path),
+                "sidecar": file_signature(media_file_path + ".txt"),
+                "record": media_file_record(media_file),
+            }
+            old_media_entry = old_media_files.get(media_file.FileName)
+            if self.use_hash:
+                unchanged_file = (
+                    old_media_entry is not None
+                    and old_media_entry["signature"] == media_entry["signature"]
+                    and old_media_entry.get("hash") is not None
+                )
+                media_entry["hash"] = (
+                    old_media_entry["hash"] if unchanged_file else file_hash(media_file_path)
+                )
+            media_files[media_file.FileName] = media_entry
+
+            if old_media_entry is None:
+                delta.added_media_files.append(media_entry["record"])
+            elif old_media_entry["record"] != media_entry["record"] or not self._same_content(
+                old_media_entry, media_entry
+            ):
+                delta.changed_media_files.append(media_entry["record"])
+
+        for file_name, old_media_entry in old_media_files.items():
+            if file_name not in media_files:
+                delta.removed_media_files.append(old_media_entry["record"])
+
+        self.directories[key] = {
+            # taken after the sidecars were written, so the next run sees them as unchanged
+            "signature": directory_signature(directory),
+            "presentation": record,
+            "media_files": media_files,
+        }
+
+    def update_records(self, directory: str, presentation: MultiMediaPresentation, delta: ImportDelta):
+        # the media files of an unchanged directory that changed without their files changing,
+        # e.g. that got a Url from the ingest. The signatures of the directory stay as they are.
+        entry = self.directories.get(self.key(directory))
+        if entry is None:
+            return
+        for media_file in presentation.MediaFiles:
+            media_entry = entry["media_files"].get(media_file.FileName)
+            record = media_file_record(media_file)
+            if media_entry is not None and media_entry["record"] != record:
+                media_entry["record"] = record
+                delta.changed_media_files.append(record)
+
+    def remove_missing(self, delta: ImportDelta):
+        # forget directories that were not seen in this import
+        for key in [key for key in self.directories if key not in self._seen]:
+            entry = self.directories.pop(key)
+            delta.removed_presentations.append(entry["presentation"])
+            for media_entry in entry["media_files"].values():
+                delta.removed_media_files.append(media_entry["record"])
+
+    def save(self):
+        # write to a temporary file first, so an interrupted run never leaves a broken manifest
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {"version": MANIFEST_VERSION, "directories": self.directories},
+                f,
+                ensure_ascii=False,
+                indent=1,
+            )
+        os.replace(temp_path, self.path)
+        if os.path.exists(self.legacy_path) and os.path.abspath(self.legacy_path) != os.path.abspath(self.path):
+            os.remove(self.legacy_path)
+
+    def _same_content(self, old_media_entry: dict, media_entry: dict) -> bool:
+        if old_media_entry.get("hash") is not None and media_entry.get("hash") is not None:
+            return old_media_entry["hash"] == media_entry["hash"]
+        return old_media_entry["signature"] == media_entry["signature"]
@@ -0,0 +1,139 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import shutil
+import sys
+
+from model.MediaFileDefinition import MediaFile
+
+# the tools share their media code in src/tools/shared
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from shared.media_queries import LOCAL_URL_PREFIX  # noqa: E402
+from shared.metrics import metrics  # noqa: E402
+
+# the temporary names of download_media.py, which check_media.py does not report as orphans
+COPY_SUFFIX = ".part"
+LINK_SUFFIX = ".link"
+# bytes per copy_file_range/sendfile call, large enough that a video needs only a few
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+
+
+def store_file_name(media_file: MediaFile) -> str:
+    # the name the admin UI gives an uploaded file: the id and the lower case extension
+    return media_file.Id + os.path.splitext(media_file.FileName)[1].lower()
+
+
+def is_up_to_date(source_path: str, target_path: str) -> bool:
+    # the target is the source itself (a hard link), or a copy with its size and mtime
+    try:
+        source = os.stat(source_path)
+        target = os.stat(target_path)
+    except FileNotFoundError:
+        return False
+    if (source.st_dev, source.st_ino) == (target.st_dev, target.st_ino):
+        return True
+    return source.st_size == target.st_size and source.st_mtime_ns == target.st_mtime_ns
+
+
+def copy_file(source_path: str, target_path: str):
+    # Copies in the kernel without passing the data through Python: copy_file_range lets the
+    # file system clone the blocks or copy on the server (btrfs, XFS, NFS 4.2, SMB), sendfile
+    # at least avoids the copies to user space. shutil is the fallback on other systems.
+    with open(source_path, "rb") as source, open(target_path, "wb") as target:
+        size = os.fstat(source.fileno()).st_size
+        for copy in (getattr(os, "copy_file_range", None), getattr(os, "sendfile", None)):
+            if copy is None:
+                continue
+            try:
+                copied = 0
+                while copied < size:
+                    if copy is os.sendfile:
+                        count = copy(target.fileno(), source.fileno(), copied, min(COPY_CHUNK_SIZE, size - copied))
+                    else:
+                        count = copy(source.fileno(), target.fileno(), min(COPY_CHUNK_SIZE, size - copied), copied, copied)
+                    if count == 0:
+                        break
+                    copied += count
+                if copied == size:
+                    return
+            except OSError:
+                # not supported between these file systems, start over with the next way
+                pass
+            target.seek(0)
+            target.truncate()
+        source.seek(0)
+        shutil.copyfileobj(source, target, COPY_CHUNK_SIZE)
+
+
+def ingest_file(source_path: str, target_path: str, link: bool = False) -> str:
+    # Puts one file into the media directory and returns how: "skipped", "linked" or "copied".
+    # The file only appears under its final name when it is complete.
+    if is_up_to_date(source_path, target_path):
+        return "skipped"
+    if link:
+        temp_path = target_path + LINK_SUFFIX
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        try:
+            os.link(source_path, temp_path)
+            os.replace(temp_path, target_path)
+            return "linked"
+        except OSError:
+            # another file system, or one without hard links
+            pass
+    temp_path = target_path + COPY_SUFFIX
+    try:
+        copy_file(source_path, temp_path)
+        # the mtime of the source is what the next run compares with
+        shutil.copystat(source_path, temp_path)
+        os.replace(temp_path, target_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+    return "copied"
+
+
+def ingest_media_files(
+    media_files: list[tuple[MediaFile, str]], media_dir: str, link: bool = False, jobs: int = 4
+) -> list[tuple[str, str]]:
+    # Copies (or hard links) the media files of the import into the media directory of the admin
+    # UI and points their Url to it, like an upload in the admin UI does. Files that are already
+    # there with the same size and mtime are skipped. Media files with an external Url are left
+    # alone. Returns the files that could not be ingested, with the error.
+    os.makedirs(media_dir, exist_ok=True)
+    failures: list[tuple[str, str]] = []
+    pending = []
+    sizes: dict[str, int] = {}
+    for media_file, source_path in media_files:
+        if media_file.Url and not media_file.Url.startswith(LOCAL_URL_PREFIX):
+            continue
+        try:
+            sizes[source_path] = os.path.getsize(source_path)
+        except OSError as e:
+            failures.append((source_path, str(e)))
+            continue
+        pending.append((media_file, source_path))
+    # the largest files first, so a long video does not start last and keep the others waiting
+    pending.sort(key=lambda item: sizes[item[1]], reverse=True)
+
+    def ingest(media_file: MediaFile, source_path: str) -> str:
+        target_path = os.path.join(media_dir, store_file_name(media_file))
+        with metrics.timer("ingest", path=source_path):
+            return ingest_file(source_path, target_path, link)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(ingest, media_file, source_path) for media_file, source_path in pending]
+        for (media_file, source_path), future in zip(pending, futures):
+            try:
+                result = future.result()
+            except OSError as e:
+                print(f"Failed to ingest {source_path}: {e}")
+                metrics.count("errors")
+                failures.append((source_path, str(e)))
+                continue
+            media_file.Url = LOCAL_URL_PREFIX + store_file_name(media_file)
+            media_file.FileName = os.path.basename(source_path)
+            metrics.count(f"ingest_{result}")
+            if result != "skipped":
+                metrics.count("bytes_ingested", sizes[source_path])
+    return failures
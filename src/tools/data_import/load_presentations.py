@@ -0,0 +1,65 @@
+from typing import Iterator
+import os
+import sys
+import uuid
+
+from model.MediaFileDefinition import MediaFile, MediaType
+from model.MultiMediaPresentationDefinition import MultiMediaPresentation
+
+# the tools share their database code in src/tools/shared
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from shared.bulk_loader import BulkLoader  # noqa: E402
+from shared.models import PresentationItem  # noqa: E402
+
+# how long an image is shown if the media file has no duration of its own
+DEFAULT_DURATION_IN_SECONDS = 5
+
+
+def slot_number(media_file: MediaFile) -> int:
+    # slot 0 is audio only, slot 1 the 360 degree dome, slots 2..n are flat displays
+    if media_file.Type == MediaType.Audio:
+        return 0
+    if media_file.Type in (MediaType.Image360Degree, MediaType.Video360Degree):
+        return 1
+    return 2
+
+
+def presentation_item_id(presentation: MultiMediaPresentation, media_file: MediaFile) -> str:
+    # derived from the presentation and the media file, so loading again updates the same row
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{presentation.Id}/{media_file.Id}"))
+
+
+def presentation_rows(presentations: list[MultiMediaPresentation]) -> Iterator[tuple]:
+    for presentation in presentations:
+        yield presentation.to_row()
+
+
+def media_file_rows(presentations: list[MultiMediaPresentation]) -> Iterator[tuple]:
+    for presentation in presentations:
+        for media_file in presentation.MediaFiles:
+            yield media_file.to_row()
+
+
+def presentation_item_rows(presentations: list[MultiMediaPresentation]) -> Iterator[tuple]:
+    for presentation in presentations:
+        sequence_numbers: dict[int, int] = {}
+        for media_file in presentation.MediaFiles:
+            slot = slot_number(media_file)
+            sequence_number = sequence_numbers.get(slot, 0)
+            sequence_numbers[slot] = sequence_number + 1
+            yield PresentationItem(
+                presentation_item_id(presentation, media_file),
+                presentation.Id,
+                media_file.Id,
+                slot,
+                sequence_number,
+                round(media_file.DurationInSeconds or DEFAULT_DURATION_IN_SECONDS),
+            ).to_row()
+
+
+def load_presentations(db_path: str, presentations: list[MultiMediaPresentation]):
+    # upsert the presentations, their media files and presentation items in one transaction
+    with BulkLoader(db_path) as loader:
+        loader.upsert("MultimediaPresentations", presentation_rows(presentations))
+        loader.upsert("MediaFiles", media_file_rows(presentations))
+        loader.upsert("PresentationItems", presentation_item_rows(presentations))
@@ -0,0 +1,140 @@
+import json
+import os
+import threading
+
+from import_manifest import file_signature, state_file_path
+
+METADATA_INDEX_FILE_NAME = ".metadata_index.json"
+METADATA_INDEX_VERSION = 1
+# sidecars written before the import wrote UTF-8 were saved in the Windows code page
+LEGACY_SIDECAR_ENCODING = "cp1252"
+
+
+def read_sidecar_text(meta_data_file_path: str) -> str:
+    # sidecars are written as UTF-8, older ones are read in the encoding they were written in
+    with open(meta_data_file_path, "rb") as f:
+        data = f.read()
+    try:
+        text = data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        text = data.decode(LEGACY_SIDECAR_ENCODING, errors="replace")
+    # line endings as in a file opened in text mode
+    return text.replace("\r\n", "\n")
+
+
+def read_metadata_file(meta_data_file_path: str) -> tuple[str, str, str] | None:
+    # The sidecar format: the first line is the name, the last line is the id (uuid) and all
+    # lines in between are the description, which can be multiple lines or empty.
+    # Returns (name, description, id), or None if the file is empty.
+    lines = read_sidecar_text(meta_data_file_path).splitlines()
+    # check if we have at least 3 lines
+    if len(lines) < 3:
+        print(f"Invalid metadata file {meta_data_file_path}: Needs at least 3 lines but has {len(lines)}")
+    if not lines:
+        return None
+    return lines[0].strip(), "\n".join(lines[1:-1]).strip(), lines[-1].strip()
+
+
+def format_metadata_file(name: str, description: str, id: str) -> str:
+    return name + "\n" + description + "\n" + id + "\n"
+
+
+def write_metadata_file(meta_data_file_path: str, name: str, description: str, id: str) -> bool:
+    # only write if the content changed, so unchanged sidecars keep their modification time
+    content = format_metadata_file(name, description, id)
+    if os.path.exists(meta_data_file_path) and read_sidecar_text(meta_data_file_path) == content:
+        return False
+    with open(meta_data_file_path, "w", encoding="utf-8") as f:
+        f.write(content)
+    return True
+
+
+class MetadataIndex:
+    """The contents of all sidecars of a tree in one file, read once per import.
+
+    Usage:
+        index = MetadataIndex(base_path)
+        metadata = index.read(media_file_path + ".txt")
+        index.write(media_file_path + ".txt", name, description, id)
+        index.save()
+
+    The sidecars stay the source of the metadata: every entry remembers the size and
+    modification time of its sidecar, and a sidecar that was edited since is read again.
+    A sidecar is only written when its metadata changed, and the index only saved when
+    one of its entries did.
+    """
+
+    def __init__(self, base_path: str, path: str | None = None):
+        self.base_path = base_path
+        self.path = path or state_file_path(base_path, METADATA_INDEX_FILE_NAME)
+        # where earlier versions kept the index, it is removed by the next save
+        self.legacy_path = os.path.join(base_path, METADATA_INDEX_FILE_NAME)
+        # sidecar path relative to the base path -> {"sidecar": [size, mtime], "metadata": [name, description, id]}
+        self.entries: dict[str, dict] = {}
+        self.changed = False
+        self._lock = threading.Lock()
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == METADATA_INDEX_VERSION:
+                self.entries = data["entries"]
+
+    def key(self, meta_data_file_path: str) -> str:
+        return os.path.relpath(meta_data_file_path, self.base_path)
+
+    def read(self, meta_data_file_path: str) -> tuple[str, str, str] | None:
+        # (name, description, id) of the sidecar, None if there is none
+        signature = file_signature(meta_data_file_path)
+        key = self.key(meta_data_file_path)
+        with self._lock:
+            if signature is None:
+                if self.entries.pop(key, None) is not None:
+                    self.changed = True
+                return None
+            entry = self.entries.get(key)
+        if entry is not None and entry["sidecar"] == signature:
+            return tuple(entry["metadata"])
+
+        metadata = read_metadata_file(meta_data_file_path)
+        with self._lock:
+            if metadata is None:
+                self.entries.pop(key, None)
+            else:
+                self.entries[key] = {"sidecar": signature, "metadata": list(metadata)}
+            self.changed = True
+        return metadata
+
+    def write(self, meta_data_file_path: str, name: str, description: str, id: str) -> bool:
+        # write the sidecar if its metadata changed since it was read
+        key = self.key(meta_data_file_path)
+        with self._lock:
+            entry = self.entries.get(key)
+        if entry is not None and entry["metadata"] == [name, description, id]:
+            return False
+        with open(meta_data_file_path, "w", encoding="utf-8") as f:
+            f.write(format_metadata_file(name, description, id))
+        with self._lock:
+            self.entries[key] = {
+                "sidecar": file_signature(meta_data_file_path),
+                "metadata": [name, description, id],
+            }
+            self.changed = True
+        return True
+
+    def save(self):
+        if not self.changed:
+            return
+        # write to a temporary file first, so an interrupted run never leaves a broken index
+        temp_path = self.path + ".tmp"
+        with self._lock:
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(
+                    {"version": METADATA_INDEX_VERSION, "entries": self.entries},
+                    f,
+                    ensure_ascii=False,
+                    indent=1,
+                )
+            os.replace(temp_path, self.path)
+            self.changed = False
+        if os.path.exists(self.legacy_path) and os.path.abspath(self.legacy_path) != os.path.abspath(self.path):
+            os.remove(self.legacy_path)
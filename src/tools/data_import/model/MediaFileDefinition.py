@@ -1,17 +1,6 @@
-class MediaType:
-    Image2D = 0
-    Image3D = 1
-    Image360Degree = 2
-    Video2D = 3
-    Video3D = 4
-    Video360Degree = 5
-    Audio = 6
+import os
+import sys
 
-
-class MediaFile:
-    Id: str
-    Name: str
-    Description: str
-    FileName: str
-    Type: int
-    Url: str
+# the models are shared with the other tools in src/tools/shared
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from shared.models import MediaFile, MediaType  # noqa: E402, F401
@@ -1,8 +1,6 @@
-from model.MediaFileDefinition import MediaFile
+import os
+import sys
 
-
-class MultiMediaPresentation:
-    Id: str
-    Name: str
-    Description: str
-    MediaFiles: list[MediaFile]
+# the models are shared with the other tools in src/tools/shared
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from shared.models import MultiMediaPresentation  # noqa: E402, F401
@@ -0,0 +1,88 @@
+import argparse
+import os
+import sqlite3
+import sys
+import time
+
+# the tools share their database code in src/tools/shared
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from shared.geo_index import FLAG_PLACEHOLDER_COORDINATES, GeoEventIndex, from_ticks  # noqa: E402
+
+
+def build(db_path: str, force: bool = False) -> int:
+    started = time.perf_counter()
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        reports = GeoEventIndex(conn).build(force)
+    finally:
+        conn.close()
+    placeholders = 0
+    for report in reports:
+        state = "indexed" if report.rebuilt else "unchanged"
+        print(f"Time series {report.time_series_id}: {report.event_count} events, {state}")
+        if report.placeholder_count:
+            # left by media_parser, these events still have to be placed on the map
+            print(f"  {report.placeholder_count} events have the placeholder position 0/0")
+        if report.invalid_date_time_count:
+            print(f"  {report.invalid_date_time_count} events have a DateTime that cannot be read")
+        placeholders += report.placeholder_count
+    rebuilt = sum(1 for report in reports if report.rebuilt)
+    print(
+        f"{rebuilt} of {len(reports)} time series indexed, {placeholders} events at 0/0, "
+        f"in {time.perf_counter() - started:.2f}s"
+    )
+    return placeholders
+
+
+def query(db_path: str, args: argparse.Namespace):
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        started = time.perf_counter()
+        rows = GeoEventIndex(conn).query(
+            args.time_series_id,
+            tuple(args.bbox) if args.bbox else None,
+            args.start,
+            args.end,
+            args.include_placeholders,
+            args.limit,
+        )
+        elapsed = time.perf_counter() - started
+    finally:
+        conn.close()
+    for row in rows:
+        date_time = from_ticks(row["Ticks"]).isoformat() if row["Ticks"] is not None else "?"
+        placeholder = " (placeholder)" if row["Flags"] & FLAG_PLACEHOLDER_COORDINATES else ""
+        print(f"{date_time}  {row['Latitude']:.6f} {row['Longitude']:.6f}  {row['GeoEventId']}{placeholder}")
+    print(f"{len(rows)} events in {elapsed * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Spatio-temporal index of the geo events of every time series.")
+    parser.add_argument("db", help="Path to virtualmuseum.db")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build_parser = commands.add_parser("build", help="Index the time series whose events changed")
+    build_parser.add_argument("--force", action="store_true", help="Index all time series again")
+    build_parser.add_argument(
+        "--fail-on-placeholders", action="store_true", help="Exit with 1 if events are at the placeholder position 0/0"
+    )
+    query_parser = commands.add_parser("query", help="Find the events of a time series in a viewport and time window")
+    query_parser.add_argument("time_series_id")
+    query_parser.add_argument(
+        "--bbox",
+        nargs=4,
+        type=float,
+        metavar=("MIN_LAT", "MIN_LON", "MAX_LAT", "MAX_LON"),
+        help="Only events inside this bounding box",
+    )
+    query_parser.add_argument("--start", help="Only events at or after this time, e.g. 1500-01-01")
+    query_parser.add_argument("--end", help="Only events at or before this time")
+    query_parser.add_argument(
+        "--include-placeholders", action="store_true", help="Also list events at 0/0 (without --bbox)"
+    )
+    query_parser.add_argument("--limit", type=int)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        placeholders = build(args.db, args.force)
+        sys.exit(1 if placeholders and args.fail_on_placeholders else 0)
+    query(args.db, args)
@@ -1,159 +1,215 @@
-﻿from datetime import datetime
+﻿from contextlib import ExitStack, nullcontext
+from datetime import datetime
+from typing import Iterator
+import argparse
+import csv
 import os
+import sys
 import uuid
 
+from url_verifier import UrlVerifier
+
+# the tools share their database code in src/tools/shared
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from shared.bulk_loader import BulkLoader  # noqa: E402
+from shared.media_probe import probe_media_file  # noqa: E402
+from shared.models import (  # noqa: E402
+    GeoEvent,
+    GeoEventGroup,
+    MediaFile,
+    MediaType,
+    MultiMediaPresentation,
+    PresentationItem,
+)
+
 base_path = "C:\\Users\\tobia\\Downloads\\wetransfer_360-grad-fotos_2024-09-10_1643\\"
 base_url = "https://timeglide-vr.b-cdn.net/wetransfer_360-grad-fotos_2024-09-10_1643/"
 time_series_id = "8c472a83-e961-4bd3-b6f3-562964e322c4"
 
 
-class GeoEventGroup:
-    def __init__(self, id: str, label: str, time_series_id: str):
-        self.id = id
-        self.label = label
-
-
-class GeoEvent:
-    def __init__(
-        self,
-        id: str,
-        multimedia_presentation_id: str,
-        event_group_id,
-        name: str,
-        latitude: float,
-        longitude: float,
-        date_time: datetime,
-    ):
-        self.id = id
-        self.multimedia_presentation_id = multimedia_presentation_id
-        self.event_group_id = event_group_id
-        self.name = name
-        self.latitude = latitude
-        self.longitude = longitude
-        self.date_time = date_time
-
-
-class MultimediaPresentation:
-    def __init__(self, id: str, name: str):
-        self.id = id
-        self.name = name
-
-
-class PresentationItem:
-    def __init__(
-        self,
-        id: str,
-        media_file_id: str,
-        multimedia_presentation_id: str,
-        sequence: int,
-    ):
-        self.id = id
-        self.media_file_id = media_file_id
-        self.multimedia_presentation_id = multimedia_presentation_id
-        self.sequence = sequence
-
-
-class MediaFile:
-    def __init__(self, id: str, url: str, name: str, group: str):
-        self.id = id
-        self.url = url
-        self.name = name
-        self.group = group
-
+class ScannedMediaFile(MediaFile):
+    # a media file with where it was found
+    __slots__ = ("group", "path")
 
-def read_all_media_files(base_path: str, verify: bool = False) -> list[MediaFile]:
-    result = []
-    for _, _, files in os.walk(base_path):
-        for file in files:
-            if file.endswith(".jpg"):
-                url = base_url + file.replace(" ", "%20")
-                # verify that the url is reachable, suppress output
-                if (not verify) or (os.system(f"curl -I {url} > nul") == 0):
+    def __init__(self, id: str, url: str, name: str, group: str, path: str | None = None):
+        super().__init__(id, name, name, name, Url=url)
+        self.group = group
+        # the local copy of the file
+        self.path = path
+
+    def media_type(self) -> MediaType:
+        # the photos are 360 degree photos unless their header says otherwise
+        media_info = probe_media_file(self.path) if self.path else None
+        if media_info is None or media_info.is_equirectangular:
+            return MediaType.Image360Degree
+        return MediaType.Image2D
+
+
+def iter_media_files(
+    base_path: str, verify: bool = False, verify_batch_size: int = 256
+) -> Iterator[ScannedMediaFile]:
+    verifier = UrlVerifier() if verify else None
+    with verifier or nullcontext():
+        batch: list[ScannedMediaFile] = []
+        for root, _, files in os.walk(base_path):
+            for file in files:
+                if file.endswith(".jpg"):
+                    url = base_url + file.replace(" ", "%20")
                     # the first characters until the first space are the group of the image
                     group = file.split(" ")[0]
-                    result.append(MediaFile(str(uuid.uuid4()), url, file, group))
-                else:
-                    print(f"File {url} is not reachable")
-    return result
-
-
-def create_groesste_staedte():
-    media_files = read_all_media_files(base_path)
-    groups = set([media_file.group for media_file in media_files])
-
-    multimedia_presentations = []
-    geo_events = []
-    presentation_items = []
-    geo_event_groups = []
-
-    for group in groups:
-        print(f"Group {group}:")
-
-        # create a multimedia presentation for each group
-        multimedia_presentation = MultimediaPresentation(str(uuid.uuid4()), group)
-        multimedia_presentations.append(multimedia_presentation)
-        geo_event_group = GeoEventGroup(str(uuid.uuid4()), group, time_series_id)
-        geo_event_groups.append(geo_event_group)
-        geo_event = GeoEvent(
-            str(uuid.uuid4()),
-            multimedia_presentation.id,
-            geo_event_group.id,
-            group,
-            0,
-            0,
-            datetime.now(),
+                    media_file = ScannedMediaFile(
+                        str(uuid.uuid4()), url, file, group, os.path.join(root, file)
+                    )
+                    if not verify:
+                        yield media_file
+                        continue
+                    batch.append(media_file)
+                    if len(batch) >= verify_batch_size:
+                        yield from verify_media_files(verifier, batch)
+                        batch = []
+        if batch:
+            yield from verify_media_files(verifier, batch)
+
+
+def verify_media_files(
+    verifier: UrlVerifier, media_files: list[ScannedMediaFile]
+) -> Iterator[ScannedMediaFile]:
+    # verify that the urls are reachable, all at once
+    statuses = verifier.verify(media_file.Url for media_file in media_files)
+    for media_file in media_files:
+        status = statuses[media_file.Url]
+        if status.reachable:
+            yield media_file
+        else:
+            print(f"File {media_file.Url} is not reachable ({status.error or status.status})")
+
+
+def read_all_media_files(base_path: str, verify: bool = False) -> list[ScannedMediaFile]:
+    return list(iter_media_files(base_path, verify))
+
+
+def open_csv_writer(stack: ExitStack, file_name: str, header: list[str]):
+    f = stack.enter_context(open(file_name, "w", newline="", encoding="utf-8-sig"))
+    writer = csv.writer(f)
+    writer.writerow(header)
+    return writer
+
+
+class SqliteRowWriter:
+    # writerow() like csv.writer, but upserts the rows in chunks through a BulkLoader
+    def __init__(self, loader: BulkLoader, table: str, columns: list[str], chunk_size: int = 1000):
+        self.loader = loader
+        self.table = table
+        self.columns = columns
+        self.chunk_size = chunk_size
+        self.rows: list[tuple] = []
+
+    def writerow(self, row: tuple):
+        self.rows.append(row)
+        if len(self.rows) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.loader.upsert(self.table, self.rows, self.columns)
+            self.rows = []
+
+
+def open_row_writer(
+    stack: ExitStack,
+    loader: BulkLoader | None,
+    file_name: str,
+    model: type,
+    header: list[str] | None = None,
+):
+    # rows are the to_row() of the model. With a loader they go straight into the database,
+    # otherwise into a csv file whose header defaults to the columns of the table.
+    if loader is None:
+        return open_csv_writer(stack, file_name, header or list(model.COLUMNS))
+    writer = SqliteRowWriter(loader, model.TABLE, list(model.COLUMNS))
+    stack.callback(writer.flush)
+    return writer
+
+
+def create_groesste_staedte(db_path: str | None = None):
+    # every row is written as soon as it is known, only the groups are kept in memory
+    with ExitStack() as stack:
+        loader = stack.enter_context(BulkLoader(db_path)) if db_path else None
+        multimedia_presentations_csv = open_row_writer(
+            stack, loader, "multimedia_presentations.csv", MultiMediaPresentation
         )
-        geo_events.append(geo_event)
-
-        # create a presentation item for each media file in the group
-        for i, media_file in enumerate(media_files):
-            if media_file.group == group:
-                presentation_item = PresentationItem(
-                    str(uuid.uuid4()), media_file.id, multimedia_presentation.id, i
-                )
-                presentation_items.append(presentation_item)
-
-    # write some csv files
-    with open(f"multimedia_presentations.csv", "w") as f:
-        f.write("Id,Name,Description\n")
-        for multimedia_presentation in multimedia_presentations:
-            f.write(
-                f"{multimedia_presentation.id},{multimedia_presentation.name},{multimedia_presentation.name}\n"
-            )
-
-    with open(f"geo_events.csv", "w") as f:
-        f.write(
-            "Id,GeoEventGroupId,MultiMediaPresentationId,Name,Description,DateTime,Latitude,Longitude\n"
+        geo_events_csv = open_row_writer(
+            stack,
+            loader,
+            "geo_events.csv",
+            GeoEvent,
+            # the csv calls the label "Name"
+            [
+                "Id",
+                "GeoEventGroupId",
+                "MultiMediaPresentationId",
+                "Name",
+                "Description",
+                "DateTime",
+                "Latitude",
+                "Longitude",
+            ],
         )
-        for geo_event in geo_events:
-            f.write(
-                f"{geo_event.id},{geo_event.event_group_id},{geo_event.multimedia_presentation_id},{geo_event.name},{geo_event.name},{geo_event.date_time},{geo_event.latitude},{geo_event.longitude}\n"
-            )
-
-    with open(f"presentation_items.csv", "w") as f:
-        f.write(
-            "Id,MultiMediaPresentationId,MediaFileId,SlotNumber,SequenceNumber,DurationInSeconds\n"
+        presentation_items_csv = open_row_writer(
+            stack, loader, "presentation_items.csv", PresentationItem
         )
-        for presentation_item in presentation_items:
-            f.write(
-                f"{presentation_item.id},{presentation_item.multimedia_presentation_id},{presentation_item.media_file_id},2,{presentation_item.sequence},5\n"
-            )
-    with open(f"geo_event_groups.csv", "w") as f:
-        f.write("Id,Name,Description,TimeSeriesId\n")
-        for geo_event_group in geo_event_groups:
-            f.write(
-                f"{geo_event_group.id},{geo_event_group.label},{geo_event_group.label},{time_series_id}\n"
-            )
-
-    with open(f"media_files.csv", "w") as f:
-        f.write("Id,FileName,Name, Description,DurationInSeconds,Type,Url\n")
-        for media_file in media_files:
-            f.write(
-                f"{media_file.id},{media_file.name},{media_file.name},{media_file.name},0,2,{media_file.url}\n"
+        geo_event_groups_csv = open_row_writer(
+            stack,
+            loader,
+            "geo_event_groups.csv",
+            GeoEventGroup,
+            # the csv calls the label "Name"
+            ["Id", "Name", "Description", "TimeSeriesId"],
+        )
+        media_files_csv = open_row_writer(stack, loader, "media_files.csv", MediaFile)
+
+        # group -> (multimedia presentation, number of presentation items so far)
+        groups: dict[str, list] = {}
+
+        for media_file in iter_media_files(base_path):
+            media_file.Type = media_file.media_type()
+            media_files_csv.writerow(media_file.to_row())
+
+            if media_file.group not in groups:
+                group = media_file.group
+                print(f"Group {group}:")
+
+                # create a multimedia presentation for each group
+                multimedia_presentation = MultiMediaPresentation(str(uuid.uuid4()), group, group)
+                geo_event_group = GeoEventGroup(str(uuid.uuid4()), group, group, time_series_id)
+                geo_event = GeoEvent(
+                    str(uuid.uuid4()),
+                    geo_event_group.Id,
+                    multimedia_presentation.Id,
+                    group,
+                    group,
+                    datetime.now(),
+                    0,
+                    0,
+                )
+                multimedia_presentations_csv.writerow(multimedia_presentation.to_row())
+                geo_event_groups_csv.writerow(geo_event_group.to_row())
+                geo_events_csv.writerow(geo_event.to_row())
+                groups[group] = [multimedia_presentation, 0]
+
+            # create a presentation item for each media file in the group
+            multimedia_presentation, sequence = groups[media_file.group]
+            presentation_item = PresentationItem(
+                str(uuid.uuid4()), multimedia_presentation.Id, media_file.Id, 2, sequence, 5
             )
-
-
+            groups[media_file.group][1] = sequence + 1
+            presentation_items_csv.writerow(presentation_item.to_row())
 
 
 if __name__ == "__main__":
-    create_groesste_staedte()
+    parser = argparse.ArgumentParser(description="Create the groesste staedte presentations.")
+    parser.add_argument(
+        "--db", help="Load the rows into this virtualmuseum.db instead of writing csv files"
+    )
+    args = parser.parse_args()
+    create_groesste_staedte(args.db)
@@ -0,0 +1,181 @@
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from typing import Iterable, Optional
+from urllib.parse import urljoin, urlsplit
+import http.client
+import threading
+import time
+
+# longest wait before a retry, also when the server asks for more with Retry-After
+MAX_RETRY_DELAY = 60.0
+# redirects followed to the file, like curl -L
+MAX_REDIRECTS = 5
+REDIRECT_STATUS = {301, 302, 303, 307, 308}
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    # a Retry-After header (seconds or an HTTP date) in seconds from now
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class UrlStatus:
+    def __init__(
+        self,
+        url: str,
+        status: Optional[int],
+        size: Optional[int],
+        error: Optional[str] = None,
+    ):
+        self.url = url
+        self.status = status
+        self.size = size
+        self.error = error
+
+    @property
+    def reachable(self) -> bool:
+        return self.status is not None and 200 <= self.status < 300
+
+
+class UrlVerifier:
+    """Checks URLs with HEAD requests from a thread pool.
+
+    Every worker thread keeps one keep-alive connection per host, so a folder on the CDN
+    costs one TLS handshake per thread instead of one per file. Used as a context manager,
+    the threads, their connections and the time budget are shared by all verify() calls.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 16,
+        retries: int = 2,
+        timeout: float = 10.0,
+        budget: Optional[float] = None,
+    ):
+        self.max_workers = max_workers
+        self.retries = retries
+        self.timeout = timeout
+        # total number of seconds for the whole run (or for a verify() call outside of a with
+        # block), remaining urls are reported as not checked
+        self.budget = budget
+        self._local = threading.local()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._deadline: Optional[float] = None
+        # the connections of all threads, so they can be closed at the end
+        self._connections: set[http.client.HTTPConnection] = set()
+        self._connections_lock = threading.Lock()
+
+    # keep the worker threads (and their connections) alive across several verify() calls
+    def __enter__(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self._deadline = None if self.budget is None else time.monotonic() + self.budget
+        return self
+
+    def __exit__(self, *exc_info):
+        self._executor.shutdown()
+        self._executor = None
+        self._deadline = None
+        self.close()
+
+    def close(self):
+        with self._connections_lock:
+            connections, self._connections = self._connections, set()
+        for connection in connections:
+            connection.close()
+
+    def verify(self, urls: Iterable[str]) -> dict[str, UrlStatus]:
+        urls = list(dict.fromkeys(urls))
+        if self._executor is not None:
+            results = self._executor.map(lambda url: self._check(url, self._deadline), urls)
+            return {result.url: result for result in results}
+        deadline = None if self.budget is None else time.monotonic() + self.budget
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                results = executor.map(lambda url: self._check(url, deadline), urls)
+                return {result.url: result for result in results}
+        finally:
+            self.close()
+
+    def _check(self, url: str, deadline: Optional[float]) -> UrlStatus:
+        error = None
+        retry_after = None
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                delay = min(0.5 * 2 ** (attempt - 1), 5)
+                # wait at least as long as the server asked for
+                if retry_after is not None:
+                    delay = max(delay, min(retry_after, MAX_RETRY_DELAY))
+                if deadline is not None and time.monotonic() + delay >= deadline:
+                    break
+                time.sleep(delay)
+            if deadline is not None and time.monotonic() >= deadline:
+                return UrlStatus(url, None, None, error or "timeout budget exceeded")
+            try:
+                status, size, retry_after = self._head_following_redirects(url)
+                # retry throttling and server errors, everything else is a final answer
+                if status != 429 and status < 500:
+                    return UrlStatus(url, status, size)
+                error = f"HTTP {status}"
+            except (OSError, http.client.HTTPException) as e:
+                self._drop_connection(url)
+                retry_after = None
+                error = str(e) or type(e).__name__
+        return UrlStatus(url, None, None, error)
+
+    def _head_following_redirects(self, url: str) -> tuple[int, Optional[int], Optional[float]]:
+        # the answer of the url the redirects lead to
+        for _ in range(MAX_REDIRECTS):
+            status, size, retry_after, location = self._head(url)
+            if status not in REDIRECT_STATUS or not location:
+                return status, size, retry_after
+            url = urljoin(url, location)
+        raise http.client.HTTPException(f"more than {MAX_REDIRECTS} redirects")
+
+    def _head(self, url: str) -> tuple[int, Optional[int], Optional[float], Optional[str]]:
+        parts = urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        connection = self._get_connection(parts.scheme, parts.netloc)
+        connection.request("HEAD", path)
+        response = connection.getresponse()
+        response.read()
+        if response.will_close:
+            self._drop_connection(url)
+        length = response.getheader("Content-Length")
+        return (
+            response.status,
+            int(length) if length and length.isdigit() else None,
+            parse_retry_after(response.getheader("Retry-After")),
+            response.getheader("Location"),
+        )
+
+    def _get_connection(self, scheme: str, netloc: str) -> http.client.HTTPConnection:
+        connections = getattr(self._local, "connections", None)
+        if connections is None:
+            connections = self._local.connections = {}
+        key = (scheme, netloc)
+        if key not in connections:
+            connection_class = (
+                http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+            )
+            connections[key] = connection_class(netloc, timeout=self.timeout)
+            with self._connections_lock:
+                self._connections.add(connections[key])
+        return connections[key]
+
+    def _drop_connection(self, url: str):
+        parts = urlsplit(url)
+        connections = getattr(self._local, "connections", {})
+        connection = connections.pop((parts.scheme, parts.netloc), None)
+        if connection is not None:
+            with self._connections_lock:
+                self._connections.discard(connection)
+            connection.close()
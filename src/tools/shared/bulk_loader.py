@@ -0,0 +1,99 @@
+from typing import Iterable, Sequence
+import sqlite3
+import time
+
+from shared.models import MODELS
+
+# columns of the tables the import tools write, as in the schema of virtualmuseum.db
+TABLE_COLUMNS = {model.TABLE: list(model.COLUMNS) for model in MODELS}
+# other names of these columns in older databases
+COLUMN_ALIASES = {model.TABLE: getattr(model, "COLUMN_ALIASES", {}) for model in MODELS}
+# columns whose value in the database is kept when the row brings an empty one
+KEEP_EXISTING = {model.TABLE: getattr(model, "KEEP_EXISTING", ()) for model in MODELS}
+
+
+def update_expression(column: str, keep_existing: bool) -> str:
+    if keep_existing:
+        return f'"{column}" = COALESCE(NULLIF(excluded."{column}", \'\'), "{column}")'
+    return f'"{column}" = excluded."{column}"'
+
+
+def upsert_statement(table: str, columns: Sequence[str]) -> str:
+    column_list = ", ".join(f'"{column}"' for column in columns)
+    placeholders = ", ".join("?" for _ in columns)
+    keep = KEEP_EXISTING.get(table, ())
+    updates = ", ".join(update_expression(column, column in keep) for column in columns if column != "Id")
+    return (
+        f'INSERT INTO "{table}" ({column_list}) VALUES ({placeholders}) '
+        f'ON CONFLICT("Id") DO UPDATE SET {updates}'
+    )
+
+
+class BulkLoader:
+    """Upserts rows into virtualmuseum.db in a single transaction.
+
+    Usage:
+        with BulkLoader(db_path) as loader:
+            loader.upsert("MediaFiles", rows)
+
+    Everything written inside the with block is committed together, or not at all if an
+    exception is raised. While loading, the connection trades durability for speed: the
+    transaction is only synced once at the commit, and sorting/indexing happens in memory.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.counts: dict[str, int] = {}
+        # lower case column names of every table written so far, sqlite ignores their case
+        self._table_columns: dict[str, set[str]] = {}
+        self._conn: sqlite3.Connection | None = None
+        self._started = 0.0
+
+    def __enter__(self):
+        # autocommit mode, the transaction is controlled explicitly below
+        self._conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        # these pragmas only apply to this connection and end with it
+        self._conn.execute("PRAGMA synchronous = OFF")
+        self._conn.execute("PRAGMA temp_store = MEMORY")
+        self._conn.execute("PRAGMA cache_size = -65536")
+        self._conn.execute("BEGIN IMMEDIATE")
+        self._started = time.perf_counter()
+        return self
+
+    def resolve_columns(self, table: str, columns: Sequence[str]) -> list[str]:
+        # a column the table does not have is written under its alias, if the table has that
+        if table not in self._table_columns:
+            rows = self._conn.execute(f'PRAGMA table_info("{table}")').fetchall()
+            self._table_columns[table] = {row[1].lower() for row in rows}
+        existing = self._table_columns[table]
+        aliases = COLUMN_ALIASES.get(table, {})
+        return [
+            aliases[column]
+            if column.lower() not in existing and aliases.get(column, "").lower() in existing
+            else column
+            for column in columns
+        ]
+
+    def upsert(self, table: str, rows: Iterable[Sequence], columns: Sequence[str] | None = None) -> int:
+        # rows are tuples in the order of TABLE_COLUMNS[table] (or of columns, if given).
+        # executemany prepares the statement once and binds every row to it.
+        columns = self.resolve_columns(table, columns or TABLE_COLUMNS[table])
+        cursor = self._conn.executemany(upsert_statement(table, columns), rows)
+        count = cursor.rowcount if cursor.rowcount >= 0 else 0
+        self.counts[table] = self.counts.get(table, 0) + count
+        return count
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self._conn.execute("COMMIT")
+                elapsed = time.perf_counter() - self._started
+                loaded = ", ".join(f"{count} {table}" for table, count in self.counts.items())
+                print(f"Loaded {loaded or 'nothing'} into {self.db_path} in {elapsed:.2f}s")
+            else:
+                self._conn.execute("ROLLBACK")
+                print(f"Load into {self.db_path} rolled back: {exc_value}")
+        finally:
+            self._conn.close()
+            self._conn = None
+        return False
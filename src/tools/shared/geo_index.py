@@ -0,0 +1,290 @@
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+import hashlib
+import re
+import sqlite3
+
+# .NET DateTime.Ticks: 100 ns since 0001-01-01, sortable as an integer and the same on the server
+TICKS_PER_SECOND = 10_000_000
+TICKS_PER_DAY = 86_400 * TICKS_PER_SECOND
+# EF stores DateTime as "2024-09-11 01:07:13.488149", imports also wrote "873-01-01T00:00:00"
+DATE_TIME_PATTERN = re.compile(
+    r"^\s*(\d{1,4})(?:-(\d{1,2})(?:-(\d{1,2})(?:[T ](\d{1,2}):(\d{2})(?::(\d{2})(?:\.(\d{1,7}))?)?)?)?)?"
+)
+
+# entry flags
+FLAG_PLACEHOLDER_COORDINATES = 1
+FLAG_INVALID_DATE_TIME = 2
+
+SERIES_TABLE = "GeoEventIndexSeries"
+ENTRIES_TABLE = "GeoEventIndexEntries"
+BOXES_TABLE = "GeoEventIndexBoxes"
+INDEX_SCHEMA = [
+    f"""CREATE TABLE IF NOT EXISTS "{SERIES_TABLE}" (
+        "SeriesNo" INTEGER PRIMARY KEY,
+        "TimeSeriesId" TEXT NOT NULL UNIQUE,
+        "Signature" TEXT NOT NULL,
+        "EventCount" INTEGER NOT NULL,
+        "PlaceholderCount" INTEGER NOT NULL,
+        "MinTicks" INTEGER NULL,
+        "MaxTicks" INTEGER NULL,
+        "BuiltAt" TEXT NOT NULL
+    )""",
+    f"""CREATE TABLE IF NOT EXISTS "{ENTRIES_TABLE}" (
+        "EntryNo" INTEGER PRIMARY KEY,
+        "SeriesNo" INTEGER NOT NULL,
+        "GeoEventId" TEXT NOT NULL,
+        "Ticks" INTEGER NULL,
+        "Latitude" REAL NOT NULL,
+        "Longitude" REAL NOT NULL,
+        "Flags" INTEGER NOT NULL
+    )""",
+    f'CREATE INDEX IF NOT EXISTS "IX_{ENTRIES_TABLE}_SeriesNo_Ticks" ON "{ENTRIES_TABLE}" ("SeriesNo", "Ticks")',
+    # series, time and position as the dimensions of one R*-tree. Its coordinates are 32 bit
+    # floats rounded outwards, so it finds candidates and the entries decide exactly.
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS "{BOXES_TABLE}" USING rtree(
+        "EntryNo", "MinSeries", "MaxSeries", "MinTicks", "MaxTicks",
+        "MinLatitude", "MaxLatitude", "MinLongitude", "MaxLongitude"
+    )""",
+]
+
+
+def to_ticks(value: str | datetime | None) -> int | None:
+    # the ticks of a stored DateTime or a datetime, None if it cannot be read
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        fraction = value.microsecond * 10
+        value = value.replace(microsecond=0)
+    else:
+        match = DATE_TIME_PATTERN.match(value)
+        if not match:
+            return None
+        year, month, day, hour, minute, second, fraction_text = match.groups()
+        try:
+            # a year or month alone, as in a time window, is its first day
+            value = datetime(
+                int(year), int(month or 1), int(day or 1), int(hour or 0), int(minute or 0), int(second or 0)
+            )
+        except ValueError:
+            return None
+        fraction = int((fraction_text or "").ljust(7, "0"))
+    seconds = value.hour * 3600 + value.minute * 60 + value.second
+    return (value.toordinal() - 1) * TICKS_PER_DAY + seconds * TICKS_PER_SECOND + fraction
+
+
+def from_ticks(ticks: int) -> datetime:
+    return datetime(1, 1, 1) + timedelta(microseconds=ticks // 10)
+
+
+def is_placeholder_position(latitude: float, longitude: float) -> bool:
+    # media_parser creates its geo events at 0/0 until someone places them on the map
+    return latitude == 0 and longitude == 0
+
+
+@dataclass
+class SeriesReport:
+    time_series_id: str
+    event_count: int
+    placeholder_count: int
+    invalid_date_time_count: int
+    rebuilt: bool
+
+
+class GeoEventIndex:
+    """A spatio-temporal index of the geo events of every time series, kept in virtualmuseum.db.
+
+    Usage:
+        index = GeoEventIndex(conn)
+        index.build()
+        rows = index.query(time_series_id, bbox=(50.0, 10.0, 51.0, 11.5), start="1500-01-01", end="1600-01-01")
+
+    The DateTime of every event is normalized to .NET ticks. An R*-tree over series, time and
+    position answers viewport and time slider lookups without reading the other events of the
+    series. A series is only indexed again when one of its events changed. Events at the 0/0
+    placeholder position are flagged and left out of bounding box lookups.
+    """
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+    def create(self):
+        with self.conn:
+            for statement in INDEX_SCHEMA:
+                self.conn.execute(statement)
+
+    def read_series(self) -> dict[str, list[tuple]]:
+        # time series id -> its events, ids compared case-insensitively like the API does
+        series_by_group = {
+            str(group_id).lower(): str(time_series_id).lower()
+            for group_id, time_series_id in self.conn.execute(
+                'SELECT "Id", "TimeSeriesId" FROM "GeoEventGroups" WHERE "TimeSeriesId" IS NOT NULL'
+            )
+        }
+        events: dict[str, list[tuple]] = {}
+        for row in self.conn.execute(
+            'SELECT "Id", "GeoEventGroupId", "DateTime", "Latitude", "Longitude" FROM "GeoEvents" ORDER BY "Id"'
+        ):
+            time_series_id = series_by_group.get(str(row[1]).lower())
+            if time_series_id is not None:
+                events.setdefault(time_series_id, []).append((row[0], row[2], row[3], row[4]))
+        return events
+
+    def build(self, force: bool = False) -> list[SeriesReport]:
+        self.create()
+        built = {
+            row[0]: (row[1], row[2])
+            for row in self.conn.execute(f'SELECT "TimeSeriesId", "SeriesNo", "Signature" FROM "{SERIES_TABLE}"')
+        }
+        reports = []
+        with self.conn:
+            for time_series_id, events in sorted(self.read_series().items()):
+                signature = hashlib.sha256(repr(events).encode("utf-8")).hexdigest()
+                series_no, old_signature = built.pop(time_series_id, (None, None))
+                if not force and signature == old_signature:
+                    row = self.conn.execute(
+                        f'SELECT "EventCount", "PlaceholderCount", '
+                        f'(SELECT count(*) FROM "{ENTRIES_TABLE}" WHERE "SeriesNo" = ? AND "Flags" & ?) '
+                        f'FROM "{SERIES_TABLE}" WHERE "SeriesNo" = ?',
+                        (series_no, FLAG_INVALID_DATE_TIME, series_no),
+                    ).fetchone()
+                    reports.append(SeriesReport(time_series_id, row[0], row[1], row[2], False))
+                    continue
+                reports.append(self.build_series(time_series_id, series_no, signature, events))
+            # series without events any more
+            for series_no, _ in built.values():
+                self.delete_series(series_no)
+                self.conn.execute(f'DELETE FROM "{SERIES_TABLE}" WHERE "SeriesNo" = ?', (series_no,))
+        return reports
+
+    def delete_series(self, series_no: int):
+        self.conn.execute(f'DELETE FROM "{BOXES_TABLE}" WHERE "MinSeries" = ? AND "MaxSeries" = ?', (series_no, series_no))
+        self.conn.execute(f'DELETE FROM "{ENTRIES_TABLE}" WHERE "SeriesNo" = ?', (series_no,))
+
+    def build_series(self, time_series_id: str, series_no: int | None, signature: str, events: list[tuple]) -> SeriesReport:
+        entries = []
+        for geo_event_id, date_time, latitude, longitude in events:
+            ticks = to_ticks(date_time)
+            flags = 0
+            if is_placeholder_position(latitude, longitude):
+                flags |= FLAG_PLACEHOLDER_COORDINATES
+            if ticks is None:
+                flags |= FLAG_INVALID_DATE_TIME
+            entries.append((geo_event_id, ticks, latitude, longitude, flags))
+        placeholder_count = sum(1 for entry in entries if entry[4] & FLAG_PLACEHOLDER_COORDINATES)
+        invalid_count = sum(1 for entry in entries if entry[4] & FLAG_INVALID_DATE_TIME)
+        ticks = [entry[1] for entry in entries if entry[1] is not None]
+
+        if series_no is None:
+            series_no = self.conn.execute(
+                f'INSERT INTO "{SERIES_TABLE}" ("TimeSeriesId", "Signature", "EventCount", "PlaceholderCount", "BuiltAt") '
+                "VALUES (?, '', 0, 0, '')",
+                (time_series_id,),
+            ).lastrowid
+        else:
+            self.delete_series(series_no)
+        self.conn.execute(
+            f'UPDATE "{SERIES_TABLE}" SET "Signature" = ?, "EventCount" = ?, "PlaceholderCount" = ?, '
+            f'"MinTicks" = ?, "MaxTicks" = ?, "BuiltAt" = ? WHERE "SeriesNo" = ?',
+            (
+                signature,
+                len(entries),
+                placeholder_count,
+                min(ticks, default=None),
+                max(ticks, default=None),
+                datetime.now().isoformat(),
+                series_no,
+            ),
+        )
+        # the entry numbers are assigned here, so both tables are filled with one executemany each
+        first_entry_no = self.conn.execute(f'SELECT coalesce(max("EntryNo"), 0) + 1 FROM "{ENTRIES_TABLE}"').fetchone()[0]
+        self.conn.executemany(
+            f'INSERT INTO "{ENTRIES_TABLE}" ("EntryNo", "SeriesNo", "GeoEventId", "Ticks", "Latitude", "Longitude", "Flags") '
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            ((first_entry_no + i, series_no, *entry) for i, entry in enumerate(entries)),
+        )
+        # only events with a time and a real position can be found in a viewport
+        self.conn.executemany(
+            f'INSERT INTO "{BOXES_TABLE}" VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (
+                (first_entry_no + i, series_no, series_no, entry_ticks, entry_ticks, latitude, latitude, longitude, longitude)
+                for i, (_, entry_ticks, latitude, longitude, flags) in enumerate(entries)
+                if not flags
+            ),
+        )
+        return SeriesReport(time_series_id, len(entries), placeholder_count, invalid_count, True)
+
+    def query(
+        self,
+        time_series_id: str,
+        bbox: tuple[float, float, float, float] | None = None,
+        start: str | datetime | None = None,
+        end: str | datetime | None = None,
+        include_placeholders: bool = False,
+        limit: int | None = None,
+    ) -> list[sqlite3.Row]:
+        # The events of a time series inside bbox (min latitude, min longitude, max latitude,
+        # max longitude) and between start and end (both included), ordered by time. Rows have
+        # GeoEventId, Ticks, Latitude, Longitude and Flags.
+        row = self.conn.execute(
+            f'SELECT "SeriesNo" FROM "{SERIES_TABLE}" WHERE "TimeSeriesId" = ?', (time_series_id.lower(),)
+        ).fetchone()
+        if row is None:
+            return []
+        series_no = row[0]
+        start_ticks = to_ticks(start) if start is not None else None
+        end_ticks = to_ticks(end) if end is not None else None
+        if (start is not None and start_ticks is None) or (end is not None and end_ticks is None):
+            raise ValueError(f"Cannot read the time window {start} - {end}")
+
+        columns = 'e."GeoEventId", e."Ticks", e."Latitude", e."Longitude", e."Flags"'
+        conditions = []
+        parameters: list = []
+        if start_ticks is not None:
+            conditions.append('e."Ticks" >= ?')
+            parameters.append(start_ticks)
+        if end_ticks is not None:
+            conditions.append('e."Ticks" <= ?')
+            parameters.append(end_ticks)
+
+        if bbox is None:
+            # the time window alone is a range of the (SeriesNo, Ticks) index
+            conditions.insert(0, 'e."SeriesNo" = ?')
+            parameters.insert(0, series_no)
+            if not include_placeholders:
+                conditions.append('e."Flags" & ? = 0')
+                parameters.append(FLAG_PLACEHOLDER_COORDINATES)
+            sql = f'SELECT {columns} FROM "{ENTRIES_TABLE}" e WHERE {" AND ".join(conditions)}'
+        else:
+            min_latitude, min_longitude, max_latitude, max_longitude = bbox
+            box = [
+                series_no,
+                series_no,
+                start_ticks if start_ticks is not None else -1.0e19,
+                end_ticks if end_ticks is not None else 1.0e19,
+                min_latitude,
+                max_latitude,
+                min_longitude,
+                max_longitude,
+            ]
+            # the R*-tree finds the candidates, the entries compare the exact values
+            conditions += [
+                'e."Latitude" BETWEEN ? AND ?',
+                'e."Longitude" BETWEEN ? AND ?',
+            ]
+            parameters += [min_latitude, max_latitude, min_longitude, max_longitude]
+            sql = (
+                f'SELECT {columns} FROM "{BOXES_TABLE}" b JOIN "{ENTRIES_TABLE}" e ON e."EntryNo" = b."EntryNo" '
+                'WHERE b."MinSeries" <= ? AND b."MaxSeries" >= ? AND b."MaxTicks" >= ? AND b."MinTicks" <= ? '
+                'AND b."MaxLatitude" >= ? AND b."MinLatitude" <= ? AND b."MaxLongitude" >= ? AND b."MinLongitude" <= ?'
+            )
+            parameters = box + parameters
+            if conditions:
+                sql += " AND " + " AND ".join(conditions)
+        sql += ' ORDER BY e."Ticks", e."GeoEventId"'
+        if limit is not None:
+            sql += " LIMIT ?"
+            parameters.append(limit)
+        cursor = self.conn.cursor()
+        cursor.row_factory = sqlite3.Row
+        return cursor.execute(sql, parameters).fetchall()
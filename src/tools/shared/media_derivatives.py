@@ -0,0 +1,140 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
+import os
+import sys
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is only needed when derivatives are generated
+    Image = None
+
+# the module also runs as a script, so it imports its neighbours like the tools do
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from shared.media_probe import probe_media_file  # noqa: E402
+
+# derivatives are stored next to the original as <name>.<suffix>.jpg, e.g.
+# 0b6c...e1.jpg -> 0b6c...e1.thumb.jpg, 0b6c...e1.2k.jpg, 0b6c...e1.4k.jpg
+DERIVATIVE_EXTENSION = ".jpg"
+THUMBNAIL_SUFFIX = "thumb"
+THUMBNAIL_WIDTH = 512
+# downscaled versions of 360 degree images, so headsets can show a light version first
+RENDITION_WIDTHS = {"2k": 2048, "4k": 4096, "8k": 8192}
+DERIVATIVE_SUFFIXES = (THUMBNAIL_SUFFIX, *RENDITION_WIDTHS)
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+JPEG_QUALITY = 85
+# 360 degree photos are larger than Pillow's default decompression bomb limit
+MAX_IMAGE_PIXELS = 16384 * 8192 * 2
+
+
+def derivatives_available() -> bool:
+    return Image is not None
+
+
+def derivative_file_name(file_name: str, suffix: str) -> str:
+    return os.path.splitext(file_name)[0] + "." + suffix + DERIVATIVE_EXTENSION
+
+
+def is_derivative(file_name: str) -> bool:
+    stem, extension = os.path.splitext(file_name)
+    return extension == DERIVATIVE_EXTENSION and os.path.splitext(stem)[1][1:] in DERIVATIVE_SUFFIXES
+
+
+def derivative_widths(width: int, is_360: bool) -> dict[str, int]:
+    # every image gets a thumbnail, 360 degree images also the renditions smaller than the original
+    widths = {THUMBNAIL_SUFFIX: min(THUMBNAIL_WIDTH, width)}
+    if is_360:
+        widths.update({suffix: w for suffix, w in RENDITION_WIDTHS.items() if w < width})
+    return widths
+
+
+def is_up_to_date(source_path: str, derivative_path: str) -> bool:
+    try:
+        return os.stat(derivative_path).st_mtime_ns >= os.stat(source_path).st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+
+def generate_derivatives(source_path: str, is_360: bool) -> list[str]:
+    # the derivatives of one image that were (re)written; runs in a worker process
+    media_info = probe_media_file(source_path)
+    if media_info is None or media_info.kind != "image" or not media_info.width:
+        return []
+    directory, file_name = os.path.split(source_path)
+    widths = derivative_widths(media_info.width, is_360)
+    pending = {
+        os.path.join(directory, derivative_file_name(file_name, suffix)): width
+        for suffix, width in widths.items()
+    }
+    pending = {path: width for path, width in pending.items() if not is_up_to_date(source_path, path)}
+    if not pending:
+        return []
+
+    Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+    written = []
+    with Image.open(source_path) as image:
+        # let the JPEG decoder scale down while decoding, if only small versions are needed
+        largest = max(pending.values())
+        image.draft("RGB", (largest, largest * image.height // image.width))
+        image = image.convert("RGB")
+        # largest first, every smaller version is scaled from the previous one
+        for path, width in sorted(pending.items(), key=lambda item: -item[1]):
+            height = max(1, round(width * media_info.height / media_info.width))
+            if image.width != width:
+                image = image.resize((width, height), Image.LANCZOS)
+            temp_path = path + ".tmp"
+            image.save(temp_path, "JPEG", quality=JPEG_QUALITY, progressive=True, optimize=True)
+            os.replace(temp_path, path)
+            written.append(path)
+    return written
+
+
+def generate_all_derivatives(
+    images: list[tuple[str, bool]], max_workers: int | None = None
+) -> tuple[int, list[tuple[str, str]]]:
+    # (path, is 360 degree) of the images; returns the number of files written and the failures.
+    # Scaling is CPU bound, so it runs in a process pool.
+    if not derivatives_available():
+        print("Pillow is not installed, skipping derivatives (pip install Pillow)")
+        return 0, []
+    written = 0
+    failures: list[tuple[str, str]] = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(generate_derivatives, path, is_360): path for path, is_360 in images
+        }
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                written += len(future.result())
+            except Exception as e:
+                print(f"Failed to create derivatives of {path}: {e}")
+                failures.append((path, str(e)))
+    print(f"Derivatives: {written} written for {len(images)} images, {len(failures)} failed")
+    return written, failures
+
+
+def find_images(directory: str) -> list[tuple[str, bool]]:
+    # originals in a flat media directory; 360 degree images are recognised by their header
+    images = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if (
+                entry.is_file()
+                and entry.name.lower().endswith(IMAGE_EXTENSIONS)
+                and not is_derivative(entry.name)
+            ):
+                media_info = probe_media_file(entry.path)
+                images.append((entry.path, media_info is not None and media_info.is_equirectangular))
+    return sorted(images)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Create thumbnails and 360 degree renditions for the images in a media directory."
+    )
+    parser.add_argument("directory")
+    parser.add_argument("--jobs", type=int, default=None, help="Number of worker processes")
+    args = parser.parse_args()
+    _, failures = generate_all_derivatives(find_images(args.directory), args.jobs)
+    if failures:
+        sys.exit(1)
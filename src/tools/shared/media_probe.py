@@ -0,0 +1,311 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Iterable
+import json
+import os
+import struct
+import threading
+
+PROBE_CACHE_FILE_NAME = ".media_probe_cache.json"
+
+# equirectangular 360 degree media is twice as wide as high
+EQUIRECTANGULAR_ASPECT_RATIO = 2.0
+EQUIRECTANGULAR_TOLERANCE = 0.02
+
+# JPEG segments that carry the image size
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+# JPEG markers without a length field
+JPEG_STANDALONE_MARKERS = {0x01, 0xD0, 0xD1, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7, 0xD8}
+
+# MP3 bitrates in kbit/s by (MPEG-1?, layer) and sample rates by version bits
+MP3_BITRATES = {
+    (True, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (True, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (True, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (False, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (False, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (False, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+MP3_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+# how far into a file we look for an MP3 frame or JPEG metadata
+MAX_HEADER_SCAN = 64 * 1024
+
+
+class MediaInfo:
+    def __init__(
+        self,
+        kind: str,
+        width: int | None = None,
+        height: int | None = None,
+        duration: float | None = None,
+        projection: str | None = None,
+    ):
+        # kind is "image", "video" or "audio"
+        self.kind = kind
+        self.width = width
+        self.height = height
+        self.duration = duration
+        # "equirectangular" if the file says so, e.g. in the XMP metadata of a 360 degree photo
+        self.projection = projection
+
+    @property
+    def is_equirectangular(self) -> bool:
+        if self.projection == "equirectangular":
+            return True
+        if not self.width or not self.height:
+            return False
+        aspect_ratio = self.width / self.height
+        return abs(aspect_ratio - EQUIRECTANGULAR_ASPECT_RATIO) <= EQUIRECTANGULAR_TOLERANCE
+
+    def to_dict(self) -> dict:
+        return {
+            "kind": self.kind,
+            "width": self.width,
+            "height": self.height,
+            "duration": self.duration,
+            "projection": self.projection,
+        }
+
+    @staticmethod
+    def from_dict(data: dict) -> "MediaInfo":
+        return MediaInfo(
+            data["kind"], data["width"], data["height"], data["duration"], data["projection"]
+        )
+
+
+def probe_media_file(path: str) -> MediaInfo | None:
+    # read only the headers of a file; None if the format is unknown or the file is broken
+    extension = os.path.splitext(path)[1].lower()
+    probe = {
+        ".jpg": probe_jpeg,
+        ".jpeg": probe_jpeg,
+        ".png": probe_png,
+        ".mp4": probe_mp4,
+        ".m4v": probe_mp4,
+        ".mov": probe_mp4,
+        ".mp3": probe_mp3,
+    }.get(extension)
+    if probe is None:
+        return None
+    try:
+        with open(path, "rb") as f:
+            return probe(f, os.fstat(f.fileno()).st_size)
+    except (OSError, struct.error, ValueError, IndexError):
+        return None
+
+
+def probe_jpeg(f: BinaryIO, size: int) -> MediaInfo | None:
+    if f.read(2) != b"\xff\xd8":
+        return None
+    projection = None
+    while True:
+        byte = f.read(1)
+        if not byte:
+            return None
+        if byte != b"\xff":
+            continue
+        marker = f.read(1)[0]
+        # skip fill bytes
+        while marker == 0xFF:
+            marker = f.read(1)[0]
+        if marker in JPEG_STANDALONE_MARKERS:
+            continue
+        if marker == 0xD9 or marker == 0xDA:
+            # end of image or start of the compressed data: no size found
+            return None
+        length = struct.unpack(">H", f.read(2))[0]
+        if marker in JPEG_SOF_MARKERS:
+            _, height, width = struct.unpack(">BHH", f.read(5))
+            return MediaInfo("image", width, height, projection=projection)
+        if marker == 0xE1 and length <= MAX_HEADER_SCAN:
+            # APP1 holds Exif or XMP; 360 degree cameras write GPano:ProjectionType into the XMP
+            segment = f.read(length - 2)
+            if b"equirectangular" in segment:
+                projection = "equirectangular"
+        else:
+            f.seek(length - 2, os.SEEK_CUR)
+
+
+def probe_png(f: BinaryIO, size: int) -> MediaInfo | None:
+    header = f.read(24)
+    if header[:8] != b"\x89PNG\r\n\x1a\n" or header[12:16] != b"IHDR":
+        return None
+    width, height = struct.unpack(">II", header[16:24])
+    return MediaInfo("image", width, height)
+
+
+def iter_mp4_boxes(f: BinaryIO, start: int, end: int) -> Iterable[tuple[bytes, int, int]]:
+    # (type, payload offset, payload end) of the boxes between start and end, without reading payloads
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        box_size, box_type = struct.unpack(">I4s", f.read(8))
+        header_size = 8
+        if box_size == 1:
+            box_size = struct.unpack(">Q", f.read(8))[0]
+            header_size = 16
+        elif box_size == 0:
+            box_size = end - offset
+        if box_size < header_size:
+            return
+        yield box_type, offset + header_size, min(offset + box_size, end)
+        offset += box_size
+
+
+def probe_mp4(f: BinaryIO, size: int) -> MediaInfo | None:
+    for box_type, start, end in iter_mp4_boxes(f, 0, size):
+        # moov can be at the start or the end of the file; mdat in between is skipped by size
+        if box_type != b"moov":
+            continue
+        duration = None
+        width = height = None
+        for child_type, child_start, child_end in iter_mp4_boxes(f, start, end):
+            if child_type == b"mvhd":
+                duration = read_mvhd_duration(f, child_start)
+            elif child_type == b"trak" and width is None:
+                for track_box_type, track_box_start, _ in iter_mp4_boxes(f, child_start, child_end):
+                    if track_box_type == b"tkhd":
+                        track_width, track_height = read_tkhd_size(f, track_box_start)
+                        # audio tracks have no size
+                        if track_width and track_height:
+                            width, height = track_width, track_height
+        kind = "video" if width else "audio"
+        return MediaInfo(kind, width, height, duration)
+    return None
+
+
+def read_mvhd_duration(f: BinaryIO, start: int) -> float | None:
+    f.seek(start)
+    version = f.read(4)[0]
+    if version == 1:
+        _, _, timescale, duration = struct.unpack(">QQIQ", f.read(28))
+    else:
+        _, _, timescale, duration = struct.unpack(">IIII", f.read(16))
+    return duration / timescale if timescale else None
+
+
+def read_tkhd_size(f: BinaryIO, start: int) -> tuple[int, int]:
+    f.seek(start)
+    version = f.read(4)[0]
+    # creation/modification time, track id, reserved, duration
+    f.seek(32 if version == 1 else 20, os.SEEK_CUR)
+    # reserved, layer, alternate group, volume, reserved, matrix
+    f.seek(8 + 2 + 2 + 2 + 2 + 36, os.SEEK_CUR)
+    width, height = struct.unpack(">II", f.read(8))
+    # 16.16 fixed point
+    return width >> 16, height >> 16
+
+
+def probe_mp3(f: BinaryIO, size: int) -> MediaInfo | None:
+    audio_start = 0
+    header = f.read(10)
+    if header[:3] == b"ID3":
+        # the ID3v2 tag size is stored as a syncsafe integer
+        tag_size = (header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9]
+        audio_start = 10 + tag_size
+    f.seek(audio_start)
+    data = f.read(MAX_HEADER_SCAN)
+
+    for i in range(len(data) - 4):
+        if data[i] != 0xFF or (data[i + 1] & 0xE0) != 0xE0:
+            continue
+        version_bits = (data[i + 1] >> 3) & 0x03
+        layer = 4 - ((data[i + 1] >> 1) & 0x03)
+        bitrate_index = data[i + 2] >> 4
+        sample_rate_index = (data[i + 2] >> 2) & 0x03
+        if version_bits == 1 or layer == 4 or bitrate_index in (0, 15) or sample_rate_index == 3:
+            continue
+        mpeg1 = version_bits == 3
+        mono = (data[i + 3] >> 6) == 3
+        bitrate = MP3_BITRATES[(mpeg1, layer)][bitrate_index] * 1000
+        sample_rate = MP3_SAMPLE_RATES[version_bits][sample_rate_index]
+        samples_per_frame = 384 if layer == 1 else (1152 if mpeg1 or layer == 2 else 576)
+
+        # VBR files announce their frame count in a Xing/Info or VBRI header in the first frame
+        side_info = (17 if mono else 32) if mpeg1 else (9 if mono else 17)
+        xing = data[i + 4 + side_info : i + 4 + side_info + 12]
+        if xing[:4] in (b"Xing", b"Info") and struct.unpack(">I", xing[4:8])[0] & 0x1:
+            frames = struct.unpack(">I", xing[8:12])[0]
+            return MediaInfo("audio", duration=frames * samples_per_frame / sample_rate)
+        vbri = data[i + 36 : i + 36 + 18]
+        if vbri[:4] == b"VBRI":
+            frames = struct.unpack(">I", vbri[14:18])[0]
+            return MediaInfo("audio", duration=frames * samples_per_frame / sample_rate)
+
+        # constant bitrate: the duration follows from the size
+        audio_size = size - (audio_start + i)
+        return MediaInfo("audio", duration=audio_size * 8 / bitrate)
+    return None
+
+
+class ProbeCache:
+    """Probe results by path, valid as long as size and mtime of the file do not change.
+
+    The cache also owns the threads that probe the files. Directories processed in parallel
+    share them instead of each starting a pool of its own; close() stops them.
+    """
+
+    def __init__(self, path: str | None = None, max_workers: int | None = None):
+        self.path = path
+        self.max_workers = max_workers
+        self.entries: dict[str, dict] = {}
+        self.changed = False
+        self._lock = threading.Lock()
+        self._executor: ThreadPoolExecutor | None = None
+        if path and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+
+    def probe(self, media_file_path: str) -> MediaInfo | None:
+        key = os.path.abspath(media_file_path)
+        try:
+            stat = os.stat(media_file_path)
+        except OSError:
+            # removed since the scan, there is nothing to probe
+            return None
+        signature = [stat.st_size, stat.st_mtime_ns]
+        with self._lock:
+            entry = self.entries.get(key)
+        if entry is not None and entry["signature"] == signature:
+            return MediaInfo.from_dict(entry["info"]) if entry["info"] else None
+
+        info = probe_media_file(media_file_path)
+        with self._lock:
+            self.entries[key] = {"signature": signature, "info": info.to_dict() if info else None}
+            self.changed = True
+        return info
+
+    def probe_all(self, paths: list[str]) -> list[MediaInfo | None]:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+            executor = self._executor
+        return list(executor.map(self.probe, paths))
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
+
+    def save(self):
+        if not self.path or not self.changed:
+            return
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f, ensure_ascii=False)
+        os.replace(temp_path, self.path)
+        self.changed = False
+
+
+def probe_media_files(
+    paths: Iterable[str], cache: ProbeCache | None = None, max_workers: int | None = None
+) -> dict[str, MediaInfo | None]:
+    # probe many files at once; header reads are small, so threads overlap the I/O latency.
+    # With a cache its threads are used, without one a pool is started for these files.
+    paths = list(paths)
+    if cache is not None:
+        return dict(zip(paths, cache.probe_all(paths)))
+    cache = ProbeCache()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(paths, executor.map(cache.probe, paths)))
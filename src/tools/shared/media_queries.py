@@ -0,0 +1,70 @@
+from typing import Iterator
+import sqlite3
+
+from shared.models import MediaFile
+
+# Url of the media files that are served by the admin UI itself
+LOCAL_URL_PREFIX = "/api/media/file/"
+# The condition is part of the SQL text and not a parameter: SQLite only uses a partial index
+# if the query repeats the condition of the index literally.
+EXTERNAL_URL_CONDITION = f"\"Url\" NOT LIKE '{LOCAL_URL_PREFIX}%'"
+EXTERNAL_URL_INDEX = "IX_MediaFiles_Id_ExternalUrl"
+
+MEDIA_FILE_COLUMNS = ", ".join(f'"{column}"' for column in MediaFile.COLUMNS)
+
+
+def ensure_external_url_index(conn: sqlite3.Connection) -> bool:
+    # A partial index of the Ids of the media files that still have an external URL. It only
+    # holds the work that is left, so selecting the next batch does not scan the whole table.
+    # Returns True if the index was created.
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", (EXTERNAL_URL_INDEX,)
+    ).fetchone()
+    if exists:
+        return False
+    with conn:
+        conn.execute(
+            f'CREATE INDEX IF NOT EXISTS "{EXTERNAL_URL_INDEX}" ON "MediaFiles" ("Id") '
+            f"WHERE {EXTERNAL_URL_CONDITION}"
+        )
+    return True
+
+
+def count_external_media_files(conn: sqlite3.Connection) -> int:
+    return conn.execute(f'SELECT count(*) FROM "MediaFiles" WHERE {EXTERNAL_URL_CONDITION}').fetchone()[0]
+
+
+def iter_media_files(
+    conn: sqlite3.Connection,
+    external_only: bool = False,
+    batch_size: int = 500,
+    limit: int | None = None,
+) -> Iterator[sqlite3.Row]:
+    # Streams the media files ordered by Id, one batch per query. Every batch continues after
+    # the last Id of the one before (keyset pagination), so it is an index seek no matter how
+    # far into the table it is, and rows that change in between are neither skipped nor repeated.
+    condition = f"{EXTERNAL_URL_CONDITION} AND " if external_only else ""
+    query = (
+        f'SELECT {MEDIA_FILE_COLUMNS} FROM "MediaFiles" '
+        f'WHERE {condition}"Id" > ? ORDER BY "Id" LIMIT ?'
+    )
+    last_id = ""
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = batch_size if remaining is None else min(batch_size, remaining)
+        rows = conn.execute(query, (last_id, size)).fetchall()
+        if not rows:
+            return
+        yield from rows
+        if remaining is not None:
+            remaining -= len(rows)
+        if len(rows) < size:
+            return
+        last_id = rows[-1][0]
+
+
+def iter_external_media_files(
+    conn: sqlite3.Connection, batch_size: int = 500, limit: int | None = None
+) -> Iterator[sqlite3.Row]:
+    # the media files that still have to be downloaded
+    return iter_media_files(conn, True, batch_size, limit)
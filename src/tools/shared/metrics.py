@@ -0,0 +1,104 @@
+from contextlib import contextmanager
+from typing import TextIO
+import json
+import os
+import re
+import threading
+import time
+
+
+def format_value(value: float) -> str:
+    # plain decimal notation, large byte counts must not lose digits to an exponent
+    return f"{value:.6f}".rstrip("0").rstrip(".")
+
+
+class Metrics:
+    """Per-stage timers and counters of a run, safe to use from several threads.
+
+    Usage:
+        with metrics.timer("get", file_id=file_id):
+            ...
+        metrics.count("bytes_downloaded", len(chunk))
+
+    With a trace file every timed stage is also written as one JSON line, so single slow files
+    can be found. At the end of a run the totals can be printed or written in the Prometheus
+    text format, e.g. for the textfile collector of the node exporter.
+    """
+
+    def __init__(self):
+        # stage -> [calls, total seconds, max seconds]
+        self.stages: dict[str, list] = {}
+        self.counters: dict[str, float] = {}
+        self._trace: TextIO | None = None
+        self._lock = threading.Lock()
+
+    def start_trace(self, path: str):
+        self._trace = open(path, "a", encoding="utf-8")
+
+    @contextmanager
+    def timer(self, stage: str, **fields):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - started, **fields)
+
+    def record(self, stage: str, seconds: float, **fields):
+        with self._lock:
+            stats = self.stages.setdefault(stage, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+            if self._trace:
+                event = {"time": round(time.time(), 6), "stage": stage, "seconds": round(seconds, 6)}
+                event.update(fields)
+                self._trace.write(json.dumps(event, ensure_ascii=False) + "\n")
+
+    def count(self, name: str, value: float = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def get(self, name: str) -> float:
+        return self.counters.get(name, 0)
+
+    def summary(self) -> str:
+        # where the time went, the slowest stage first
+        lines = ["Time per stage:"]
+        for stage, (calls, total, slowest) in sorted(self.stages.items(), key=lambda item: -item[1][1]):
+            lines.append(f"  {stage:<14}{total:>10.2f}s in {calls} calls (max {slowest:.3f}s)")
+        if self.counters:
+            lines.append("Counters:")
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"  {name:<20}{value:>14,.0f}")
+        return "\n".join(lines)
+
+    def write_prometheus(self, path: str, prefix: str = "virtualmuseum"):
+        lines = []
+        stage_metrics = [
+            ("stage_seconds_total", "counter", "Time spent in each stage.", 1),
+            ("stage_calls_total", "counter", "Number of times each stage ran.", 0),
+            ("stage_max_seconds", "gauge", "Longest single run of each stage.", 2),
+        ]
+        for name, metric_type, help_text, index in stage_metrics:
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} {metric_type}")
+            for stage, stats in self.stages.items():
+                lines.append(f'{prefix}_{name}{{stage="{stage}"}} {format_value(stats[index])}')
+        for name, value in sorted(self.counters.items()):
+            metric = f"{prefix}_{re.sub(r'[^a-zA-Z0-9_]', '_', name)}_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric} {format_value(value)}")
+        # write and rename, so a collector never reads a half written file
+        temp_path = path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temp_path, path)
+
+    def close(self):
+        if self._trace:
+            self._trace.close()
+            self._trace = None
+
+
+# one registry per process, shared by all modules of a tool
+metrics = Metrics()
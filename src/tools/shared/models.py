@@ -0,0 +1,231 @@
+from datetime import datetime
+from enum import IntEnum
+import uuid
+
+
+class MediaType(IntEnum):
+    Image2D = 0
+    Image3D = 1
+    Image360Degree = 2
+    Video2D = 3
+    Video3D = 4
+    Video360Degree = 5
+    Audio = 6
+
+
+def pack_uuid(value: str) -> bytes | str:
+    # 16 bytes instead of a 36 character string. Ids that would not be written back exactly as
+    # they were read (upper case, braces, no uuid at all) are kept as strings, the database
+    # compares them as text.
+    try:
+        packed = uuid.UUID(value)
+    except (AttributeError, TypeError, ValueError):
+        return value
+    return packed.bytes if str(packed) == value else value
+
+
+def unpack_uuid(value: bytes | str) -> str:
+    return str(uuid.UUID(bytes=value)) if isinstance(value, bytes) else value
+
+
+def uuid_attribute(slot: str) -> property:
+    # a uuid attribute that reads and writes strings but keeps the packed value in the slot
+    def get(self) -> str:
+        return unpack_uuid(getattr(self, slot))
+
+    def set(self, value: str):
+        setattr(self, slot, pack_uuid(value))
+
+    return property(get, set)
+
+
+# The models of the import tools, one per table of virtualmuseum.db. They use __slots__ instead
+# of a __dict__ per instance, so catalogs with hundreds of thousands of entries stay small.
+# to_row() returns the values in the order of COLUMNS, for csv.writer and the BulkLoader.
+class MultiMediaPresentation:
+    __slots__ = ("_id", "Name", "Description", "MediaFiles")
+
+    TABLE = "MultimediaPresentations"
+    COLUMNS = ("Id", "Name", "Description")
+
+    Id = uuid_attribute("_id")
+
+    def __init__(self, Id: str = "", Name: str = "", Description: str = "", MediaFiles: list | None = None):
+        self.Id = Id
+        self.Name = Name
+        self.Description = Description
+        self.MediaFiles = MediaFiles if MediaFiles is not None else []
+
+    def to_row(self) -> tuple:
+        return (unpack_uuid(self._id), self.Name, self.Description)
+
+
+class MediaFile:
+    __slots__ = ("_id", "Name", "Description", "FileName", "Type", "Url", "DurationInSeconds")
+
+    TABLE = "MediaFiles"
+    COLUMNS = ("Id", "Description", "DurationInSeconds", "FileName", "Name", "Type", "Url")
+    # an import without --ingest has no Url yet, it must not remove the one of an earlier
+    # ingest or migration
+    KEEP_EXISTING = ("FileName", "Url")
+
+    Id = uuid_attribute("_id")
+
+    def __init__(
+        self,
+        Id: str = "",
+        Name: str = "",
+        Description: str = "",
+        FileName: str = "",
+        Type: MediaType = MediaType.Image2D,
+        Url: str = "",
+        DurationInSeconds: float = 0,
+    ):
+        self.Id = Id
+        self.Name = Name
+        self.Description = Description
+        self.FileName = FileName
+        self.Type = MediaType(Type)
+        self.Url = Url
+        self.DurationInSeconds = DurationInSeconds
+
+    def to_row(self) -> tuple:
+        return (
+            unpack_uuid(self._id),
+            self.Description,
+            self.DurationInSeconds or 0,
+            self.FileName,
+            self.Name,
+            int(self.Type),
+            self.Url,
+        )
+
+
+class PresentationItem:
+    __slots__ = ("_id", "_presentation_id", "_media_file_id", "SlotNumber", "SequenceNumber", "DurationInSeconds")
+
+    TABLE = "PresentationItems"
+    COLUMNS = (
+        "Id",
+        "MultimediaPresentationId",
+        "MediaFileId",
+        "SlotNumber",
+        "SequenceNumber",
+        "DurationInSeconds",
+    )
+
+    Id = uuid_attribute("_id")
+    MultimediaPresentationId = uuid_attribute("_presentation_id")
+    MediaFileId = uuid_attribute("_media_file_id")
+
+    def __init__(
+        self,
+        Id: str = "",
+        MultimediaPresentationId: str = "",
+        MediaFileId: str = "",
+        SlotNumber: int = 0,
+        SequenceNumber: int = 0,
+        DurationInSeconds: int = 0,
+    ):
+        self.Id = Id
+        self.MultimediaPresentationId = MultimediaPresentationId
+        self.MediaFileId = MediaFileId
+        self.SlotNumber = SlotNumber
+        self.SequenceNumber = SequenceNumber
+        self.DurationInSeconds = DurationInSeconds
+
+    def to_row(self) -> tuple:
+        return (
+            unpack_uuid(self._id),
+            unpack_uuid(self._presentation_id),
+            unpack_uuid(self._media_file_id),
+            self.SlotNumber,
+            self.SequenceNumber,
+            self.DurationInSeconds,
+        )
+
+
+class GeoEventGroup:
+    __slots__ = ("_id", "Label", "Description", "_time_series_id")
+
+    TABLE = "GeoEventGroups"
+    COLUMNS = ("Id", "Label", "Description", "TimeSeriesId")
+
+    Id = uuid_attribute("_id")
+    TimeSeriesId = uuid_attribute("_time_series_id")
+
+    def __init__(self, Id: str = "", Label: str = "", Description: str = "", TimeSeriesId: str = ""):
+        self.Id = Id
+        self.Label = Label
+        self.Description = Description
+        self.TimeSeriesId = TimeSeriesId
+
+    def to_row(self) -> tuple:
+        return (unpack_uuid(self._id), self.Label, self.Description, unpack_uuid(self._time_series_id))
+
+
+class GeoEvent:
+    __slots__ = (
+        "_id",
+        "_group_id",
+        "_presentation_id",
+        "Label",
+        "Description",
+        "DateTime",
+        "Latitude",
+        "Longitude",
+    )
+
+    TABLE = "GeoEvents"
+    COLUMNS = (
+        "Id",
+        "GeoEventGroupId",
+        "MultimediaPresentationId",
+        "Label",
+        "Description",
+        "DateTime",
+        "Latitude",
+        "Longitude",
+    )
+    # databases created by the EF migrations call the label "Name"
+    COLUMN_ALIASES = {"Label": "Name"}
+
+    Id = uuid_attribute("_id")
+    GeoEventGroupId = uuid_attribute("_group_id")
+    MultimediaPresentationId = uuid_attribute("_presentation_id")
+
+    def __init__(
+        self,
+        Id: str = "",
+        GeoEventGroupId: str = "",
+        MultimediaPresentationId: str = "",
+        Label: str = "",
+        Description: str = "",
+        DateTime: datetime | None = None,
+        Latitude: float = 0,
+        Longitude: float = 0,
+    ):
+        self.Id = Id
+        self.GeoEventGroupId = GeoEventGroupId
+        self.MultimediaPresentationId = MultimediaPresentationId
+        self.Label = Label
+        self.Description = Description
+        self.DateTime = DateTime
+        self.Latitude = Latitude
+        self.Longitude = Longitude
+
+    def to_row(self) -> tuple:
+        return (
+            unpack_uuid(self._id),
+            unpack_uuid(self._group_id),
+            unpack_uuid(self._presentation_id),
+            self.Label,
+            self.Description,
+            # the database keeps the date as text, like str(datetime)
+            str(self.DateTime) if self.DateTime is not None else None,
+            self.Latitude,
+            self.Longitude,
+        )
+
+
+MODELS = (MultiMediaPresentation, MediaFile, PresentationItem, GeoEventGroup, GeoEvent)